@@ -1,13 +1,40 @@
+from datetime import datetime
 import os
+import time
 
-from flask import Flask, render_template, request, flash, redirect, session, g, abort
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify, Response
 from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import exists
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm
-from models import db, connect_db, User, Message
+from httpcache import conditional
+from instrumentation import query_budget
+from models import db, connect_db, User, Message, Follows, Likes
+from pagination import build_page, cursor_args, keyset, seek
+from search import search_users
+import assets
+import counters
+import directory
+import follows
+import fragments
+import httpcache
+import instrumentation
+import likes
+import metrics
+import migrations
+import passwords
+import principal
+import profiling
+import recommendations
+import timeline
+import typeahead
+import viewer
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_VERSION_KEY = "curr_user_version"
 
 app = Flask(__name__)
 
@@ -20,9 +47,19 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['TIMELINE_PAGE_SIZE'] = 100
+app.config['USERS_PAGE_SIZE'] = 24
+app.config['SIDEBAR_STALE_SECONDS'] = 60
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+instrumentation.init_app(app)
+metrics.init_app(app, db)
+profiling.init_app(app)
+fragments.init_app(app)
+httpcache.init_app(app)
+assets.init_app(app)
 
 
 ##############################################################################
@@ -31,10 +68,15 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    `g.user` is a cached principal.Principal, not a User; routes that
+    change the user call `principal.load_user()` for the ORM object.
+    """
+
+    if CURR_USER_KEY in session and request.endpoint != 'static':
+        g.user = principal.get(session[CURR_USER_KEY],
+                               session.get(CURR_USER_VERSION_KEY, 0))
 
     else:
         
@@ -42,17 +84,44 @@ def add_user_to_g():
       
 
 
+@app.context_processor
+def add_viewer_to_templates():
+    """Expose the current user's relationship lookups to templates."""
+
+    return {'viewer': viewer.current_viewer()}
+
+
+def message_key(msg):
+    """Keyset sort key for message timelines."""
+
+    return (msg.timestamp, msg.id)
+
+
+def liked_among(messages):
+    """Ids of the given messages that the current user has liked."""
+
+    message_ids = [msg.id for msg in messages]
+    if not message_ids:
+        return []
+
+    return [message_id for (message_id,) in db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == g.user.id,
+                    Likes.message_id.in_(message_ids))]
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_VERSION_KEY] = user.profile_version
 
 
 def do_logout():
     """Logout user."""
 
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
+    session.pop(CURR_USER_KEY, None)
+    session.pop(CURR_USER_VERSION_KEY, None)
 
 
 @app.route('/signup', methods=["GET", "POST"])
@@ -100,13 +169,21 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        username, ip = form.username.data, passwords.client_ip()
+        if passwords.attempts.blocked(username, ip):
+            flash("Too many failed logins. Please try again later.", 'danger')
+            return render_template('users/login.html', form=form), 429
+
+        user = User.authenticate(username, form.password.data)
         if user:
+            # saves the password if it was re-hashed at the current cost
+            db.session.commit()
+            passwords.attempts.succeeded(username)
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
+        passwords.attempts.failed(username, ip)
         flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
@@ -128,39 +205,94 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@query_budget(8)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations, and a 'page' param to page through ranked results.
+    Without 'q', lists everyone alphabetically, paged by `before`/`after`.
     """
     search = request.args.get('q')
     if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        before, after = cursor_args(request, (str,))
+
+        # Anonymous pages without flashed messages are the same for everyone.
+        shared = not g.user and '_flashes' not in session
+        if shared:
+            html = directory.rendered.get((before, after))
+            if html is not None:
+                return html
 
-    return render_template('users/index.html', users=users)
+        page = directory.page(before, after, app.config['USERS_PAGE_SIZE'])
+        html = render_template('users/index.html', users=page, page=page,
+                               total=directory.user_count())
+        if shared:
+            directory.rendered.set((before, after), html)
+        return html
+
+    results = search_users(search, page=request.args.get('page', 1, type=int))
+    return render_template('users/index.html', users=results, results=results)
+
+
+@app.route('/users/autocomplete')
+def users_autocomplete():
+    """JSON username suggestions for the search box.
+
+    Takes a 'q' prefix in the querystring; returns the most-followed matches.
+    """
+
+    prefix = request.args.get('q', '').strip()
+    return jsonify(users=typeahead.complete(prefix))
+
+
+def profile_page_version(user_id):
+    """Validator for a profile page: the user's stamps and counters, plus
+    the ids and like counts of the messages on the requested page.
+
+    The sidebar's "followed by" and suggestions come from data refreshed
+    in the background, so a time bucket lets them catch up.
+    """
+
+    user = (db.session
+            .query(User.profile_version, User.messages_count, User.following_count,
+                   User.followers_count, User.likes_count)
+            .filter(User.id == user_id)
+            .first())
+    if user is None:
+        return None
+
+    before, after = cursor_args(request, (datetime, int))
+    messages = (seek(db.session.query(Message.id, Message.likes_count)
+                     .filter(Message.user_id == user_id),
+                     [Message.timestamp, Message.id], before, after)
+                .limit(app.config['TIMELINE_PAGE_SIZE'] + 1)
+                .all())
+
+    return (tuple(user), tuple(map(tuple, messages)),
+            int(time.time() // app.config['SIDEBAR_STALE_SECONDS']))
 
 
 @app.route('/users/<int:user_id>')
+@query_budget(8)
+@conditional(profile_page_version)
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
+    before, after = cursor_args(request, (datetime, int))
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = [l_msg.id for l_msg in user.likes]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes)
+    page = keyset(Message.query.filter(Message.user_id == user_id),
+                  [Message.timestamp, Message.id], message_key,
+                  before, after, app.config['TIMELINE_PAGE_SIZE'])
+
+    return render_template('users/show.html', user=user, messages=page, page=page)
 
 
 @app.route('/users/<int:user_id>/following')
+@query_budget(7)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -169,10 +301,20 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    before, after = cursor_args(request, (int,))
+
+    following = (User
+                 .query
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == user_id))
+    page = keyset(following, [User.id], lambda u: (u.id,),
+                  before, after, app.config['USERS_PAGE_SIZE'])
+
+    return render_template('users/following.html', user=user, users=page, page=page)
 
 
 @app.route('/users/<int:user_id>/followers')
+@query_budget(7)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -181,7 +323,16 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    before, after = cursor_args(request, (int,))
+
+    followers = (User
+                 .query
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == user_id))
+    page = keyset(followers, [User.id], lambda u: (u.id,),
+                  before, after, app.config['USERS_PAGE_SIZE'])
+
+    return render_template('users/followers.html', user=user, users=page, page=page)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -192,9 +343,14 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if not db.session.query(exists().where(User.id == follow_id)).scalar():
+        abort(404)
+
+    follows.follow(g.user.id, follow_id)
     db.session.commit()
+    viewer.forget(g.user.id)
+    principal.forget(g.user.id)
+    principal.forget(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -207,13 +363,51 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    follows.unfollow(g.user.id, follow_id)
     db.session.commit()
+    viewer.forget(g.user.id)
+    principal.forget(g.user.id)
+    principal.forget(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.route('/users/follow/bulk', methods=['POST'])
+def bulk_follow():
+    """Follow many accounts at once, e.g. when importing from elsewhere.
+
+    Takes JSON {"user_ids": [...], "usernames": [...]} (either may be
+    omitted) and answers with the ids newly followed, how many were
+    already followed, and the ids/usernames that don't exist.
+    """
+
+    if not g.user:
+        abort(401)
+
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('user_ids', [])
+    usernames = data.get('usernames', [])
+    if (not isinstance(user_ids, list) or not isinstance(usernames, list)
+            or not all(isinstance(user_id, int) and not isinstance(user_id, bool)
+                       for user_id in user_ids)
+            or not all(isinstance(username, str) for username in usernames)):
+        abort(400)
+
+    try:
+        result = follows.follow_many(g.user.id, user_ids, usernames)
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+
+    db.session.commit()
+    viewer.forget(g.user.id)
+    for user_id in [g.user.id] + result.followed:
+        principal.forget(user_id)
+
+    return jsonify(followed=result.followed,
+                   already_following=result.already_following,
+                   not_found=result.not_found)
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
@@ -223,21 +417,30 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
-    form = EditProfileForm(obj= g.user)
+    form = EditProfileForm(obj=principal.load_user())
     
     if form.validate_on_submit():
+        if passwords.attempts.blocked(g.user.username, passwords.client_ip()):
+            flash("Too many wrong passwords. Please try again later.", 'danger')
+            return render_template("users/edit.html", form=form, user_id=g.user.id), 429
+
         user = User.authenticate(g.user.username,
                                  form.password.data)
         if user:
-            g.user.username = form.username.data
-            g.user.email = form.email.data
-            g.user.image_url = form.image_url.data or "/static/images/default-pic.png"
-            g.user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
-            g.user.bio = form.bio.data
+            user.username = form.username.data
+            user.email = form.email.data
+            user.image_url = form.image_url.data or "/static/images/default-pic.png"
+            user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
+            user.bio = form.bio.data
+            user.profile_version = User.profile_version + 1
             
             db.session.commit()
+            passwords.attempts.succeeded(g.user.username)
+            principal.forget(user.id)
+            session[CURR_USER_VERSION_KEY] = user.profile_version
             flash("Your profile is updated successfully", "success")
             return redirect(f"/users/{g.user.id}")
+        passwords.attempts.failed(g.user.username, passwords.client_ip())
         flash("Wrong password, please try again.", 'danger')
     return render_template("users/edit.html", form=form, user_id=g.user.id)
 
@@ -255,8 +458,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = principal.load_user()
+    counters.before_user_delete(user)
+    db.session.delete(user)
     db.session.commit()
+    principal.forget(user.id)
 
     return redirect("/signup")
 
@@ -278,20 +484,38 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out(msg)
         db.session.commit()
+        principal.forget(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+def message_version(message_id):
+    """Validator for a message page: its like count and its author's stamp."""
+
+    row = (db.session
+           .query(Message.likes_count, Message.user_id, User.profile_version)
+           .join(Message.user)
+           .filter(Message.id == message_id)
+           .first())
+    return tuple(row) if row else None
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@query_budget(6)
+@conditional(message_version)
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.options(joinedload(Message.user)).get(message_id)
+    if msg is None:
+        abort(404)
     return render_template('messages/show.html', message=msg)
 
 
@@ -307,101 +531,246 @@ def messages_destroy(message_id):
     if msg.user_id != g.user.id:
         flash("Cannot delete this message!", "danger")
         return redirect("/")
+    timeline.retract(msg)
+    counters.before_message_delete(msg)
     db.session.delete(msg)
     db.session.commit()
+    principal.forget(g.user.id)
+    fragments.forget(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
+@query_budget(6)
 def show_likes(user_id):
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/liked_msgs.html', user=user, likes=user.likes)
+    before, after = cursor_args(request, (int,))
+
+    liked = (Message
+             .query
+             .options(joinedload(Message.user))
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id))
+    page = keyset(liked, [Likes.message_id], lambda msg: (msg.id,),
+                  before, after, app.config['TIMELINE_PAGE_SIZE'])
+
+    return render_template('users/liked_msgs.html', user=user, likes=page, page=page)
+
+
+def likeable_author(message_id):
+    """The author id of a message the current user may like; aborts otherwise."""
+
+    author_id = (db.session
+                 .query(Message.user_id)
+                 .filter(Message.id == message_id)
+                 .scalar())
+    if author_id is None:
+        abort(404)
+    if author_id == g.user.id:
+        abort(403)
+    return author_id
 
 
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
 def toggle_likes(message_id):
-    """like/unlike msg for the signed-in user"""
+    """like/unlike msg for the signed-in user
+
+    Answers with {"liked": true/false} when the request accepts JSON, so
+    the like buttons can update in place.
+    """
     # Get the URL of the previous page
     previous_page = request.referrer
+    wants_json = request.accept_mimetypes.best == 'application/json'
     if not g.user:
+        if wants_json:
+            abort(401)
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    liked_message = Message.query.get_or_404(message_id)
-    if liked_message.user_id != g.user.id:
-        if liked_message in g.user.likes:
-            g.user.likes = [like for like in g.user.likes if like != liked_message]
-        else:
-            g.user.likes.append(liked_message)
+    likeable_author(message_id)
+    liked = likes.toggle(g.user.id, message_id)
+    db.session.commit()
+    principal.forget(g.user.id)
 
-        db.session.commit()
-        # Check if the referrer exists and is not the current page to avoid infinite redirects
-        if previous_page and previous_page != request.url:
+    if wants_json:
+        return jsonify(liked=liked)
+
+    # Check if the referrer exists and is not the current page to avoid infinite redirects
+    if previous_page and previous_page != request.url:
         # Redirect back to the previous page
-           return redirect(previous_page) 
-        else:
-        # If there is no referrer or it's the same page, redirect to a default URL
-           return redirect("/")
+        return redirect(previous_page)
+    # If there is no referrer or it's the same page, redirect to a default URL
     return redirect("/")
-   
-    
-       
 
-    
 
-    
+@app.route('/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def set_like(message_id):
+    """Like (PUT) or unlike (DELETE) a message; idempotent, answers 204."""
 
-    
+    if not g.user:
+        abort(401)
+
+    likeable_author(message_id)
+    if request.method == 'PUT':
+        changed = likes.like(g.user.id, message_id)
+    else:
+        changed = likes.unlike(g.user.id, message_id)
+
+    if changed:
+        db.session.commit()
+        principal.forget(g.user.id)
+
+    return '', 204
 
 
 ##############################################################################
 # Homepage and error pages
 
 
+def anonymous_home_version():
+    """Validator for the logged-out home page, which only changes on deploy."""
+
+    return None if g.user else ()
+
+
 @app.route('/')
+@query_budget(8)
+@conditional(anonymous_home_version)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users,
+      read from the user's materialized timeline and paged by
+      `before`/`after` cursors
     """
 
     if g.user:
-        following_ids = [followed.id for followed in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        ids_of_liked_msgs = [msg.id for msg in g.user.likes]
+        before, after = cursor_args(request, (datetime, int))
+        per_page = app.config['TIMELINE_PAGE_SIZE']
 
+        messages = timeline.home_timeline(g.user.id, per_page + 1, before, after)
+        page = build_page(messages, per_page, message_key, before, after)
 
-        return render_template('home.html', messages=messages, likes=ids_of_liked_msgs)
+        ids_of_liked_msgs = liked_among(page)
+
+        return render_template('home.html', messages=page, page=page, likes=ids_of_liked_msgs)
 
     else:
         return render_template('home-anon.html')
 
 
+@app.errorhandler(passwords.HasherBusy)
+def hasher_busy(error):
+    """Shed sign-ups and logins while the password hash pool is full."""
+
+    return ("Too many sign-ins right now. Please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
+##############################################################################
+# Monitoring
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint, summed across gunicorn workers.
+
+    When METRICS_TOKEN is set, scrapers must send it as a bearer token.
+    """
+
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+
+    body = metrics.exposition(db.engine, app.config['METRICS_DIR'])
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
+
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+
+@app.cli.command('rebuild-timelines')
+@click.option('--after-id', type=int, default=0,
+              help="Resume after this user id, as logged by an earlier run.")
+def rebuild_timelines_command(after_id):
+    """Recreate every user's home timeline from messages and follows."""
+
+    done = timeline.rebuild_all(after_id=after_id, log=print)
+    print(f"Rebuilt timelines for {done} user(s).")
+
+
+@app.cli.command('trim-timelines')
+def trim_timelines_command():
+    """Drop home timeline entries beyond each user's newest TIMELINE_LIMIT."""
+
+    deleted = timeline.trim_all()
+    print(f"Trimmed {deleted} timeline entries.")
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute every user's message/follow/like counters."""
+
+    drifted = counters.reconcile()
+    db.session.commit()
+    print(f"Repaired counters for {drifted} user(s).")
+
+
+@app.cli.command('recommend')
+@click.option('--watch', is_flag=True,
+              help="Keep recomputing stale suggestions until stopped.")
+def recommend_command(watch):
+    """Recompute every user's "who to follow" suggestions."""
+
+    if watch:
+        recommendations.run()
+
+    done = recommendations.refresh_all()
+    print(f"Recomputed suggestions for {done} user(s).")
+
+
+@app.cli.group('assets')
+def assets_group():
+    """Static asset pipeline."""
+
+
+@assets_group.command('vendor')
+def assets_vendor_command():
+    """Download the pinned third-party CSS, JS and fonts."""
+
+    assets.vendor(app.static_folder)
+
+
+@assets_group.command('build')
+def assets_build_command():
+    """Fingerprint and precompress static files into static/dist."""
+
+    assets.build(app.static_folder)
+
+
+@app.cli.group()
+def schema():
+    """Versioned schema migrations."""
+
+
+@schema.command('upgrade')
+def schema_upgrade_command():
+    """Apply all pending schema migrations."""
+
+    migrations.upgrade(db.engine)
+    print("Schema is up to date.")
+
+
+@schema.command('status')
+def schema_status_command():
+    """List migrations that have not been applied yet."""
+
+    for step in migrations.pending(db.engine):
+        print(f"pending {step.version}: {step.description}")
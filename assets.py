@@ -0,0 +1,244 @@
+"""Static asset pipeline: vendored libraries, fingerprinted and precompressed.
+
+Two build steps, run on deploy:
+
+    flask assets vendor   # download Bootstrap, jQuery, Popper, Font Awesome
+    flask assets build    # fingerprint and compress everything under static/
+
+`vendor` saves the pinned CDN files under static/vendor/. `build` copies
+every static file to static/dist/ under a name carrying a hash of its
+contents (`style.css` -> `style.3f2a9c1e4b7d.css`), rewrites url(...)
+references inside stylesheets to the hashed names, writes `.gz` and
+`.br` variants of text files, and records the mapping in
+static/dist/manifest.json. Both directories are build output and are not
+committed. `build` needs the `brotli` package (pinned in
+requirements.txt) and refuses to run without it, rather than quietly
+shipping gzip only; serving the built files does not.
+
+Templates link assets with `static_url(path)`: the hashed file when the
+manifest has one (cached for a year as immutable, see httpcache.py),
+else the CDN copy for vendored files that haven't been downloaded, else
+the plain static URL. Requests for hashed files are answered with the
+precompressed variant the browser accepts.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+from urllib.request import urlopen
+
+from flask import current_app, request, safe_join, send_file, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+FONTAWESOME = 'https://use.fontawesome.com/releases/v5.3.1'
+
+# Vendored file -> where it is downloaded from (and linked, until it is).
+VENDOR = {
+    'vendor/bootstrap/bootstrap.min.css':
+        'https://unpkg.com/bootstrap@4.1.3/dist/css/bootstrap.min.css',
+    'vendor/bootstrap/bootstrap.min.js':
+        'https://unpkg.com/bootstrap@4.1.3/dist/js/bootstrap.min.js',
+    'vendor/jquery/jquery.min.js':
+        'https://unpkg.com/jquery@3.3.1/dist/jquery.min.js',
+    'vendor/popper/popper.min.js':
+        'https://unpkg.com/popper.js@1.14.3/dist/umd/popper.min.js',
+    'vendor/fontawesome/css/all.css': f'{FONTAWESOME}/css/all.css',
+}
+VENDOR.update({
+    f'vendor/fontawesome/webfonts/{font}.{ext}': f'{FONTAWESOME}/webfonts/{font}.{ext}'
+    for font in ('fa-brands-400', 'fa-regular-400', 'fa-solid-900')
+    for ext in ('eot', 'svg', 'ttf', 'woff', 'woff2')
+})
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+
+# Worth precompressing; images and woff fonts are compressed already.
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.ttf', '.eot'}
+
+# Encodings served from precompressed files, most preferred first.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+_manifest = None
+_vendored = {}
+
+
+##############################################################################
+# Build
+
+
+def vendor(static_folder, force=False, log=print):
+    """Download the VENDOR files missing from `static_folder`."""
+
+    for path, url in sorted(VENDOR.items()):
+        target = os.path.join(static_folder, path)
+        if os.path.exists(target) and not force:
+            continue
+
+        log(f"Fetching {url}")
+        with urlopen(url, timeout=30) as response:
+            _write(target, response.read())
+
+
+def build(static_folder, log=print):
+    """Fingerprint and precompress every static file into static/dist.
+
+    Returns the manifest: {path: hashed path}, both relative to
+    static/ and static/dist/ respectively.
+    """
+
+    if brotli is None:
+        raise RuntimeError("Building assets needs the brotli package: "
+                           "pip install -r requirements.txt")
+
+    dist = os.path.join(static_folder, DIST)
+    sources = []
+    for directory, subdirectories, files in os.walk(static_folder):
+        if directory == static_folder and DIST in subdirectories:
+            subdirectories.remove(DIST)
+        for name in files:
+            path = os.path.relpath(os.path.join(directory, name), static_folder)
+            sources.append(path.replace(os.sep, '/'))
+
+    # Stylesheets last, so they can refer to the hashed names of the rest.
+    manifest = {}
+    for path in sorted(sources, key=lambda p: (p.endswith('.css'), p)):
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = _rewrite_css(data, path, manifest)
+
+        root, ext = os.path.splitext(path)
+        hashed = f'{root}.{hashlib.md5(data).hexdigest()[:12]}{ext}'
+        manifest[path] = hashed
+
+        target = os.path.join(dist, hashed)
+        if not os.path.exists(target):
+            _write(target, data)
+            if ext.lower() in COMPRESSIBLE:
+                _write_compressed(target, data)
+
+    _write(os.path.join(dist, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode())
+    log(f"Built {len(manifest)} asset(s) into {dist}")
+    return manifest
+
+
+def _rewrite_css(data, path, manifest):
+    """Point url(...) references in a stylesheet at hashed files."""
+
+    def hashed(match):
+        quote, ref = match.groups()
+        target, cut, suffix = ref.partition('?') if '?' in ref else ref.partition('#')
+        if target.startswith('/static/'):
+            target = target[len('/static/'):]
+        elif target.startswith(('/', 'data:')) or '://' in target:
+            return match.group(0)
+        else:
+            target = os.path.normpath(
+                os.path.join(os.path.dirname(path), target)).replace(os.sep, '/')
+
+        if target not in manifest:
+            return match.group(0)
+        url = f'/static/{DIST}/{manifest[target]}{cut}{suffix}'
+        return f'url({quote}{url}{quote})'
+
+    return _CSS_URL.sub(hashed, data.decode('utf-8')).encode('utf-8')
+
+
+def _write_compressed(target, data):
+    variants = (('.gz', gzip.compress(data, 9)), ('.br', brotli.compress(data)))
+    for suffix, compressed in variants:
+        if len(compressed) < len(data):
+            _write(target + suffix, compressed)
+
+
+def _write(target, data):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f'{target}.tmp'
+    with open(partial, 'wb') as f:
+        f.write(data)
+    os.replace(partial, target)
+
+
+##############################################################################
+# Runtime
+
+
+def manifest():
+    """The build's {path: hashed path} mapping, or {} if not built."""
+
+    global _manifest
+
+    if _manifest is None or current_app.debug:
+        path = os.path.join(current_app.static_folder, DIST, MANIFEST)
+        try:
+            with open(path) as f:
+                _manifest = json.load(f)
+        except FileNotFoundError:
+            _manifest = {}
+    return _manifest
+
+
+def static_url(path):
+    """URL for a static file, e.g. 'stylesheets/style.css'.
+
+    Also takes '/static/...' URLs (such as the default profile images);
+    anything else, like an external image URL, is returned unchanged.
+    """
+
+    if not path:
+        return path
+    if path.startswith('/static/'):
+        path = path[len('/static/'):]
+    elif path.startswith('/') or '://' in path:
+        return path
+
+    hashed = manifest().get(path)
+    if hashed:
+        return url_for('static', filename=f'{DIST}/{hashed}')
+
+    if path in VENDOR and not _is_vendored(path):
+        return VENDOR[path]
+    return url_for('static', filename=path)
+
+
+def _is_vendored(path):
+    if path not in _vendored or current_app.debug:
+        _vendored[path] = os.path.exists(os.path.join(current_app.static_folder, path))
+    return _vendored[path]
+
+
+def _serve_precompressed():
+    if request.endpoint != 'static':
+        return None
+
+    filename = request.view_args['filename']
+    if not filename.startswith(f'{DIST}/'):
+        return None
+
+    for encoding, suffix in ENCODINGS:
+        if encoding not in request.accept_encodings:
+            continue
+        path = safe_join(current_app.static_folder, filename + suffix)
+        if os.path.isfile(path):
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_file(path, mimetype=mimetype, conditional=True)
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+def init_app(app):
+    app.add_template_global(static_url)
+    app.before_request(_serve_precompressed)
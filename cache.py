@@ -0,0 +1,95 @@
+"""Small in-process caches for Warbler.
+
+Each gunicorn worker keeps its own copy, so anything cached here must be
+safe to serve slightly stale: entries expire after `ttl` seconds and
+writers in the same worker invalidate them directly.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+import time
+
+# Every cache created, by name, so hit/miss counts can be reported.
+registry = {}
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe least-recently-used cache with optional expiry."""
+
+    def __init__(self, name, maxsize=1024, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        registry[name] = self
+
+    def __repr__(self):
+        return f"<LRUCache {self.name}: {len(self._data)}/{self.maxsize}>"
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if absent/expired."""
+
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key`, evicting the oldest entry if full.
+
+        `ttl` overrides the cache's own expiry for this entry.
+        """
+
+        ttl = ttl or self.ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for `key`, calling `loader()` on a miss."""
+
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value)
+        return value
+
+    def peek(self, key, default=None):
+        """Like `get`, but without touching recency or hit counters."""
+
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            return default
+        return value
+
+    def pop(self, key):
+        """Invalidate `key`."""
+
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
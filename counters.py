@@ -0,0 +1,188 @@
+"""Denormalized per-user counters.
+
+`users.messages_count`, `following_count`, `followers_count` and
+`likes_count` let profile and home pages show their stat pills without
+loading whole relationship collections.
+
+Counters are changed with `col = col + n` UPDATEs in the same transaction
+as the write they describe:
+
+- adding or deleting Message, Follows or Likes *objects* through the
+  session is counted by the mapper events below;
+- writes that bypass the mapper (relationship collections such as
+  `user.following.append(...)`, which go straight to the secondary table,
+  or Core INSERT/DELETE statements) must call `bump` themselves;
+- rows removed by ON DELETE CASCADE are accounted for by
+  `before_message_delete` and `before_user_delete`.
+
+`messages.likes_count` is kept by likes.py instead, through a write-behind
+buffer. `reconcile` recomputes everything from scratch and repairs any
+drift in either.
+"""
+
+from sqlalchemy import event, func, or_, select
+
+from models import db, Follows, Likes, Message, User
+
+users = User.__table__
+follows = Follows.__table__
+likes = Likes.__table__
+messages = Message.__table__
+
+
+def _increments(**deltas):
+    return {name: getattr(users.c, name) + delta for name, delta in deltas.items()}
+
+
+def bump(user_id, connection=None, **deltas):
+    """Add `deltas` (e.g. likes_count=-1) to one user's counters."""
+
+    stmt = users.update().where(users.c.id == user_id).values(**_increments(**deltas))
+    (connection or db.session).execute(stmt)
+
+
+def bump_many(user_ids, connection=None, **deltas):
+    """Add `deltas` to the counters of every user in `user_ids` (a list or subquery)."""
+
+    stmt = users.update().where(users.c.id.in_(user_ids)).values(**_increments(**deltas))
+    (connection or db.session).execute(stmt)
+
+
+def before_message_delete(msg):
+    """Uncount the likes that will cascade away with `msg`."""
+
+    likers = select([likes.c.user_id]).where(likes.c.message_id == msg.id)
+    bump_many(likers, likes_count=-1)
+
+
+def before_user_delete(user):
+    """Uncount the follows and likes that will cascade away with `user`."""
+
+    liked = select([likes.c.message_id]).where(likes.c.user_id == user.id)
+    db.session.execute(messages.update()
+                       .where(messages.c.id.in_(liked))
+                       .values(likes_count=messages.c.likes_count - 1))
+
+    followed = select([follows.c.user_being_followed_id]).where(
+        follows.c.user_following_id == user.id)
+    followers = select([follows.c.user_following_id]).where(
+        follows.c.user_being_followed_id == user.id)
+    likers = (select([likes.c.user_id])
+              .select_from(likes.join(messages, messages.c.id == likes.c.message_id))
+              .where(messages.c.user_id == user.id))
+
+    bump_many(followed, followers_count=-1)
+    bump_many(followers, following_count=-1)
+
+    # One UPDATE per liker would be needed to subtract more than one like per
+    # user, so recount just the users affected instead.
+    db.session.execute(users.update()
+                       .where(users.c.id.in_(likers))
+                       .values(likes_count=_count_likes_of(users.c.id, user.id)))
+
+
+def _count_likes_of(liker_id, excluding_author_id):
+    return (select([func.count()])
+            .select_from(likes.join(messages, messages.c.id == likes.c.message_id))
+            .where(likes.c.user_id == liker_id)
+            .where(messages.c.user_id != excluding_author_id)
+            .as_scalar())
+
+
+def recount_follows(user_ids):
+    """Recompute following/followers counts for just `user_ids`.
+
+    For bulk writes, where working out each user's delta would take as
+    many queries as counting.
+    """
+
+    db.session.execute(users.update().where(users.c.id.in_(user_ids)).values(
+        following_count=(select([func.count()])
+                         .where(follows.c.user_following_id == users.c.id)
+                         .as_scalar()),
+        followers_count=(select([func.count()])
+                         .where(follows.c.user_being_followed_id == users.c.id)
+                         .as_scalar())))
+
+
+def reconcile(connection=None):
+    """Recompute every user's and message's counters from the underlying tables.
+
+    Runs inside the caller's transaction and returns the number of rows
+    whose counters had drifted.
+    """
+
+    return reconcile_users(connection) + reconcile_messages(connection)
+
+
+def reconcile_users(connection=None):
+    """Recompute users' counters; returns the number that had drifted."""
+
+    counts = {
+        'messages_count': (select([func.count()])
+                           .where(messages.c.user_id == users.c.id)),
+        'following_count': (select([func.count()])
+                            .where(follows.c.user_following_id == users.c.id)),
+        'followers_count': (select([func.count()])
+                            .where(follows.c.user_being_followed_id == users.c.id)),
+        'likes_count': (select([func.count()])
+                        .where(likes.c.user_id == users.c.id)),
+    }
+    counts = {name: query.as_scalar() for name, query in counts.items()}
+
+    drifted = or_(*[getattr(users.c, name) != query
+                    for name, query in counts.items()])
+
+    stmt = users.update().where(drifted).values(**counts)
+    result = (connection or db.session).execute(stmt)
+    return result.rowcount
+
+
+def reconcile_messages(connection=None):
+    """Recompute messages' like counts; returns the number that had drifted."""
+
+    count = (select([func.count()])
+             .where(likes.c.message_id == messages.c.id)
+             .as_scalar())
+
+    stmt = (messages.update()
+            .where(messages.c.likes_count != count)
+            .values(likes_count=count))
+    result = (connection or db.session).execute(stmt)
+    return result.rowcount
+
+
+##############################################################################
+# Mapper events: count rows added or removed through the ORM unit of work.
+
+
+@event.listens_for(Message, 'after_insert')
+def _message_inserted(mapper, connection, msg):
+    bump(msg.user_id, connection, messages_count=1)
+
+
+@event.listens_for(Message, 'after_delete')
+def _message_deleted(mapper, connection, msg):
+    bump(msg.user_id, connection, messages_count=-1)
+
+
+@event.listens_for(Follows, 'after_insert')
+def _follow_inserted(mapper, connection, follow):
+    bump(follow.user_following_id, connection, following_count=1)
+    bump(follow.user_being_followed_id, connection, followers_count=1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def _follow_deleted(mapper, connection, follow):
+    bump(follow.user_following_id, connection, following_count=-1)
+    bump(follow.user_being_followed_id, connection, followers_count=-1)
+
+
+@event.listens_for(Likes, 'after_insert')
+def _like_inserted(mapper, connection, like):
+    bump(like.user_id, connection, likes_count=1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def _like_deleted(mapper, connection, like):
+    bump(like.user_id, connection, likes_count=-1)
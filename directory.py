@@ -0,0 +1,70 @@
+"""Cached alphabetical user directory for /users without a search.
+
+Pages are keyset-paginated by username. Each page's rows, the rendered
+HTML for anonymous visitors, and the total user count are cached per
+worker. All of it is dropped when a transaction that inserts, updates or
+deletes a User commits (signup, profile edit, account deletion). Changes
+made through other workers show up once the TTL expires.
+"""
+
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from cache import LRUCache
+from models import db, User
+from pagination import keyset
+
+TTL = 300
+
+# The columns a directory card shows; cached instead of ORM objects, which
+# can't outlive their session.
+Card = namedtuple('Card', 'id username image_url header_image_url bio')
+
+pages = LRUCache('directory_pages', maxsize=512, ttl=TTL)
+rendered = LRUCache('directory_html', maxsize=512, ttl=TTL)
+counts = LRUCache('directory_count', maxsize=1, ttl=TTL)
+
+
+def user_count():
+    """Total number of users (cached)."""
+
+    return counts.get_or_load('users', lambda: User.query.count())
+
+
+def page(before=None, after=None, per_page=24):
+    """Return a Page of Cards, alphabetical by username (cached)."""
+
+    def load():
+        query = db.session.query(*[getattr(User, field) for field in Card._fields])
+        result = keyset(query, [User.username], lambda row: (row.username,),
+                        before, after, per_page, descending=False)
+        result.items = [Card(*row) for row in result.items]
+        return result
+
+    return pages.get_or_load((before, after, per_page), load)
+
+
+def invalidate():
+    pages.clear()
+    rendered.clear()
+    counts.clear()
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, user):
+    Session.object_session(user).info['directory_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_on_commit(session):
+    if session.info.pop('directory_changed', False):
+        invalidate()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_on_rollback(session, previous_transaction):
+    session.info.pop('directory_changed', None)
@@ -0,0 +1,120 @@
+"""Following and unfollowing with direct statements.
+
+Single follows are one INSERT or DELETE against the `follows` table
+instead of loading the follower's whole `following` collection; both are
+idempotent. `follow_many` imports a list of accounts at once (e.g. when
+someone moves over from another service): it inserts every follow that
+doesn't already exist with one INSERT ... SELECT.
+
+Each function also keeps counters, home timelines and follow suggestions
+in step. The caller commits, then calls `viewer.forget` and
+`principal.forget`.
+"""
+
+from sqlalchemy import and_, exists, literal, or_, select
+from sqlalchemy.dialects import postgresql
+
+import counters
+import graph
+import recommendations
+import timeline
+from models import db, Follows, User
+
+# Most accounts one bulk request may name.
+MAX_BULK_FOLLOWS = 5000
+
+follows = Follows.__table__
+users = User.__table__
+
+
+def _insert_ignoring_duplicates(**values):
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(follows).values(**values).on_conflict_do_nothing()
+    return follows.insert().values(**values).prefix_with('OR IGNORE')
+
+
+def follow(follower_id, followed_id):
+    """Make `follower_id` follow `followed_id`. Returns True if it was new."""
+
+    result = db.session.execute(_insert_ignoring_duplicates(
+        user_following_id=follower_id, user_being_followed_id=followed_id))
+    if result.rowcount != 1:
+        return False
+
+    counters.bump(follower_id, following_count=1)
+    counters.bump(followed_id, followers_count=1)
+    timeline.reclassify([followed_id], 1)
+    timeline.backfill(follower_id, followed_id)
+    graph.changed(db.session, follower_id, followed_id, True)
+    recommendations.mark_stale(follower_id)
+    return True
+
+
+def unfollow(follower_id, followed_id):
+    """Stop `follower_id` following `followed_id`. Returns True if they were."""
+
+    result = db.session.execute(follows.delete().where(and_(
+        follows.c.user_following_id == follower_id,
+        follows.c.user_being_followed_id == followed_id)))
+    if result.rowcount != 1:
+        return False
+
+    counters.bump(follower_id, following_count=-1)
+    counters.bump(followed_id, followers_count=-1)
+    timeline.reclassify([followed_id], -1)
+    timeline.prune(follower_id, followed_id)
+    graph.changed(db.session, follower_id, followed_id, False)
+    recommendations.mark_stale(follower_id)
+    return True
+
+
+class BulkResult:
+    """What `follow_many` did."""
+
+    def __init__(self, followed, already_following, not_found):
+        self.followed = followed
+        self.already_following = already_following
+        self.not_found = not_found
+
+
+def follow_many(follower_id, user_ids=(), usernames=()):
+    """Follow every named user the follower doesn't already follow.
+
+    Unknown ids/usernames and the follower themself are skipped. Raises
+    ValueError if more than MAX_BULK_FOLLOWS accounts are named.
+    """
+
+    user_ids, usernames = set(user_ids), set(usernames)
+    if len(user_ids) + len(usernames) > MAX_BULK_FOLLOWS:
+        raise ValueError(f"At most {MAX_BULK_FOLLOWS} accounts can be followed at once.")
+
+    named = or_(users.c.id.in_(user_ids), users.c.username.in_(usernames))
+    following = exists().where(and_(
+        follows.c.user_following_id == follower_id,
+        follows.c.user_being_followed_id == users.c.id))
+
+    found = db.session.execute(
+        select([users.c.id, users.c.username, following.label('following')])
+        .where(named)).fetchall()
+
+    targets = [row for row in found if row.id != follower_id]
+    new_ids = sorted(row.id for row in targets if not row.following)
+
+    if new_ids:
+        rows = (select([literal(follower_id), users.c.id])
+                .where(and_(users.c.id.in_(new_ids), ~following)))
+        db.session.execute(follows.insert().from_select(
+            ['user_following_id', 'user_being_followed_id'], rows))
+
+        counters.recount_follows([follower_id] + new_ids)
+        timeline.reclassify(new_ids, 1)
+        timeline.backfill_many(follower_id, new_ids)
+        for followed_id in new_ids:
+            graph.changed(db.session, follower_id, followed_id, True)
+        recommendations.mark_stale(follower_id)
+
+    return BulkResult(
+        followed=new_ids,
+        already_following=len(targets) - len(new_ids),
+        not_found=(sorted(user_ids - {row.id for row in found})
+                   + sorted(usernames - {row.username for row in found})))
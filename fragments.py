@@ -0,0 +1,57 @@
+"""Cached HTML for message list items.
+
+Timelines, profiles and likes pages render the same `<li>` for each
+message: author avatar and name, formatted date, text and like button.
+`message_item` renders templates/messages/item.html once per variant and
+keeps the result in an LRU cache keyed by message id, so a page of cached
+messages is a dictionary lookup per item.
+
+Each entry holds the variants seen for one message (with or without a
+like button, liked or not) and is only used while the author's
+`profile_version` and the message's `likes_count` match what it was
+rendered with. A profile edit bumps the version, so every worker stops
+using fragments showing the old name or avatar at once, and the stale
+entries age out. Deleted messages are dropped with `forget`. The author
+and timestamp are checked too, in case SQLite hands a deleted message's
+id to a new one.
+"""
+
+from flask import current_app
+from markupsafe import Markup
+
+from cache import LRUCache
+
+fragments = LRUCache('message_fragments', 20000)
+
+
+def message_item(msg, author, can_like=False, liked=False):
+    """The rendered list item for `msg`, written by `author`.
+
+    `can_like` shows a like button (pressed if `liked`) instead of just
+    the count.
+    """
+
+    stamp = (author.id, author.profile_version, msg.timestamp, msg.likes_count)
+    variant = (can_like, can_like and liked)
+
+    entry = fragments.get(msg.id)
+    if entry is None or entry[0] != stamp:
+        entry = (stamp, {})
+        fragments.set(msg.id, entry)
+
+    html = entry[1].get(variant)
+    if html is None:
+        template = current_app.jinja_env.get_template('messages/item.html')
+        html = entry[1][variant] = Markup(template.render(
+            msg=msg, author=author, can_like=can_like, liked=liked))
+    return html
+
+
+def forget(message_id):
+    """Drop the cached fragments of a deleted message."""
+
+    fragments.pop(message_id)
+
+
+def init_app(app):
+    app.add_template_global(message_item)
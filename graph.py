@@ -0,0 +1,706 @@
+"""In-memory follow graph for relationship questions.
+
+"Does A follow B?", "Do they follow each other?" and "Which of the people
+I follow also follow them?" are answered from memory instead of loading
+`User.following`/`User.followers`.
+
+The graph is kept twice, once per direction, in compressed sparse row
+(CSR) layout: `ids` is the sorted array of user ids with at least one
+edge, and user `ids[i]`'s neighbours are `targets[offsets[i]:offsets[i+1]]`,
+sorted. Edges take 4 bytes each and there is no per-user object, so even
+millions of follows fit comfortably. Membership is two binary searches:
+one for the row, one within it, O(log d). Neighbour lists are handed out
+as memoryview slices of `targets`, so reading a celebrity's followers
+copies nothing.
+
+The arrays are built by one process and shared by all of them: the
+builder writes them to SNAPSHOT_FILE in app.config['FOLLOW_GRAPH_DIR']
+(or the FOLLOW_GRAPH_DIR environment variable; by default a directory
+under the system temp dir, one per database), and every worker maps
+that file read-only, so the machine holds one copy whatever the number
+of workers. Building reads the `follows` table once per direction in
+bulk, without a Python loop per edge.
+
+CSR arrays are expensive to change, so each committed follow or unfollow
+is appended to a change log in the same directory, and every worker
+replays the log since its snapshot into a small overlay of added and
+removed edges, kept per user. A worker replays its own commits at once
+and other workers' within POLL_SECONDS. The next snapshot is built, in
+the background by whichever worker notices first, when the overlay
+passes MAX_OVERLAY edges or the snapshot is REBUILD_SECONDS old; the
+latter also picks up changes made on other machines, which write their
+own logs.
+
+Until a snapshot exists, `graph()` returns a SqlGraph that answers the
+same questions from the `follows` table.
+"""
+
+from array import array
+from bisect import bisect_left
+from contextlib import contextmanager
+import fcntl
+import hashlib
+from itertools import groupby
+import mmap
+from operator import itemgetter
+import os
+import tempfile
+from threading import Lock, Thread
+import time
+
+from flask import current_app, g, has_app_context, has_request_context
+from sqlalchemy import and_, event, select
+from sqlalchemy.orm import Session, aliased
+
+from models import db, Follows
+
+# How often a worker looks for a new snapshot and other workers' changes.
+POLL_SECONDS = 1
+
+# Snapshot age, and overlay edges, allowed before the arrays are rebuilt.
+REBUILD_SECONDS = 15 * 60
+MAX_OVERLAY = 10000
+
+# Rows fetched at a time while building.
+FETCH_ROWS = 10000
+
+# Files in FOLLOW_GRAPH_DIR besides the change logs, `changes-<n>.log`.
+SNAPSHOT_FILE = 'graph.bin'
+LOCK_FILE = 'graph.lock'
+REBUILD_LOCK_FILE = 'rebuild.lock'
+
+# Snapshot header: magic, change log number, ids per direction, edges.
+MAGIC = 0x57424c4752415031
+HEADER = 5
+
+follows = Follows.__table__
+
+
+class Adjacency:
+    """One direction of the graph: user id -> sorted neighbour ids (CSR).
+
+    The arrays may be `array`s or memoryviews into a mapped snapshot.
+    """
+
+    def __init__(self, ids=None, offsets=None, targets=None):
+        self.ids = array('i') if ids is None else ids
+        self.offsets = array('q', [0]) if offsets is None else offsets
+        # Slices of a memoryview share the array's memory.
+        self.targets = memoryview(array('i') if targets is None else targets)
+
+    @classmethod
+    def build(cls, firsts, targets):
+        """From parallel arrays of edges, sorted by (first, target)."""
+
+        ids = array('i', map(itemgetter(0), groupby(firsts)))
+        offsets = array('q', [0])
+        offsets.extend(bisect_left(firsts, user_id + 1) for user_id in ids)
+        return cls(ids, offsets, targets)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """From (user_id, neighbour_id) pairs sorted by both."""
+
+        pairs = list(pairs)
+        return cls.build(array('i', map(itemgetter(0), pairs)),
+                         array('i', map(itemgetter(1), pairs)))
+
+    def _row(self, user_id):
+        i = bisect_left(self.ids, user_id)
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return self.offsets[i], self.offsets[i + 1]
+        return 0, 0
+
+    def neighbours(self, user_id):
+        """Sorted neighbour ids, as a read-only view into the array."""
+
+        lo, hi = self._row(user_id)
+        return self.targets[lo:hi]
+
+    def has(self, user_id, neighbour_id):
+        lo, hi = self._row(user_id)
+        i = bisect_left(self.targets, neighbour_id, lo, hi)
+        return i < hi and self.targets[i] == neighbour_id
+
+
+def intersect(small, large):
+    """Sorted intersection of two sorted sequences.
+
+    Binary-searches each element of the smaller one in the larger, so a
+    short list against a huge one costs O(s log l), not O(s + l).
+    """
+
+    if len(small) > len(large):
+        small, large = large, small
+
+    result, lo = [], 0
+    for value in small:
+        lo = bisect_left(large, value, lo)
+        if lo == len(large):
+            break
+        if large[lo] == value:
+            result.append(value)
+    return result
+
+
+class FollowGraph:
+    """Both directions of the follow graph, plus an overlay of recent changes.
+
+    The overlay is kept per user and direction, {user_id: {other_id:
+    follows?}}, holding only edges that differ from the arrays. A row's
+    dict is replaced rather than changed, so readers need no lock.
+    """
+
+    def __init__(self):
+        self._following = Adjacency()
+        self._followers = Adjacency()
+        self._out = {}
+        self._in = {}
+        self._size = 0
+        self._lock = Lock()
+
+    def load(self, by_follower, by_followed):
+        """Replace the graph. Each argument is sorted (user_id, neighbour_id) pairs."""
+
+        self.use(Adjacency.from_pairs(by_follower), Adjacency.from_pairs(by_followed))
+
+    def use(self, following, followers):
+        """Replace the arrays and drop the overlay."""
+
+        with self._lock:
+            self._following, self._followers = following, followers
+            self._out, self._in, self._size = {}, {}, 0
+
+    def overlay_size(self):
+        return self._size
+
+    @staticmethod
+    def _change(overlay, user_id, other_id, value):
+        """Set one overlay entry, or drop it if `value` is None. Returns the
+        change in entries."""
+
+        row = dict(overlay.get(user_id, ()))
+        had = other_id in row
+        if value is None:
+            row.pop(other_id, None)
+        else:
+            row[other_id] = value
+        if row:
+            overlay[user_id] = row
+        else:
+            overlay.pop(user_id, None)
+        return (value is not None) - had
+
+    def apply(self, follower_id, followed_id, following):
+        """Record that `follower_id` now follows `followed_id`, or doesn't."""
+
+        with self._lock:
+            base = self._following.has(follower_id, followed_id)
+            value = None if following == base else following
+            self._size += self._change(self._out, follower_id, followed_id, value)
+            self._change(self._in, followed_id, follower_id, value)
+
+    def add(self, follower_id, followed_id):
+        self.apply(follower_id, followed_id, True)
+
+    def remove(self, follower_id, followed_id):
+        self.apply(follower_id, followed_id, False)
+
+    def follows(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        row = self._out.get(follower_id)
+        if row and followed_id in row:
+            return row[followed_id]
+        return self._following.has(follower_id, followed_id)
+
+    @staticmethod
+    def _merged(base, overlay, user_id):
+        values = base.neighbours(user_id)
+        row = overlay.get(user_id)
+        if not row:
+            return values
+        kept = (value for value in values if row.get(value, True))
+        return sorted({*kept, *(other for other, on in row.items() if on)})
+
+    def following(self, user_id):
+        """Sorted ids that `user_id` follows."""
+
+        return self._merged(self._following, self._out, user_id)
+
+    def followers(self, user_id):
+        """Sorted ids that follow `user_id`."""
+
+        return self._merged(self._followers, self._in, user_id)
+
+    def mutual(self, user_id, other_id):
+        """Do the two users follow each other?"""
+
+        return self.follows(user_id, other_id) and self.follows(other_id, user_id)
+
+    def followed_by_following(self, viewer_id, user_id):
+        """Sorted ids that `viewer_id` follows and that follow `user_id`."""
+
+        return intersect(self.following(viewer_id), self.followers(user_id))
+
+
+class SqlGraph:
+    """FollowGraph's questions answered from the `follows` table.
+
+    Stands in while this worker's graph is first loading. Lists of whom a
+    user follows are kept for the request, so a page of user cards costs
+    one query for the viewer's follows rather than one per card.
+    """
+
+    def __init__(self):
+        self._following = {}
+
+    def following(self, user_id):
+        """Sorted ids that `user_id` follows."""
+
+        if user_id not in self._following:
+            self._following[user_id] = [
+                followed_id for (followed_id,) in db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id)
+                .order_by(Follows.user_being_followed_id)]
+        return self._following[user_id]
+
+    def followers(self, user_id):
+        """Sorted ids that follow `user_id`."""
+
+        return [follower_id for (follower_id,) in db.session
+                .query(Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == user_id)
+                .order_by(Follows.user_following_id)]
+
+    def follows(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        ids = self.following(follower_id)
+        i = bisect_left(ids, followed_id)
+        return i < len(ids) and ids[i] == followed_id
+
+    def mutual(self, user_id, other_id):
+        """Do the two users follow each other?"""
+
+        return self.follows(user_id, other_id) and self.follows(other_id, user_id)
+
+    def followed_by_following(self, viewer_id, user_id):
+        """Sorted ids that `viewer_id` follows and that follow `user_id`."""
+
+        viewers = aliased(Follows)
+        return [follower_id for (follower_id,) in db.session
+                .query(Follows.user_following_id)
+                .join(viewers, and_(
+                    viewers.user_being_followed_id == Follows.user_following_id,
+                    viewers.user_following_id == viewer_id))
+                .filter(Follows.user_being_followed_id == user_id)
+                .order_by(Follows.user_following_id)]
+
+
+index = FollowGraph()
+
+# (inode, mtime) of the snapshot `index` was built from, and its mtime.
+_snapshot = None
+_built_at = None
+
+# (change log number, offset) replayed up to.
+_replayed = None
+
+# The change log this process last appended to.
+_appending = None
+
+_checked_at = 0.0
+_syncing = Lock()
+_rebuilding = Lock()
+_directories = set()
+
+
+def _directory():
+    directory = None
+    if has_app_context():
+        directory = current_app.config.get('FOLLOW_GRAPH_DIR')
+    directory = directory or os.environ.get('FOLLOW_GRAPH_DIR')
+    if not directory:
+        database = hashlib.sha1(str(db.engine.url).encode('utf-8')).hexdigest()
+        directory = os.path.join(tempfile.gettempdir(), f'warbler-graph-{database[:12]}')
+
+    if directory not in _directories:
+        os.makedirs(directory, exist_ok=True)
+        _directories.add(directory)
+    return directory
+
+
+@contextmanager
+def _locked(directory, operation):
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _log_path(directory, number):
+    return os.path.join(directory, f'changes-{number}.log')
+
+
+def _logs(directory):
+    numbers = []
+    for filename in os.listdir(directory):
+        stem, ext = os.path.splitext(filename)
+        prefix, _, number = stem.partition('-')
+        if ext == '.log' and prefix == 'changes' and number.isdigit():
+            numbers.append(int(number))
+    return sorted(numbers)
+
+
+def _newest_log(directory, number=None):
+    """The change log being appended to. Call holding LOCK_FILE."""
+
+    if number is None or not os.path.exists(_log_path(directory, number)):
+        number = max(_logs(directory), default=0)
+    while os.path.exists(_log_path(directory, number + 1)):
+        number += 1
+    return number
+
+
+##############################################################################
+# Snapshots
+
+
+def _read_adjacency(connection, first, second):
+    firsts, targets = array('i'), array('i')
+    result = connection.execute(select([first, second]).order_by(first, second))
+    while True:
+        rows = result.fetchmany(FETCH_ROWS)
+        if not rows:
+            return Adjacency.build(firsts, targets)
+        firsts.extend(map(itemgetter(0), rows))
+        targets.extend(map(itemgetter(1), rows))
+
+
+def _read_edges():
+    """Both directions from the `follows` table, read in one transaction."""
+
+    with db.engine.connect() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection = connection.execution_options(
+                isolation_level='REPEATABLE READ', stream_results=True)
+        with connection.begin():
+            following = _read_adjacency(connection, follows.c.user_following_id,
+                                        follows.c.user_being_followed_id)
+            followers = _read_adjacency(connection, follows.c.user_being_followed_id,
+                                        follows.c.user_following_id)
+    return following, followers
+
+
+def _write_snapshot(path, log_number, following, followers):
+    header = array('q', [MAGIC, log_number, len(following.ids),
+                         len(followers.ids), len(following.targets)])
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        # The 8-byte arrays first, so every array is aligned.
+        for part in (header, following.offsets, followers.offsets,
+                     following.ids, followers.ids,
+                     following.targets, followers.targets):
+            f.write(part)
+    os.replace(temp, path)
+
+
+def _snapshot_log(path):
+    """The change log number a snapshot replays from, or None."""
+
+    try:
+        with open(path, 'rb') as f:
+            header = array('q', f.read(HEADER * 8))
+    except (FileNotFoundError, ValueError):
+        return None
+    return header[1] if len(header) == HEADER and header[0] == MAGIC else None
+
+
+def _map_snapshot(path):
+    """(stat, log number, following, followers) of the snapshot at `path`."""
+
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    header = data[:HEADER * 8].cast('q')
+    if header[0] != MAGIC:
+        raise ValueError(f"{path} is not a follow graph snapshot")
+    _, log_number, following_ids, followers_ids, edges = header
+
+    position = HEADER * 8
+
+    def take(count, kind):
+        nonlocal position
+        size = count * (8 if kind == 'q' else 4)
+        part = data[position:position + size].cast(kind)
+        position += size
+        return part
+
+    offsets = take(following_ids + 1, 'q'), take(followers_ids + 1, 'q')
+    ids = take(following_ids, 'i'), take(followers_ids, 'i')
+    targets = take(edges, 'i'), take(edges, 'i')
+    following, followers = (Adjacency(*arrays) for arrays in zip(ids, offsets, targets))
+    return stat, log_number, following, followers
+
+
+def _rebuild(directory):
+    """Build a snapshot from the `follows` table and start a new change log.
+
+    Call holding REBUILD_LOCK_FILE. Changes committed before the new log
+    starts are in the table; later ones are replayed from the new log.
+    """
+
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    previous = _snapshot_log(path)
+
+    with _locked(directory, fcntl.LOCK_EX):
+        log_number = _newest_log(directory) + 1
+        open(_log_path(directory, log_number), 'a').close()
+
+    following, followers = _read_edges()
+    _write_snapshot(path, log_number, following, followers)
+
+    # Workers still on the previous snapshot replay from its log on.
+    if previous is not None:
+        with _locked(directory, fcntl.LOCK_EX):
+            for number in _logs(directory):
+                if number < previous:
+                    os.remove(_log_path(directory, number))
+
+
+def _rebuild_in_background(app, directory, lock):
+    try:
+        with app.app_context():
+            _rebuild(directory)
+            with _syncing:
+                _sync(directory)
+    finally:
+        lock.close()
+        _rebuilding.release()
+
+
+def _start_rebuild(directory):
+    """Rebuild on a background thread, unless a process is already at it."""
+
+    if not _rebuilding.acquire(False):
+        return
+    lock = open(os.path.join(directory, REBUILD_LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        _rebuilding.release()
+        return
+
+    app = current_app._get_current_object()
+    Thread(target=_rebuild_in_background, args=(app, directory, lock), daemon=True).start()
+
+
+##############################################################################
+# Following the snapshot and change log. Call holding _syncing.
+
+
+def _adopt(directory):
+    """Use the newest snapshot, if `index` isn't already. False if there is none."""
+
+    global _snapshot, _built_at, _replayed
+
+    path = os.path.join(directory, SNAPSHOT_FILE)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    if (stat.st_ino, stat.st_mtime_ns) == _snapshot:
+        return True
+
+    try:
+        stat, log_number, following, followers = _map_snapshot(path)
+    except FileNotFoundError:
+        return _snapshot is not None
+    index.use(following, followers)
+    _snapshot, _built_at = (stat.st_ino, stat.st_mtime_ns), stat.st_mtime
+    _replayed = (log_number, 0)
+    return True
+
+
+def _replay(directory):
+    """Apply the change log since `_replayed`. False if it has been deleted."""
+
+    global _replayed
+
+    number, offset = _replayed
+    with _locked(directory, fcntl.LOCK_SH):
+        while True:
+            try:
+                with open(_log_path(directory, number), 'rb') as f:
+                    f.seek(offset)
+                    data = f.read()
+            except FileNotFoundError:
+                return False
+
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                follower_id, followed_id, following = line.split()
+                index.apply(int(follower_id), int(followed_id), following == b'1')
+            offset += end
+
+            # No new log can start while we hold the lock, so once the next
+            # one exists, this one is complete.
+            if not os.path.exists(_log_path(directory, number + 1)):
+                break
+            number, offset = number + 1, 0
+
+    _replayed = (number, offset)
+    return True
+
+
+def _sync(directory):
+    """Bring `index` up to date. False if there is no snapshot yet."""
+
+    global _snapshot
+
+    if not _adopt(directory):
+        return False
+    if not _replay(directory):
+        # Outrun by two rebuilds; the newest snapshot replays from a later log.
+        _snapshot = None
+        return _adopt(directory) and _replay(directory)
+    return True
+
+
+def graph():
+    """The follow graph, or a SqlGraph until the first snapshot is built."""
+
+    global _checked_at
+
+    now = time.monotonic()
+    if now - _checked_at >= POLL_SECONDS and _syncing.acquire(False):
+        try:
+            _checked_at = now
+            directory = _directory()
+            if not _sync(directory):
+                _start_rebuild(directory)
+            elif (index.overlay_size() > MAX_OVERLAY
+                  or time.time() - _built_at > REBUILD_SECONDS):
+                _start_rebuild(directory)
+        finally:
+            _syncing.release()
+
+    if _snapshot is None:
+        return _sql_graph()
+    return index
+
+
+def _sql_graph():
+    if not has_request_context():
+        return SqlGraph()
+    if 'sql_graph' not in g:
+        g.sql_graph = SqlGraph()
+    return g.sql_graph
+
+
+def load():
+    """Bring the graph up to date now, in this thread, and return it.
+
+    Builds the first snapshot if there is none. For commands and tests.
+    """
+
+    directory = _directory()
+    with _syncing:
+        if _sync(directory):
+            return index
+    return rebuild()
+
+
+def rebuild():
+    """Build a new snapshot now, in this thread, and return the graph."""
+
+    directory = _directory()
+    with _rebuilding:
+        with open(os.path.join(directory, REBUILD_LOCK_FILE), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            _rebuild(directory)
+    with _syncing:
+        _sync(directory)
+    return index
+
+
+def reset():
+    """Delete the snapshot and change logs and empty the graph.
+
+    Waits for a rebuild already running. For tests.
+    """
+
+    global _snapshot, _built_at, _replayed, _appending, _checked_at
+
+    directory = _directory()
+    with _rebuilding, _syncing:
+        with _locked(directory, fcntl.LOCK_EX):
+            for filename in os.listdir(directory):
+                if filename == SNAPSHOT_FILE or filename.endswith('.log'):
+                    os.remove(os.path.join(directory, filename))
+        index.use(Adjacency(), Adjacency())
+        _snapshot = _built_at = _replayed = _appending = None
+        _checked_at = 0.0
+
+
+##############################################################################
+# Keep the graph current: queue follow changes during the transaction and
+# log them once it commits. Core writes (follows.py) queue theirs with
+# `changed`.
+
+
+def changed(session, follower_id, followed_id, following):
+    """Record that a follow was added (`following`=True) or removed."""
+
+    if has_request_context():
+        g.pop('sql_graph', None)
+    session.info.setdefault('follow_graph', []).append(
+        (follower_id, followed_id, following))
+
+
+def _append(directory, changes):
+    global _appending
+
+    lines = ''.join(f'{follower_id} {followed_id} {int(following)}\n'
+                    for follower_id, followed_id, following in changes)
+    with _locked(directory, fcntl.LOCK_SH):
+        _appending = _newest_log(directory, _appending)
+        with open(_log_path(directory, _appending), 'a') as f:
+            f.write(lines)
+
+
+@event.listens_for(Follows, 'after_insert')
+def _follow_inserted(mapper, connection, follow):
+    changed(Session.object_session(follow),
+            follow.user_following_id, follow.user_being_followed_id, True)
+
+
+@event.listens_for(Follows, 'after_delete')
+def _follow_deleted(mapper, connection, follow):
+    changed(Session.object_session(follow),
+            follow.user_following_id, follow.user_being_followed_id, False)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('follow_graph', None)
+    if not changes:
+        return
+
+    directory = _directory()
+    _append(directory, changes)
+    # Replay at once, so this worker sees its own changes.
+    with _syncing:
+        if _snapshot is not None:
+            _sync(directory)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('follow_graph', None)
@@ -0,0 +1,131 @@
+"""HTTP caching policy: conditional GETs for pages, long-lived static files.
+
+Pages whose content changes rarely declare a validator with
+@conditional: a function of the view's arguments that returns a few
+cheap values (version stamps, counters, the newest ids) which change
+whenever the rendered page would. Their hash, together with the logged-in
+user's principal (which covers their own counters and profile) and the
+current release, is sent as a weak ETag. A request whose If-None-Match
+matches gets an empty 304 without the view running or the template being
+rendered. Those responses are marked `private, no-cache`, so browsers
+keep them but revalidate on every visit.
+
+Static files linked with `url_for('static', ...)` carry a `v=` hash of
+their contents and are cached for a year as immutable; editing a file
+changes its URL. So are the content-hashed files built by assets.py.
+Static requests without `v` revalidate with Flask's own
+Last-Modified/ETag. Every other response is `no-store`.
+"""
+
+from functools import wraps
+import hashlib
+import os
+
+from flask import current_app, g, request, session
+
+# Cache-Control values.
+REVALIDATE = 'private, no-cache'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC = 'public, no-cache'
+NO_STORE = 'no-store'
+
+_release = None
+_static_hashes = {}
+
+
+def conditional(validator):
+    """Answer GET requests from the browser's copy while `validator(**view_args)`
+    is unchanged. A validator returning None (e.g. for a missing row) lets
+    the view run as usual.
+
+    Apply it below @app.route and @query_budget.
+    """
+
+    def decorate(view):
+        @wraps(view)
+        def conditional_view(**kwargs):
+            # Pending flashed messages are shown once, so never skip them.
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(**kwargs)
+
+            parts = validator(**kwargs)
+            if parts is None:
+                return view(**kwargs)
+
+            g.cache_validated = True
+            etag = _etag(parts)
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(view(**kwargs))
+            response.set_etag(etag, weak=True)
+            return response
+
+        return conditional_view
+
+    return decorate
+
+
+def _etag(parts):
+    viewer = tuple(g.user) if g.get('user') else None
+    key = repr((release(), request.endpoint, viewer, parts))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def release():
+    """Stamp for the deployed code and templates: their newest mtime."""
+
+    global _release
+
+    if _release is None or current_app.debug:
+        root = current_app.root_path
+        paths = [os.path.join(root, name) for name in os.listdir(root)
+                 if name.endswith('.py')]
+        for directory, _, files in os.walk(os.path.join(root, 'templates')):
+            paths.extend(os.path.join(directory, name) for name in files)
+        _release = int(max(os.path.getmtime(path) for path in paths))
+    return _release
+
+
+def static_hash(filename):
+    """Short content hash of a file under the static folder, or None."""
+
+    digest = _static_hashes.get(filename)
+    if digest is None or current_app.debug:
+        path = os.path.join(current_app.static_folder, filename)
+        try:
+            with open(path, 'rb') as f:
+                digest = hashlib.md5(f.read()).hexdigest()[:12]
+        except OSError:
+            return None
+        _static_hashes[filename] = digest
+    return digest
+
+
+def _add_static_version(endpoint, values):
+    filename = values.get('filename', '')
+    if endpoint == 'static' and 'v' not in values and not filename.startswith('dist/'):
+        digest = static_hash(filename)
+        if digest:
+            values['v'] = digest
+
+
+def _apply_policy(response):
+    if request.endpoint == 'static':
+        filename = request.view_args['filename']
+        fingerprinted = (filename.startswith('dist/')
+                         or request.args.get('v') == static_hash(filename))
+        response.headers['Cache-Control'] = IMMUTABLE if fingerprinted else STATIC
+        return response
+
+    if g.get('cache_validated'):
+        response.headers['Cache-Control'] = REVALIDATE
+        response.vary.add('Cookie')
+    else:
+        response.headers['Cache-Control'] = NO_STORE
+    return response
+
+
+def init_app(app):
+    app.url_defaults(_add_static_version)
+    app.after_request(_apply_policy)
@@ -0,0 +1,178 @@
+"""Per-request SQL accounting.
+
+Counts the statements each request sends to the database so that views
+can declare a query budget with `@query_budget(n)`. A view that goes over
+budget usually has an N+1 problem: a lazy relationship touched once per
+row of a list.
+
+What happens on overrun is set by app.config['QUERY_BUDGET_MODE']:
+
+- 'raise': fail the request with QueryBudgetExceeded (for tests);
+- 'warn':  log a warning (for development);
+- None:    don't check (for production).
+
+A sample of requests (app.config['SQL_TIMING_SAMPLE_RATE']) is also
+timed: the response gets a `Server-Timing` header with the statement
+count, total database time and slowest statement, and any statement
+slower than app.config['SLOW_QUERY_MS'] is written to the
+`warbler.slow_queries` log as one JSON object per line, with the route,
+request id and the line of our code that issued it.
+
+Every request gets an id, taken from an incoming X-Request-ID header or
+generated, and echoed back in the response.
+"""
+
+import json
+import logging
+import os
+import random
+import time
+import traceback
+import uuid
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+slow_log = logging.getLogger('warbler.slow_queries')
+
+# Longest statement text written to the slow-query log.
+STATEMENT_CHARS = 1000
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A view issued more SQL statements than its declared budget."""
+
+
+def query_budget(limit):
+    """Declare the most SQL statements a view may issue per request.
+
+    Apply it below @app.route so the registered view carries the budget.
+    """
+
+    def declare(view):
+        view.query_budget = limit
+        return view
+
+    return declare
+
+
+def queries_issued():
+    """Number of SQL statements issued so far by the current request."""
+
+    return g.get('sql_queries', 0)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+
+    g.sql_queries = g.get('sql_queries', 0) + 1
+    if g.get('sql_timed'):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context() or not g.get('sql_timed'):
+        return
+
+    started = conn.info.get('query_started')
+    if not started:
+        return
+
+    elapsed = time.perf_counter() - started.pop()
+    g.sql_time += elapsed
+    if elapsed > g.sql_slowest[0]:
+        g.sql_slowest = (elapsed, statement)
+
+    if elapsed * 1000 >= current_app.config['SLOW_QUERY_MS']:
+        slow_log.warning(json.dumps({
+            'event': 'slow_query',
+            'request_id': g.request_id,
+            'endpoint': request.endpoint,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'method': request.method,
+            'duration_ms': round(elapsed * 1000, 2),
+            'statement': statement[:STATEMENT_CHARS],
+            'call_site': _call_site(),
+        }))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _query_failed(context):
+    started = context.connection.info.get('query_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+def _call_site():
+    """The innermost frame of our own code in the current stack."""
+
+    root = current_app.root_path
+    for frame in reversed(traceback.extract_stack()):
+        filename = frame.filename
+        if (filename.startswith(root) and 'site-packages' not in filename
+                and filename != __file__):
+            return f"{os.path.relpath(filename, root)}:{frame.lineno} in {frame.name}"
+    return None
+
+
+def init_app(app):
+    app.config.setdefault('QUERY_BUDGET_MODE', 'warn' if app.debug else None)
+    app.config.setdefault('SQL_TIMING_SAMPLE_RATE',
+                          float(os.environ.get('SQL_TIMING_SAMPLE_RATE', 0.1)))
+    app.config.setdefault('SLOW_QUERY_MS',
+                          float(os.environ.get('SLOW_QUERY_MS', 100)))
+
+    app.before_request(_start_request)
+    app.after_request(_check_budget)
+    app.after_request(_add_timing_headers)
+
+
+def _start_request():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_timed = random.random() < current_app.config['SQL_TIMING_SAMPLE_RATE']
+    g.sql_time = 0.0
+    g.sql_slowest = (0.0, None)
+
+
+def _check_budget(response):
+    mode = current_app.config['QUERY_BUDGET_MODE']
+    view = current_app.view_functions.get(request.endpoint)
+    limit = getattr(view, 'query_budget', None)
+
+    if not mode or limit is None:
+        return response
+
+    issued = queries_issued()
+    if issued > limit:
+        message = (f"{request.endpoint} issued {issued} SQL statements "
+                   f"(budget {limit}) for {request.method} {request.full_path}")
+        if mode == 'raise':
+            raise QueryBudgetExceeded(message)
+        log.warning(message)
+
+    return response
+
+
+def _add_timing_headers(response):
+    if 'request_id' not in g:
+        return response
+
+    response.headers['X-Request-ID'] = g.request_id
+
+    if g.sql_timed:
+        total = (time.perf_counter() - g.request_started) * 1000
+        slowest = g.sql_slowest[0] * 1000
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={g.sql_time * 1000:.2f};desc="{g.sql_queries} queries"',
+            f'db-slowest;dur={slowest:.2f}',
+            f'total;dur={total:.2f}',
+        ])
+
+    return response
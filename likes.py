@@ -0,0 +1,161 @@
+"""Liking and unliking messages with single statements.
+
+Each operation is one INSERT or DELETE against the `likes` table instead
+of loading and rewriting the user's whole `likes` collection. Both are
+idempotent: liking twice or unliking something not liked changes
+nothing. The liker's `likes_count` is bumped only when a row was really
+added or removed (see counters.py).
+
+Each message's `likes_count` is written behind: a like adds +1 to a
+per-worker buffer when its transaction commits, and a background thread
+applies the buffered totals every FLUSH_SECONDS in one batch. A popular
+message then gets one UPDATE every few seconds per worker, instead of
+every liker queueing on a lock for its row. Counts lag by up to
+FLUSH_SECONDS, and deltas still buffered when a worker is killed are
+lost until `flask reconcile-counters` runs.
+"""
+
+import atexit
+from collections import Counter
+import logging
+from threading import Lock, Thread
+import time
+
+from sqlalchemy import and_, bindparam, event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+
+import counters
+from models import db, Likes, Message
+
+log = logging.getLogger(__name__)
+
+FLUSH_SECONDS = 2
+
+likes = Likes.__table__
+messages = Message.__table__
+
+
+def _insert_ignoring_duplicates(**values):
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(likes).values(**values).on_conflict_do_nothing()
+    return likes.insert().values(**values).prefix_with('OR IGNORE')
+
+
+def like(user_id, message_id):
+    """Record that a user likes a message. Returns True if it was new."""
+
+    result = db.session.execute(
+        _insert_ignoring_duplicates(user_id=user_id, message_id=message_id))
+    if result.rowcount == 1:
+        counters.bump(user_id, likes_count=1)
+        _count(db.session, message_id, 1)
+        return True
+    return False
+
+
+def unlike(user_id, message_id):
+    """Remove a user's like of a message. Returns True if there was one."""
+
+    result = db.session.execute(likes.delete().where(and_(
+        likes.c.user_id == user_id,
+        likes.c.message_id == message_id)))
+    if result.rowcount == 1:
+        counters.bump(user_id, likes_count=-1)
+        _count(db.session, message_id, -1)
+        return True
+    return False
+
+
+def toggle(user_id, message_id):
+    """Unlike the message if liked, else like it. Returns whether a like by
+    `user_id` is now recorded."""
+
+    if unlike(user_id, message_id):
+        return False
+    return like(user_id, message_id)
+
+
+##############################################################################
+# Per-message like counts, written behind
+
+
+class LikeCountBuffer:
+    """Committed like-count deltas per message, waiting to be written."""
+
+    def __init__(self):
+        self._deltas = Counter()
+        self._lock = Lock()
+        self._flusher = None
+
+    def add(self, deltas):
+        with self._lock:
+            self._deltas.update(deltas)
+            if self._flusher is None:
+                app = db.get_app()
+                self._flusher = Thread(target=self._run, args=(app,), daemon=True)
+                self._flusher.start()
+                atexit.register(self._flush_in, app)
+
+    def flush(self):
+        """Write every buffered delta in one batch. Needs an app context."""
+
+        with self._lock:
+            deltas, self._deltas = self._deltas, Counter()
+
+        rows = [{'message_id': message_id, 'delta': delta}
+                for message_id, delta in sorted(deltas.items()) if delta]
+        if not rows:
+            return
+
+        stmt = (messages.update()
+                .where(messages.c.id == bindparam('message_id'))
+                .values(likes_count=messages.c.likes_count + bindparam('delta')))
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(stmt, rows)
+        except Exception:
+            with self._lock:
+                self._deltas.update(deltas)
+            raise
+
+    def _flush_in(self, app):
+        with app.app_context():
+            self.flush()
+
+    def _run(self, app):
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            try:
+                self._flush_in(app)
+            except Exception:
+                log.exception("Could not write buffered like counts")
+
+
+like_counts = LikeCountBuffer()
+
+
+def _count(session, message_id, delta):
+    session.info.setdefault('like_deltas', Counter())[message_id] += delta
+
+
+@event.listens_for(Likes, 'after_insert')
+def _like_inserted(mapper, connection, like):
+    _count(Session.object_session(like), like.message_id, 1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def _like_deleted(mapper, connection, like):
+    _count(Session.object_session(like), like.message_id, -1)
+
+
+@event.listens_for(Session, 'after_commit')
+def _buffer_on_commit(session):
+    deltas = session.info.pop('like_deltas', None)
+    if deltas:
+        like_counts.add(deltas)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_on_rollback(session, previous_transaction):
+    session.info.pop('like_deltas', None)
@@ -0,0 +1,452 @@
+"""Process metrics for Warbler, exposed in Prometheus text format.
+
+Three things are recorded:
+
+- request latency, as a histogram per Flask endpoint;
+- how long requests wait to check a connection out of the SQLAlchemy pool,
+  plus how many pooled connections are in use;
+- hits and misses of every cache in `cache.registry`.
+
+Each gunicorn worker keeps its own numbers. If app.config['METRICS_DIR']
+(or the METRICS_DIR environment variable) names a directory, every worker
+writes its numbers there as `<pid>-<start>.json` every few seconds, where
+`<start>` is taken when the process first writes. /metrics then adds up
+the files from all workers, so a scrape gives the whole server no matter
+which worker answers it.
+
+A file is a dead worker's if its pid is gone, or if the pid has since been
+reused and a newer file carries it. A scrape folds dead workers' counters
+and histograms into `dead.json` and deletes their files, so totals never
+go backwards and the directory doesn't grow. Their gauges are dropped.
+
+The /metrics view in app.py serves `exposition()`.
+"""
+
+from bisect import bisect_left
+import atexit
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+from threading import Lock
+import time
+
+from flask import g, request
+
+import cache
+
+# Latency buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How often a worker writes its snapshot to METRICS_DIR, at most.
+FLUSH_SECONDS = 5
+
+# Files in METRICS_DIR besides the worker snapshots.
+DEAD_FILE = 'dead.json'
+LOCK_FILE = 'metrics.lock'
+
+_lock = Lock()
+
+# Every metric created, by name.
+registry = {}
+
+# (pid, snapshot filename) of this process.
+_own = None
+
+
+class Metric:
+    """A named family of samples, one per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.samples = {}
+        registry[name] = self
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that is read when the metrics are collected."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.samples[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """Observations counted into cumulative buckets, with their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            # [count per bucket..., count above the last bucket, sum]
+            sample = self.samples.get(key)
+            if sample is None:
+                sample = self.samples[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            sample[bisect_left(self.buckets, value)] += 1
+            sample[-1] += value
+
+
+request_duration = Histogram(
+    'warbler_request_duration_seconds',
+    'Time spent handling a request, by endpoint.',
+    labels=('endpoint', 'method'))
+
+requests_total = Counter(
+    'warbler_requests_total',
+    'Requests handled, by endpoint and status code.',
+    labels=('endpoint', 'method', 'status'))
+
+pool_wait = Histogram(
+    'warbler_db_pool_wait_seconds',
+    'Time spent waiting to check a connection out of the pool.')
+
+pool_in_use = Gauge(
+    'warbler_db_pool_checked_out',
+    'Pooled database connections currently checked out.')
+
+pool_size = Gauge(
+    'warbler_db_pool_size',
+    'Connections the database pool keeps open.')
+
+cache_hits = Counter(
+    'warbler_cache_hits_total',
+    'Cache lookups that found a live entry.',
+    labels=('cache',))
+
+cache_misses = Counter(
+    'warbler_cache_misses_total',
+    'Cache lookups that found nothing or an expired entry.',
+    labels=('cache',))
+
+cache_entries = Gauge(
+    'warbler_cache_entries',
+    'Entries currently held in a cache.',
+    labels=('cache',))
+
+
+##############################################################################
+# Collection
+
+
+def time_checkouts(pool):
+    """Record how long each checkout from `pool` waits for a connection."""
+
+    if getattr(pool, '_metrics_timed', False):
+        return
+
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            pool_wait.observe(time.perf_counter() - started)
+
+    pool._do_get = timed_do_get
+    pool._metrics_timed = True
+
+
+def _collect(engine):
+    """Copy pool and cache statistics into their metrics."""
+
+    pool = engine.pool
+    if hasattr(pool, 'checkedout'):
+        pool_in_use.set(pool.checkedout())
+    if hasattr(pool, 'size'):
+        pool_size.set(pool.size())
+
+    for name, lru in list(cache.registry.items()):
+        with _lock:
+            cache_hits.samples[(name,)] = lru.hits
+            cache_misses.samples[(name,)] = lru.misses
+            cache_entries.samples[(name,)] = len(lru)
+
+
+def snapshot():
+    """This process's metrics as a JSON-serializable dict."""
+
+    with _lock:
+        return {name: {'samples': [[list(key), value]
+                                   for key, value in metric.samples.items()]}
+                for name, metric in registry.items()}
+
+
+def _merge(total, snap, gauges=True):
+    for name, data in snap.items():
+        metric = registry.get(name)
+        if metric is None or (metric.kind == 'gauge' and not gauges):
+            continue
+        samples = total.setdefault(name, {})
+        for key, value in data['samples']:
+            key = tuple(key)
+            if metric.kind == 'histogram':
+                previous = samples.get(key, [0] * len(value))
+                samples[key] = [a + b for a, b in zip(previous, value)]
+            else:
+                samples[key] = samples.get(key, 0) + value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _own_filename():
+    """This process's snapshot name, fixed at its first use in this pid."""
+
+    global _own
+
+    pid = os.getpid()
+    if _own is None or _own[0] != pid:
+        _own = (pid, f'{pid}-{int(time.time() * 1000000)}.json')
+    return _own[1]
+
+
+@contextmanager
+def _locked(directory):
+    with open(os.path.join(directory, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _worker_snapshots(directory):
+    """{filename: (pid, start)} of the worker snapshots in `directory`."""
+
+    found = {}
+    for filename in os.listdir(directory):
+        stem, ext = os.path.splitext(filename)
+        pid, _, start = stem.partition('-')
+        if ext == '.json' and pid.isdigit() and start.isdigit():
+            found[filename] = (int(pid), int(start))
+    return found
+
+
+def _as_snapshot(totals):
+    return {name: {'samples': [[list(key), value] for key, value in samples.items()]}
+            for name, samples in totals.items()}
+
+
+def _fold(directory, dead, snapshots):
+    """Add the `dead` snapshot files into DEAD_FILE, then delete them.
+
+    DEAD_FILE lists the files last folded into it, so files left behind by
+    a fold that stopped before deleting them aren't counted twice.
+    """
+
+    path = os.path.join(directory, DEAD_FILE)
+    previous = _read(path) or {}
+    already = set(previous.get('folded', ()))
+
+    totals = {}
+    _merge(totals, previous.get('metrics', {}), gauges=False)
+    for filename in dead:
+        if filename not in already and snapshots.get(filename):
+            _merge(totals, snapshots[filename], gauges=False)
+
+    temp = f'{path}.tmp'
+    with open(temp, 'w') as f:
+        json.dump({'folded': sorted(dead), 'metrics': _as_snapshot(totals)}, f)
+    os.replace(temp, path)
+
+    for filename in dead:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+
+
+def aggregate(directory=None):
+    """Sum this process's metrics with every worker snapshot in `directory`."""
+
+    total = {}
+    _merge(total, snapshot())
+    if not directory or not os.path.isdir(directory):
+        return total
+
+    own, pid = _own_filename(), os.getpid()
+    with _locked(directory):
+        files = _worker_snapshots(directory)
+        newest = {}
+        for filename, (other_pid, start) in files.items():
+            newest[other_pid] = max(start, newest.get(other_pid, start))
+
+        snapshots, dead = {}, []
+        for filename, (other_pid, start) in files.items():
+            if filename == own:
+                continue
+            snapshots[filename] = _read(os.path.join(directory, filename))
+            if other_pid == pid or start != newest[other_pid] or not _alive(other_pid):
+                dead.append(filename)
+
+        if dead:
+            _fold(directory, dead, snapshots)
+
+        folded = _read(os.path.join(directory, DEAD_FILE)) or {}
+        _merge(total, folded.get('metrics', {}), gauges=False)
+        for filename, snap in snapshots.items():
+            if filename not in dead and snap:
+                _merge(total, snap)
+
+    return total
+
+
+def write_snapshot(directory):
+    """Atomically write this process's metrics to `<directory>/<pid>-<start>.json`."""
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, _own_filename())
+    temp = f'{path}.tmp'
+    with open(temp, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(temp, path)
+
+
+##############################################################################
+# Exposition
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    """Format aggregated metrics in the Prometheus text exposition format."""
+
+    lines = []
+    for name, metric in registry.items():
+        samples = totals.get(name)
+        if not samples:
+            continue
+
+        lines.append(f'# HELP {name} {metric.description}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+
+        for key, value in sorted(samples.items()):
+            if metric.kind != 'histogram':
+                lines.append(f'{name}{_labels(metric.labels, key)} {_number(value)}')
+                continue
+
+            cumulative = 0
+            for bound, count in zip(metric.buckets, value):
+                cumulative += count
+                labels = _labels(metric.labels, key, [('le', str(bound))])
+                lines.append(f'{name}_bucket{labels} {cumulative}')
+            count = cumulative + value[len(metric.buckets)]
+            labels = _labels(metric.labels, key, [('le', '+Inf')])
+            lines.append(f'{name}_bucket{labels} {count}')
+            lines.append(f'{name}_sum{_labels(metric.labels, key)} {_number(value[-1])}')
+            lines.append(f'{name}_count{_labels(metric.labels, key)} {count}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def exposition(engine, directory=None):
+    """Current metrics for every worker, in Prometheus text format."""
+
+    _collect(engine)
+    if directory:
+        write_snapshot(directory)
+    return render(aggregate(directory))
+
+
+##############################################################################
+# Flask integration
+
+
+def init_app(app, db):
+    app.config.setdefault('METRICS_DIR', os.environ.get('METRICS_DIR'))
+
+    state = {'flushed': 0.0}
+
+    @app.before_first_request
+    def _instrument_pool():
+        time_checkouts(db.engine.pool)
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _remember_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _record_request(exc):
+        started = g.get('metrics_started')
+        if started is None:
+            return
+
+        endpoint = request.endpoint or 'unmatched'
+        request_duration.observe(time.perf_counter() - started,
+                                 endpoint=endpoint, method=request.method)
+        requests_total.inc(endpoint=endpoint, method=request.method,
+                           status=g.get('metrics_status', 500))
+
+        directory = app.config['METRICS_DIR']
+        if directory and time.monotonic() - state['flushed'] > FLUSH_SECONDS:
+            state['flushed'] = time.monotonic()
+            _collect(db.engine)
+            write_snapshot(directory)
+
+    def _flush_at_exit():
+        if app.config['METRICS_DIR']:
+            write_snapshot(app.config['METRICS_DIR'])
+
+    atexit.register(_flush_at_exit)
@@ -0,0 +1,307 @@
+"""Versioned schema migrations for Warbler.
+
+`db.create_all()` only creates missing tables, so a database created
+before a model change never gains new columns or indexes. Each migration
+below brings an existing database forward one step; applied versions are
+recorded in the `schema_migrations` table.
+
+Run pending migrations with:
+
+    flask schema upgrade
+
+Migrations marked `transactional=False` build indexes with
+CREATE INDEX CONCURRENTLY on PostgreSQL, which cannot run inside a
+transaction but does not block writes to the table while it builds, or
+backfill large tables in batches, one transaction each. Every step is
+written to be safely re-run if a deploy is interrupted.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
+import counters
+import timeline
+from models import db, Likes, Recommendation
+
+# Registered migrations, in version order.
+MIGRATIONS = []
+
+
+class Migration:
+    """One numbered schema change."""
+
+    def __init__(self, version, description, upgrade, transactional=True):
+        self.version = version
+        self.description = description
+        self.upgrade = upgrade
+        self.transactional = transactional
+
+    def __repr__(self):
+        return f"<Migration {self.version}: {self.description}>"
+
+
+def migration(version, description, transactional=True):
+    """Register the decorated `upgrade(connection)` function as a migration."""
+
+    def register(upgrade):
+        MIGRATIONS.append(Migration(version, description, upgrade, transactional))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return upgrade
+
+    return register
+
+
+##############################################################################
+# DDL helpers
+
+
+def is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def add_column(connection, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless `table` already has `column`."""
+
+    existing = {col['name'] for col in inspect(connection).get_columns(table)}
+    if column not in existing:
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def in_batches(connection):
+    """`connection` for a non-transactional step that commits its own
+    batches: on PostgreSQL, out of autocommit mode."""
+
+    if is_postgres(connection):
+        return connection.execution_options(isolation_level='READ COMMITTED')
+    return connection
+
+
+def create_index(connection, name, table, columns, using=None, unique=False):
+    """Create an index without blocking writes, if it does not already exist.
+
+    On PostgreSQL this uses CREATE INDEX CONCURRENTLY, so `connection` must
+    be in autocommit mode. A concurrent build that failed part-way leaves an
+    INVALID index behind; it is dropped and rebuilt.
+    """
+
+    kind = 'UNIQUE INDEX' if unique else 'INDEX'
+    if not is_postgres(connection):
+        connection.execute(text(
+            f'CREATE {kind} IF NOT EXISTS {name} ON {table} ({columns})'))
+        return
+
+    valid = connection.execute(text(
+        "SELECT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE c.relname = :name"), name=name).scalar()
+
+    if valid:
+        return
+    if valid is False:
+        connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {name}'))
+
+    method = f' USING {using}' if using else ''
+    connection.execute(text(
+        f'CREATE {kind} CONCURRENTLY IF NOT EXISTS {name} ON {table}{method} ({columns})'))
+
+
+def drop_index(connection, name):
+    """Drop an index if it exists, on PostgreSQL without blocking writes."""
+
+    concurrently = ' CONCURRENTLY' if is_postgres(connection) else ''
+    connection.execute(text(f'DROP INDEX{concurrently} IF EXISTS {name}'))
+
+
+def transaction(connection):
+    """A transaction on a connection of its own, for the steps of a
+    non-transactional migration that must commit together."""
+
+    return connection.engine.begin()
+
+
+##############################################################################
+# Migrations
+
+
+@migration(1, 'timeline entries and user counters', transactional=False)
+def _timelines_and_counters(connection):
+    connection = in_batches(connection)
+
+    with connection.begin():
+        # The table as of this version, not as the model is now.
+        connection.execute(text(
+            'CREATE TABLE IF NOT EXISTS timeline_entries ('
+            ' user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,'
+            ' message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,'
+            ' timestamp TIMESTAMP NOT NULL,'
+            ' PRIMARY KEY (user_id, message_id))'))
+        connection.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_timestamp'
+            ' ON timeline_entries (user_id, timestamp, message_id)'))
+
+        for column in ('messages_count', 'following_count',
+                       'followers_count', 'likes_count'):
+            add_column(connection, 'users', column, "INTEGER NOT NULL DEFAULT 0")
+
+        counters.reconcile_users(connection)
+
+    # A batch of followers per transaction, however many rows there are.
+    timeline.rebuild_all(connection)
+
+
+@migration(2, 'indexes for timelines, follows and likes', transactional=False)
+def _hot_path_indexes(connection):
+    create_index(connection, 'ix_messages_user_timestamp',
+                 'messages', 'user_id, timestamp, id')
+    create_index(connection, 'ix_follows_user_following',
+                 'follows', 'user_following_id, user_being_followed_id')
+    create_index(connection, 'ix_likes_user_message',
+                 'likes', 'user_id, message_id')
+    create_index(connection, 'ix_users_followers_count',
+                 'users', 'followers_count')
+
+
+@migration(3, 'trigram index for user search', transactional=False)
+def _user_search_index(connection):
+    if not is_postgres(connection):
+        return
+
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    create_index(connection, 'ix_users_search_trgm', 'users',
+                 "(lower(username || ' ' || coalesce(bio, '')"
+                 " || ' ' || coalesce(location, ''))) gin_trgm_ops",
+                 using='gin')
+
+
+@migration(4, 'profile version stamps')
+def _profile_versions(connection):
+    add_column(connection, 'users', 'profile_version', "INTEGER NOT NULL DEFAULT 1")
+
+
+@migration(5, 'composite key for likes; per-message like counts',
+           transactional=False)
+def _likes_by_user_and_message(connection):
+    columns = {col['name'] for col in inspect(connection).get_columns('likes')}
+
+    if 'id' in columns and is_postgres(connection):
+        with transaction(connection) as tx:
+            tx.execute(text(
+                'DELETE FROM likes WHERE user_id IS NULL OR message_id IS NULL'))
+            # Validated NOT NULL checks let ADD PRIMARY KEY skip its
+            # full-table scan under an exclusive lock (PostgreSQL 12+).
+            for column in ('user_id', 'message_id'):
+                tx.execute(text(
+                    f'ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_{column}_not_null'))
+                tx.execute(text(
+                    f'ALTER TABLE likes ADD CONSTRAINT likes_{column}_not_null'
+                    f' CHECK ({column} IS NOT NULL) NOT VALID'))
+        for column in ('user_id', 'message_id'):
+            connection.execute(text(
+                f'ALTER TABLE likes VALIDATE CONSTRAINT likes_{column}_not_null'))
+
+        # The slow part, built without blocking writes...
+        create_index(connection, 'likes_user_message_key', 'likes',
+                     'user_id, message_id', unique=True)
+
+        # ...then swapped in as the key, which only touches the catalog.
+        with transaction(connection) as tx:
+            inspector = inspect(tx)
+            for constraint in inspector.get_unique_constraints('likes'):
+                tx.execute(text(
+                    f"ALTER TABLE likes DROP CONSTRAINT {constraint['name']}"))
+            primary_key = inspector.get_pk_constraint('likes')['name']
+            tx.execute(text(f'ALTER TABLE likes DROP CONSTRAINT {primary_key}'))
+            tx.execute(text('ALTER TABLE likes DROP COLUMN id'))
+            tx.execute(text(
+                'ALTER TABLE likes ADD CONSTRAINT likes_pkey'
+                ' PRIMARY KEY USING INDEX likes_user_message_key'))
+            for column in ('user_id', 'message_id'):
+                tx.execute(text(
+                    f'ALTER TABLE likes DROP CONSTRAINT likes_{column}_not_null'))
+
+    elif 'id' in columns:
+        # SQLite cannot change a table's keys; copy it into a new one.
+        with transaction(connection) as tx:
+            tx.execute(text('ALTER TABLE likes RENAME TO likes_old'))
+            Likes.__table__.create(tx)
+            tx.execute(text(
+                'INSERT INTO likes (user_id, message_id) '
+                'SELECT DISTINCT user_id, message_id FROM likes_old '
+                'WHERE user_id IS NOT NULL AND message_id IS NOT NULL'))
+            tx.execute(text('DROP TABLE likes_old'))
+
+    # The primary key now covers (user_id, message_id).
+    drop_index(connection, 'ix_likes_user_message')
+    create_index(connection, 'ix_likes_message_user', 'likes', 'message_id, user_id')
+
+    with transaction(connection) as tx:
+        add_column(tx, 'messages', 'likes_count', "INTEGER NOT NULL DEFAULT 0")
+        counters.reconcile_messages(tx)
+
+
+@migration(6, 'precomputed follow suggestions')
+def _recommendations(connection):
+    # Rows are filled in by `flask recommend`.
+    Recommendation.__table__.create(connection, checkfirst=True)
+
+
+@migration(7, 'when follow suggestions went stale')
+def _recommendations_stale_at(connection):
+    add_column(connection, 'recommendations', 'stale_at', 'TIMESTAMP')
+
+
+##############################################################################
+# Runner
+
+
+def _ensure_version_table(connection):
+    connection.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        ' version INTEGER PRIMARY KEY,'
+        ' description TEXT NOT NULL,'
+        ' applied_at TIMESTAMP NOT NULL)'))
+
+
+def applied_versions(engine):
+    """Return the set of migration versions already applied."""
+
+    with engine.connect() as connection:
+        _ensure_version_table(connection)
+        rows = connection.execute(text('SELECT version FROM schema_migrations'))
+        return {version for (version,) in rows}
+
+
+def pending(engine):
+    """Return the migrations not yet applied, in order."""
+
+    applied = applied_versions(engine)
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def upgrade(engine, log=print):
+    """Apply every pending migration, in order."""
+
+    for step in pending(engine):
+        log(f"Applying {step.version}: {step.description}")
+
+        with engine.connect() as connection:
+            if step.transactional:
+                with connection.begin():
+                    step.upgrade(connection)
+                    _record(connection, step)
+            else:
+                if is_postgres(connection):
+                    connection = connection.execution_options(
+                        isolation_level='AUTOCOMMIT')
+                step.upgrade(connection)
+                with connection.begin():
+                    _record(connection, step)
+
+
+def _record(connection, step):
+    connection.execute(
+        text('INSERT INTO schema_migrations (version, description, applied_at) '
+             'VALUES (:version, :description, :applied_at)'),
+        version=step.version, description=step.description,
+        applied_at=datetime.utcnow())
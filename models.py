@@ -2,10 +2,10 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
 
-bcrypt = Bcrypt()
+import passwords
+
 db = SQLAlchemy()
 
 
@@ -14,6 +14,11 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    __table_args__ = (
+        db.Index('ix_follows_user_following',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -30,22 +35,22 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    __table_args__ = (
+        db.Index('ix_likes_message_user', 'message_id', 'user_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True
     )
 
 
@@ -54,6 +59,10 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    __table_args__ = (
+        db.Index('ix_users_followers_count', 'followers_count'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -94,6 +103,46 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, maintained by counters.py.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the profile is edited, so cached copies of it
+    # (see principal.py) can tell they are stale.
+
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -119,16 +168,18 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user`?
+
+        A primary-key lookup on `follows`; the `followers` collection is
+        never loaded. For many checks against one user, see viewer.py.
+        """
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((self.id, other_user.id)) is not None
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.query.get((other_user.id, self.id)) is not None
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +188,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -158,13 +209,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password hashed with an outdated work factor is re-hashed; the
+        caller should commit.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
@@ -175,6 +231,10 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -188,7 +248,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,9 +257,94 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized; maintained (a few seconds behind) by likes.py.
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
 
+class TimelineEntry(db.Model):
+    """A message delivered to a user's home timeline.
+
+    Rows are written when a message is posted (fan-out on write), so the
+    home page is a single range read over (user_id, timestamp).
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A user's precomputed "who to follow" suggestions.
+
+    Written by recommendations.py; `suggestions` is a JSON list of cards,
+    best first, so a page needs one primary-key read to show them.
+    """
+
+    __tablename__ = 'recommendations'
+
+    __table_args__ = (
+        db.Index('ix_recommendations_stale_computed', 'stale', 'computed_at'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggestions = db.Column(
+        db.Text,
+        nullable=False,
+        default='[]',
+    )
+
+    # Set when the user's follows (or their follows' follows) change.
+    stale = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
+    # When `stale` was last set. Suggestions computed from a follow graph
+    # read before then still leave the row stale.
+    stale_at = db.Column(db.DateTime)
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
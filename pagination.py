@@ -0,0 +1,157 @@
+"""Keyset (cursor) pagination helpers.
+
+Pages are addressed by the sort key of the row at their edge rather than by
+OFFSET, so reading page 500 costs the same index seek as reading page 1.
+`before` asks for rows whose key sorts below the cursor, `after` for rows
+above it. Timelines are listed in descending key order (newest first), so
+their next page is `before`; alphabetical lists ascend, so theirs is
+`after`.
+
+A cursor is the page-edge sort key encoded for a query string, e.g.
+`20240131120000000000.42` for a (timestamp, id) key or `42` for an id.
+"""
+
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import and_, or_
+
+_TIMESTAMP_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class Page:
+    """One page of a keyset-paginated list.
+
+    `next`/`previous` are cursors for the neighbouring pages (None at the
+    ends), to be passed as `next_param`/`previous_param` in the query string.
+    """
+
+    def __init__(self, items, next=None, previous=None, descending=True):
+        self.items = items
+        self.next = next
+        self.previous = previous
+        self.next_param = 'before' if descending else 'after'
+        self.previous_param = 'after' if descending else 'before'
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(key):
+    """Encode a sort key tuple for use in a query string."""
+
+    return '.'.join(value.strftime(_TIMESTAMP_FORMAT)
+                    if isinstance(value, datetime) else str(value)
+                    for value in key)
+
+
+def decode_cursor(raw, types):
+    """Decode a cursor produced by `encode_cursor`; abort with 400 if malformed.
+
+    `types` gives the type of each key part, e.g. (datetime, int).
+    Returns None when `raw` is empty. Only the last key part may contain
+    dots (e.g. a username).
+    """
+
+    if not raw:
+        return None
+
+    parts = raw.split('.', len(types) - 1)
+    if len(parts) != len(types):
+        abort(400)
+
+    try:
+        return tuple(datetime.strptime(part, _TIMESTAMP_FORMAT)
+                     if kind is datetime else kind(part)
+                     for part, kind in zip(parts, types))
+    except ValueError:
+        abort(400)
+
+
+def cursor_args(request, types):
+    """Return the decoded (before, after) cursors from the query string."""
+
+    return (decode_cursor(request.args.get('before'), types),
+            decode_cursor(request.args.get('after'), types))
+
+
+def _beyond(columns, key, above):
+    """SQL for "sort key is strictly above/below `key`"."""
+
+    column, value = columns[0], key[0]
+    edge = column > value if above else column < value
+    if len(columns) == 1:
+        return edge
+    return or_(edge, and_(column == value, _beyond(columns[1:], key[1:], above)))
+
+
+def seek(query, columns, before=None, after=None, descending=True):
+    """Filter and order `query` to start just past a cursor.
+
+    The result is ordered away from the cursor: descending for `before`,
+    ascending for `after`, and in list order for the first page. Callers
+    should reverse rows fetched against list order.
+    """
+
+    if after is not None or (before is None and not descending):
+        if after is not None:
+            query = query.filter(_beyond(columns, after, above=True))
+        return query.order_by(*[column.asc() for column in columns])
+
+    if before is not None:
+        query = query.filter(_beyond(columns, before, above=False))
+    return query.order_by(*[column.desc() for column in columns])
+
+
+def against_list_order(before=None, after=None, descending=True):
+    """True if `seek` returns rows in the opposite order to the list."""
+
+    return (after is not None) if descending else (before is not None)
+
+
+def beyond(key, before=None, after=None):
+    """Python counterpart of `seek`'s filter for an in-memory sort key."""
+
+    if after is not None:
+        return key > after
+    if before is not None:
+        return key < before
+    return True
+
+
+def build_page(rows, per_page, key, before=None, after=None, descending=True):
+    """Turn up to per_page + 1 rows, in list order, into a Page.
+
+    The extra row only signals that another page exists in the direction
+    being read; it is dropped from the page.
+    """
+
+    more = len(rows) > per_page
+    backwards = against_list_order(before, after, descending)
+
+    if backwards:
+        rows = rows[-per_page:] if more else rows
+        has_previous, has_next = more, True
+    else:
+        rows = rows[:per_page]
+        has_previous, has_next = (before or after) is not None, more
+
+    return Page(rows,
+                next=encode_cursor(key(rows[-1])) if rows and has_next else None,
+                previous=encode_cursor(key(rows[0])) if rows and has_previous else None,
+                descending=descending)
+
+
+def keyset(query, columns, key, before=None, after=None, per_page=20, descending=True):
+    """Fetch one Page of `query`, listed in `columns` order.
+
+    `key(item)` must return the values of `columns` for a result row.
+    """
+
+    rows = seek(query, columns, before, after, descending).limit(per_page + 1).all()
+    if against_list_order(before, after, descending):
+        rows.reverse()
+    return build_page(rows, per_page, key, before, after, descending)
@@ -0,0 +1,177 @@
+"""Password hashing off the request thread, with throttling.
+
+bcrypt is deliberately slow: each hash or check takes tens to hundreds of
+milliseconds of CPU. Run inline, a burst of logins can tie up every
+gunicorn worker. Instead, hashes are computed on a small thread pool
+(bcrypt releases the GIL while it works), and at most
+PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE of them may be running or
+waiting at once. A request that finds the queue full gets HasherBusy,
+which app.py turns into a 503, rather than piling up behind the others.
+
+The pool and its limit are per process, and only requests served
+concurrently by the same process can fill it. Deploy with a threaded
+worker class (`gunicorn --threads N`, which selects gthread) so that
+each worker runs several requests at once. Under the default sync
+workers each process serves one request at a time, so at most one hash
+is ever waiting, HasherBusy is never raised, and the worker count is
+the only bound on hashing.
+
+The work factor is app.config['BCRYPT_LOG_ROUNDS']. Hashes made with a
+different factor still verify, and `User.authenticate` re-hashes them on
+the next successful login.
+
+`attempts` counts failed logins per username and per client IP, so that
+password guessing cannot keep the hash pool busy. Behind reverse proxies,
+set app.config['TRUSTED_PROXIES'] (or the TRUSTED_PROXIES environment
+variable) to how many of them append to X-Forwarded-For. Otherwise every
+client shares the proxy's address, and one guesser locks out everyone.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from threading import BoundedSemaphore, Lock
+import time
+
+import bcrypt
+from flask import current_app, has_app_context, request
+
+from cache import LRUCache
+
+DEFAULTS = {
+    'BCRYPT_LOG_ROUNDS': int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)),
+    'PASSWORD_HASH_WORKERS': 2,
+    'PASSWORD_HASH_QUEUE': 16,
+    # Failed logins allowed per LOGIN_FAILURE_WINDOW seconds.
+    'LOGIN_FAILURES_PER_USERNAME': 5,
+    'LOGIN_FAILURES_PER_IP': 20,
+    'LOGIN_FAILURE_WINDOW': 15 * 60,
+    # Reverse proxies in front of the app that set X-Forwarded-For.
+    'TRUSTED_PROXIES': int(os.environ.get('TRUSTED_PROXIES', 0)),
+}
+
+
+class HasherBusy(Exception):
+    """Too many password hashes are already running or queued."""
+
+
+def _config(name):
+    if has_app_context():
+        return current_app.config.get(name, DEFAULTS[name])
+    return DEFAULTS[name]
+
+
+def client_ip():
+    """The requesting client's address, as seen by the outermost trusted proxy.
+
+    Each trusted proxy appends the address it got the request from to
+    X-Forwarded-For, so the client is TRUSTED_PROXIES entries from the end;
+    anything before that was sent by the client and can't be trusted.
+    """
+
+    hops = _config('TRUSTED_PROXIES')
+    if hops:
+        forwarded = [address.strip()
+                     for address in request.headers.get('X-Forwarded-For', '').split(',')
+                     if address.strip()]
+        if len(forwarded) >= hops:
+            return forwarded[-hops]
+    return request.remote_addr
+
+
+class Hasher:
+    """Runs bcrypt on a bounded thread pool."""
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = Lock()
+
+    def _submit(self, fn, *args):
+        with self._lock:
+            if self._slots is None:
+                workers = _config('PASSWORD_HASH_WORKERS')
+                self._executor = ThreadPoolExecutor(workers, 'bcrypt')
+                self._slots = BoundedSemaphore(workers + _config('PASSWORD_HASH_QUEUE'))
+
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password, rounds=None):
+        """Return the bcrypt hash of `password` as a str."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        rounds = rounds or _config('BCRYPT_LOG_ROUNDS')
+        hashed = self._submit(bcrypt.hashpw, password.encode('utf-8'),
+                              bcrypt.gensalt(rounds))
+        return hashed.decode('utf-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        if not password:
+            return False
+        return self._submit(bcrypt.checkpw, password.encode('utf-8'),
+                            hashed.encode('utf-8'))
+
+
+def needs_rehash(hashed):
+    """Was `hashed` made with a work factor other than the configured one?"""
+
+    try:
+        rounds = int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return True
+    return rounds != _config('BCRYPT_LOG_ROUNDS')
+
+
+class Attempts:
+    """Failed-login counters over a sliding window, per worker."""
+
+    def __init__(self):
+        self._failures = LRUCache('login_failures', maxsize=100000)
+        self._lock = Lock()
+
+    def _keys(self, username, ip):
+        return ((('username', (username or '').lower()),
+                 _config('LOGIN_FAILURES_PER_USERNAME')),
+                (('ip', ip), _config('LOGIN_FAILURES_PER_IP')))
+
+    def _recent(self, key):
+        cutoff = time.monotonic() - _config('LOGIN_FAILURE_WINDOW')
+        return [at for at in self._failures.peek(key, ()) if at > cutoff]
+
+    def blocked(self, username, ip):
+        """Has this username or IP used up its failed logins?"""
+
+        return any(len(self._recent(key)) >= limit
+                   for key, limit in self._keys(username, ip))
+
+    def failed(self, username, ip):
+        with self._lock:
+            for key, _ in self._keys(username, ip):
+                self._failures.set(key, self._recent(key) + [time.monotonic()],
+                                   ttl=_config('LOGIN_FAILURE_WINDOW'))
+
+    def succeeded(self, username):
+        self._failures.pop(('username', (username or '').lower()))
+
+
+hasher = Hasher()
+attempts = Attempts()
+
+
+def hash_password(password):
+    return hasher.hash(password)
+
+
+def check_password(hashed, password):
+    return hasher.check(hashed, password)
@@ -0,0 +1,72 @@
+"""The logged-in user, as seen by every request.
+
+`add_user_to_g` used to load the full User row (and templates then lazily
+loaded its relationships) on every request. Most requests only need the
+few columns shown in the navbar and the home page's profile card, so
+those are cached per worker as an immutable Principal and put on `g.user`.
+Routes that change the user load the ORM object with `load_user()`.
+
+A cached Principal is dropped when:
+
+- this worker calls `forget`, after any change to the user's profile or
+  counters;
+- the login session carries a newer `profile_version` than the cached
+  copy. The session is updated when the profile is edited, so the editor
+  never sees their old profile from another worker;
+- the TTL expires. This covers changes made by other users (e.g. a new
+  follower) in other workers.
+"""
+
+from collections import namedtuple
+
+from flask import g
+
+from cache import LRUCache
+from models import db, User
+
+Principal = namedtuple('Principal', [
+    'id', 'username', 'image_url', 'header_image_url',
+    'messages_count', 'following_count', 'followers_count', 'likes_count',
+    'profile_version',
+])
+
+principals = LRUCache('principals', maxsize=10000, ttl=60)
+
+
+def get(user_id, min_version=0):
+    """Return the Principal for `user_id`, or None if there is no such user."""
+
+    cached = principals.get(user_id)
+    if cached is not None and cached.profile_version >= min_version:
+        return cached
+
+    row = (db.session
+           .query(*[getattr(User, field) for field in Principal._fields])
+           .filter(User.id == user_id)
+           .first())
+    if row is None:
+        principals.pop(user_id)
+        return None
+
+    principal = Principal(*row)
+    principals.set(user_id, principal)
+    return principal
+
+
+def forget(user_id):
+    """Drop the cached Principal for `user_id`."""
+
+    principals.pop(user_id)
+
+
+def load_user():
+    """The logged-in user's ORM object, loaded once per request.
+
+    Returns None when logged out.
+    """
+
+    if not g.get('user'):
+        return None
+    if g.get('user_record') is None:
+        g.user_record = User.query.get(g.user.id)
+    return g.user_record
@@ -0,0 +1,126 @@
+"""Opt-in sampling profiler for individual requests.
+
+A profiled request gets a background thread that looks at the request
+thread's stack every PROFILE_INTERVAL_MS milliseconds. When the request
+ends, the stacks are written to PROFILE_DIR in the "collapsed" format read
+by flamegraph.pl and speedscope: one `outer;inner;innermost count` line
+per distinct stack. The file is named after the endpoint and a fresh
+random id, e.g. `homepage-3f2a....folded`, and the name is returned in
+the X-Profile-File header. (Client-supplied request ids never go into the
+name, so a crafted X-Request-ID can't point it outside PROFILE_DIR.)
+
+Requests are profiled if either:
+
+- a random draw falls under app.config['PROFILE_SAMPLE_RATE']
+  (0 by default, meaning off), or
+- they send an `X-Profile` header equal to app.config['PROFILE_TOKEN'].
+
+Sampling only reads the stack, so the profiled request runs at close to
+its normal speed. Other requests are not affected at all.
+"""
+
+from collections import Counter
+import os
+import random
+import sys
+from threading import Event, Thread, get_ident
+import uuid
+
+from flask import current_app, g, request
+
+# Frames from these files are left out of the stacks.
+_SKIPPED = (os.path.abspath(__file__),)
+
+
+class Sampler:
+    """Samples one thread's stack on a timer until stopped."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            self.stacks[_collapse(frame)] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """The samples as collapsed-stack lines."""
+
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        if code.co_filename not in _SKIPPED:
+            filename = os.path.basename(code.co_filename)
+            names.append(f'{code.co_name} ({filename}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _wanted():
+    config = current_app.config
+    token = config['PROFILE_TOKEN']
+    if token and request.headers.get('X-Profile') == token:
+        return True
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_SAMPLE_RATE',
+                          float(os.environ.get('PROFILE_SAMPLE_RATE', 0)))
+    app.config.setdefault('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+    app.config.setdefault('PROFILE_DIR', os.environ.get(
+        'PROFILE_DIR', os.path.join(app.instance_path, 'profiles')))
+    app.config.setdefault('PROFILE_INTERVAL_MS', 5)
+
+    app.before_request(_start_profile)
+    app.after_request(_name_profile)
+    app.teardown_request(_write_profile)
+
+
+def _start_profile():
+    if not _wanted():
+        return
+
+    sampler = Sampler(get_ident(), current_app.config['PROFILE_INTERVAL_MS'] / 1000)
+    g.profile = (sampler, f"{request.endpoint or 'unmatched'}-{uuid.uuid4().hex}.folded")
+    sampler.start()
+
+
+def _name_profile(response):
+    if 'profile' in g:
+        response.headers['X-Profile-File'] = g.profile[1]
+    return response
+
+
+def _write_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+
+    sampler, filename = profile
+    sampler.stop()
+
+    directory = current_app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, filename), 'w') as f:
+        f.write(sampler.collapsed())
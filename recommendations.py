@@ -0,0 +1,277 @@
+"""Precomputed "who to follow" suggestions.
+
+Candidates are the accounts reachable in two hops through the follow
+graph (people followed by the people you follow) that you don't already
+follow. Each path counts towards the candidate's score, weighted by
+1 / log(2 + n) where n is how many accounts the intermediate user
+follows, so a friend who follows a handful of people says more than one
+who follows thousands. The best TOP_K are stored as JSON cards in the
+`recommendations` table, and a page shows them with one primary-key read.
+
+Suggestions are refreshed incrementally, outside the web workers. Following
+or unfollowing marks the follower's row stale, and the rows of up to
+STALE_FANOUT of their followers, whose two-hop paths went through them;
+that is all a web worker does. One `flask recommend --watch` process
+recomputes stale rows, rows older than MAX_AGE (which catches followers
+beyond the fan-out cap) and users who have no row yet, every
+REFRESH_SECONDS. Plain `flask recommend` recomputes everyone once, e.g.
+after a bulk load.
+
+Scores come from a follow graph (graph.py) the worker rebuilds from the
+`follows` table every GRAPH_SECONDS, which web workers on the same
+machine then share. A row only stops being stale if the graph was read
+after the row was last marked (less CLOCK_SLACK, for the commit that
+follows the marking and for clocks that disagree), so a follow the graph
+hasn't seen yet keeps the row in line for the next rebuild. Suggestions
+the viewer has since followed are dropped when served.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+import heapq
+import json
+import logging
+import math
+import time
+
+from sqlalchemy import and_, bindparam, event, exists, or_, select
+from sqlalchemy.dialects import postgresql
+
+import graph
+from models import db, Follows, Recommendation, User
+
+log = logging.getLogger(__name__)
+
+TOP_K = 10
+REFRESH_SECONDS = 30
+GRAPH_SECONDS = 5 * 60
+BATCH_SIZE = 200
+MAX_AGE = timedelta(days=1)
+CLOCK_SLACK = timedelta(seconds=5)
+
+# Follows of the user scored through, and follows of each of those.
+MAX_FRIENDS = 1000
+MAX_FANOUT = 1000
+
+# Followers whose suggestions are marked stale when someone (un)follows.
+STALE_FANOUT = 1000
+
+recommendations = Recommendation.__table__
+follows = Follows.__table__
+users = User.__table__
+
+
+def score(follow_graph, user_id, k=TOP_K):
+    """The `k` best two-hop candidates for `user_id`.
+
+    Returns (candidate_id, score, paths) tuples, best first; `paths` is
+    how many of the user's follows follow the candidate.
+    """
+
+    following = follow_graph.following(user_id)
+    followed = set(following)
+    scores = defaultdict(float)
+    paths = defaultdict(int)
+
+    for friend_id in following[:MAX_FRIENDS]:
+        theirs = follow_graph.following(friend_id)
+        weight = 1 / math.log(2 + len(theirs))
+        for candidate_id in theirs[:MAX_FANOUT]:
+            if candidate_id != user_id and candidate_id not in followed:
+                scores[candidate_id] += weight
+                paths[candidate_id] += 1
+
+    best = heapq.nlargest(k, scores, key=lambda c: (scores[c], -c))
+    return [(c, round(scores[c], 4), paths[c]) for c in best]
+
+
+def snapshot():
+    """(as_of, follow graph): the graph rebuilt now, and when its rows were read."""
+
+    as_of = datetime.utcnow()
+    return as_of, graph.rebuild()
+
+
+def compute(follow_graph, user_ids):
+    """Score `user_ids` and build their cards. Returns {user_id: [card, ...]}."""
+
+    scored = {user_id: score(follow_graph, user_id) for user_id in user_ids}
+
+    candidate_ids = {c for ranked in scored.values() for c, _, _ in ranked}
+    profiles = {}
+    if candidate_ids:
+        profiles = {row.id: row for row in db.session
+                    .query(User.id, User.username, User.image_url)
+                    .filter(User.id.in_(candidate_ids))}
+
+    return {
+        user_id: [{'id': c, 'username': profiles[c].username,
+                   'image_url': profiles[c].image_url,
+                   'score': s, 'paths': p}
+                  for c, s, p in ranked if c in profiles]
+        for user_id, ranked in scored.items()
+    }
+
+
+def _insert_ignoring_duplicates():
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(recommendations).on_conflict_do_nothing()
+    return recommendations.insert().prefix_with('OR IGNORE')
+
+
+def refresh(user_ids, follow_graph=None, as_of=None):
+    """Recompute and store suggestions for `user_ids`. The caller commits.
+
+    `follow_graph` was read at `as_of`; by default a fresh one is loaded.
+    Rows marked stale after that stay stale.
+    """
+
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return 0
+    if follow_graph is None:
+        as_of, follow_graph = snapshot()
+
+    now = datetime.utcnow()
+    rows = [{'uid': user_id, 'cards': json.dumps(cards)}
+            for user_id, cards in compute(follow_graph, user_ids).items()]
+
+    still_stale = and_(recommendations.c.stale_at.isnot(None),
+                       recommendations.c.stale_at > as_of - CLOCK_SLACK)
+    db.session.execute(recommendations.update()
+                       .where(recommendations.c.user_id == bindparam('uid'))
+                       .values(suggestions=bindparam('cards'), computed_at=now,
+                               stale=still_stale),
+                       rows)
+    db.session.execute(_insert_ignoring_duplicates(),
+                       [{'user_id': row['uid'], 'suggestions': row['cards'],
+                         'stale': False, 'computed_at': now} for row in rows])
+    return len(rows)
+
+
+def refresh_all(batch_size=BATCH_SIZE):
+    """Recompute every user's suggestions, committing each batch."""
+
+    as_of, follow_graph = snapshot()
+    done, last_id = 0, 0
+    while True:
+        user_ids = [user_id for (user_id,) in db.session
+                    .query(User.id)
+                    .filter(User.id > last_id)
+                    .order_by(User.id)
+                    .limit(batch_size)]
+        if not user_ids:
+            return done
+
+        done += refresh(user_ids, follow_graph, as_of)
+        db.session.commit()
+        last_id = user_ids[-1]
+
+
+def refresh_stale(limit=BATCH_SIZE, follow_graph=None, as_of=None):
+    """Recompute one batch of stale, expired or missing rows. Commits.
+
+    Only rows the graph can settle are taken: those marked stale before
+    it was read. On PostgreSQL they stay locked (SKIP LOCKED, so workers
+    take different batches) until the new suggestions commit.
+    """
+
+    if follow_graph is None:
+        as_of, follow_graph = snapshot()
+
+    settled = or_(recommendations.c.stale_at.is_(None),
+                  recommendations.c.stale_at <= as_of - CLOCK_SLACK)
+    expired = recommendations.c.computed_at < datetime.utcnow() - MAX_AGE
+    query = (select([recommendations.c.user_id])
+             .where(or_(and_(recommendations.c.stale, settled),
+                        and_(~recommendations.c.stale, expired)))
+             .order_by(recommendations.c.computed_at)
+             .limit(limit))
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update(skip_locked=True)
+    user_ids = {user_id for (user_id,) in db.session.execute(query)}
+
+    if len(user_ids) < limit:
+        has_row = exists().where(recommendations.c.user_id == users.c.id)
+        missing = (select([users.c.id])
+                   .where(~has_row)
+                   .order_by(users.c.id)
+                   .limit(limit - len(user_ids)))
+        user_ids.update(user_id for (user_id,) in db.session.execute(missing))
+
+    done = refresh(user_ids, follow_graph, as_of)
+    db.session.commit()
+    return done
+
+
+def run(echo=print):
+    """Keep everyone's suggestions fresh; never returns. `flask recommend --watch`."""
+
+    as_of = follow_graph = None
+    while True:
+        try:
+            if as_of is None or (datetime.utcnow() - as_of
+                                 > timedelta(seconds=GRAPH_SECONDS)):
+                as_of, follow_graph = snapshot()
+
+            done = BATCH_SIZE
+            while done == BATCH_SIZE:
+                done = refresh_stale(BATCH_SIZE, follow_graph, as_of)
+                if done:
+                    echo(f"Recomputed suggestions for {done} user(s).")
+        except Exception:
+            db.session.rollback()
+            log.exception("Could not refresh recommendations")
+        time.sleep(REFRESH_SECONDS)
+
+
+def mark_stale(user_id, connection=None):
+    """After `user_id` follows or unfollows someone, mark their suggestions
+    and their followers' stale, in the same transaction.
+
+    A user without a row yet gets a stale, empty one, so the worker can't
+    store suggestions for them from a graph read before this change.
+    """
+
+    execute = (connection or db.session).execute
+    now = datetime.utcnow()
+
+    execute(_insert_ignoring_duplicates(),
+            {'user_id': user_id, 'suggestions': '[]', 'stale': True,
+             'stale_at': now, 'computed_at': now})
+
+    followers = (select([follows.c.user_following_id])
+                 .where(follows.c.user_being_followed_id == user_id)
+                 .limit(STALE_FANOUT))
+    execute(recommendations.update()
+            .where(or_(recommendations.c.user_id == user_id,
+                       recommendations.c.user_id.in_(followers)))
+            .values(stale=True, stale_at=now))
+
+
+@event.listens_for(Follows, 'after_insert')
+@event.listens_for(Follows, 'after_delete')
+def _follow_changed(mapper, connection, follow):
+    mark_stale(follow.user_following_id, connection)
+
+
+##############################################################################
+# Serving
+
+
+def suggestions_for(user_id, limit=5):
+    """Up to `limit` stored suggestions for `user_id`, best first.
+
+    A user the worker hasn't got to yet gets none.
+    """
+
+    stored = (db.session
+              .query(Recommendation.suggestions)
+              .filter(Recommendation.user_id == user_id)
+              .scalar())
+    if not stored:
+        return []
+
+    follow_graph = graph.graph()
+    return [card for card in json.loads(stored)
+            if not follow_graph.follows(user_id, card['id'])][:limit]
@@ -0,0 +1,83 @@
+"""User search.
+
+Matches the query anywhere in a user's username, bio or location and ranks
+exact and prefix username matches first.
+
+On PostgreSQL the match runs against a pg_trgm GIN index over the same
+expression as `_document()` (see migration 3), so an infix search is an
+index scan rather than a sequential scan of `users`, and ranking adds
+trigram similarity to the username. SQLite, used for local testing, falls
+back to a plain LIKE scan with the same ranking rules.
+"""
+
+from sqlalchemy import case, func, literal_column
+
+from models import db, User
+
+PER_PAGE = 24
+
+# Ranked searches can't use a keyset cursor, so paging is by OFFSET and
+# capped to keep deep pages cheap.
+MAX_PAGES = 10
+
+
+class Results:
+    """One page of ranked search results."""
+
+    def __init__(self, users, page, has_more):
+        self.users = users
+        self.page = page
+        self.has_more = has_more
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+
+def _document():
+    """The searchable text of a user; must match the trigram index expression."""
+
+    space = literal_column("' '")
+    blank = literal_column("''")
+    return func.lower(User.username.op('||')(space)
+                      .op('||')(func.coalesce(User.bio, blank))
+                      .op('||')(space)
+                      .op('||')(func.coalesce(User.location, blank)))
+
+
+def _escape_like(term):
+    return (term.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+def search_users(term, page=1, per_page=PER_PAGE):
+    """Return a Results page of users matching `term`, best matches first."""
+
+    term = term.strip().lower()
+    page = min(max(page, 1), MAX_PAGES)
+    if not term:
+        return Results([], page, False)
+
+    pattern = _escape_like(term)
+    username = func.lower(User.username)
+
+    rank = (case([(username == term, 4)], else_=0)
+            + case([(username.like(f'{pattern}%', escape='\\'), 2)], else_=0)
+            + case([(username.like(f'%{pattern}%', escape='\\'), 1)], else_=0))
+
+    if db.engine.dialect.name == 'postgresql':
+        rank = rank + func.similarity(username, term)
+
+    users = (User
+             .query
+             .filter(_document().like(f'%{pattern}%', escape='\\'))
+             .order_by(rank.desc(), User.username, User.id)
+             .offset((page - 1) * per_page)
+             .limit(per_page + 1)
+             .all())
+
+    has_more = len(users) > per_page and page < MAX_PAGES
+    return Results(users[:per_page], page, has_more)
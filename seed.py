@@ -1,20 +1,223 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py [DIRECTORY]
+
+Recreates the database, then streams users.csv, messages.csv,
+follows.csv and, if present, likes.csv from DIRECTORY (default
+`generator/`; workload.py writes these) into it. Each may also be
+gzipped (`users.csv.gz`). The first line of each file names its columns.
+Empty fields load as NULL, and columns a file leaves out get the
+model's default. `seed_tables` loads rows from any iterables instead,
+e.g. straight from workload.py without writing files.
+
+Rows are read and written CHUNK_ROWS at a time, so memory stays flat
+however big the files are: on PostgreSQL each chunk is one COPY FROM
+STDIN, elsewhere one executemany INSERT. Secondary indexes (and, on
+PostgreSQL, foreign keys and unique constraints) are dropped for the
+load and built once at the end, which is far cheaper than maintaining
+them row by row.
+
+Finally id sequences are moved past the loaded ids and every schema
+migration is applied, which recounts the denormalized counters and
+builds the home timelines from the loaded rows, capped and a batch of
+users per transaction (see timeline.rebuild_all). Follow suggestions
+are left to `flask recommend`.
+"""
+
+import csv
+import gzip
+import io
+from itertools import islice
+import os
+import sys
+import time
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint
 
-from csv import DictReader
 from app import db
-from models import User, Message, Follows
+import migrations
+from models import User, Message, Follows, Likes
+
+CHUNK_ROWS = 50000
+
+# In foreign key order: (file, table, whether the file must exist).
+FILES = [
+    ('users.csv', User.__table__, True),
+    ('messages.csv', Message.__table__, True),
+    ('follows.csv', Follows.__table__, True),
+    ('likes.csv', Likes.__table__, False),
+]
+
+
+def _defaults(table, header):
+    """Values for the table's columns that the file leaves out."""
+
+    values = {}
+    for column in table.columns:
+        if column.name in header or column.default is None:
+            continue
+        if column.default.is_scalar:
+            values[column.name] = column.default.arg
+        elif column.default.is_callable:
+            values[column.name] = column.default.arg(None)
+    return values
+
+
+def _copy(connection, table, columns, rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+    cursor.close()
+
+
+def _insert(connection, table, columns, rows):
+    placeholders = ', '.join(f':{column}' for column in columns)
+    connection.execute(
+        text(f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES ({placeholders})"),
+        [{column: None if value == '' else value for column, value in zip(columns, row)}
+         for row in rows])
+
+
+def read_csv(path):
+    """Rows of a CSV file, header first, read lazily. `.gz` files are
+    decompressed on the fly."""
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', newline='') as f:
+        yield from csv.reader(f)
+
+
+def load(connection, table, rows, log=print):
+    """Stream `rows` (column names first) into `table`. Returns the row count."""
+
+    write = _copy if connection.dialect.name == 'postgresql' else _insert
+
+    rows = iter(rows)
+    header = next(rows)
+    defaults = _defaults(table, header)
+    columns = list(header) + list(defaults)
+    extra = list(defaults.values())
+
+    loaded, started = 0, time.perf_counter()
+    while True:
+        chunk = [list(row) + extra for row in islice(rows, CHUNK_ROWS)]
+        if not chunk:
+            break
+
+        with connection.begin():
+            write(connection, table, columns, chunk)
+
+        loaded += len(chunk)
+        rate = loaded / max(time.perf_counter() - started, 1e-6)
+        log(f"{table.name}: {loaded:,} rows ({rate:,.0f} rows/s)")
+
+    return loaded
+
+
+##############################################################################
+# Deferred indexes and constraints
+
+
+def defer_constraints(connection, tables):
+    """Drop what can be built after the load. Returns a function restoring it."""
+
+    postgres = connection.dialect.name == 'postgresql'
+    inspector = inspect(connection)
+    restore = []
+
+    if postgres:
+        for table in tables:
+            for fk in inspector.get_foreign_keys(table.name):
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} DROP CONSTRAINT {fk['name']}"))
+            restore.extend(AddConstraint(fk) for fk in table.foreign_key_constraints)
+
+        for table in tables:
+            for unique in inspector.get_unique_constraints(table.name):
+                connection.execute(text(
+                    f"ALTER TABLE {table.name} DROP CONSTRAINT {unique['name']}"))
+                restore.insert(0, text(
+                    f"ALTER TABLE {table.name} ADD CONSTRAINT {unique['name']} "
+                    f"UNIQUE ({', '.join(unique['column_names'])})"))
+
+    indexes = [index for table in tables for index in table.indexes]
+    for index in indexes:
+        index.drop(connection)
+
+    def rebuild(log=print):
+        for index in indexes:
+            log(f"Building index {index.name}")
+            index.create(connection)
+        for ddl in restore:
+            connection.execute(ddl)
+        log("Constraints restored.")
+
+    return rebuild
+
+
+def reset_sequences(connection, tables):
+    """Move serial id sequences past the loaded ids (PostgreSQL only)."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for table in tables:
+        if 'id' in table.columns and table.c.id.autoincrement:
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'),"
+                f" coalesce(max(id), 0) + 1, false) FROM {table.name}"))
+
+
+##############################################################################
+# Runner
+
+
+def seed(directory='generator', log=print):
+    """Recreate the database and load the CSV files in `directory`."""
+
+    sources = []
+    for name, table, required in FILES:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path) and os.path.exists(path + '.gz'):
+            path += '.gz'
+        if os.path.exists(path):
+            sources.append((table, read_csv(path)))
+        elif required:
+            raise FileNotFoundError(path)
+
+    seed_tables(sources, log)
+
+
+def seed_tables(sources, log=print):
+    """Recreate the database and load (table, rows) sources, in FK order.
+
+    Each `rows` is an iterable of sequences, column names first.
+    """
+
+    db.drop_all()
+    with db.engine.connect() as connection:
+        connection.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+    db.create_all()
 
+    tables = [table for table, _ in sources]
+    with db.engine.connect() as connection:
+        rebuild = defer_constraints(connection, tables)
 
-db.drop_all()
-db.create_all()
+        started = time.perf_counter()
+        total = sum(load(connection, table, rows, log) for table, rows in sources)
+        log(f"Loaded {total:,} rows in {time.perf_counter() - started:,.1f}s")
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+        rebuild(log)
+        reset_sequences(connection, tables)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    migrations.upgrade(db.engine, log)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    seed(*sys.argv[1:2])
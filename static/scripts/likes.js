@@ -0,0 +1,29 @@
+// Toggle likes in place instead of reloading the whole timeline.
+
+(function () {
+  document.addEventListener('submit', async function (event) {
+    const form = event.target;
+    if (!form.classList.contains('like-form')) return;
+    event.preventDefault();
+
+    const resp = await fetch(form.action, {
+      method: 'POST',
+      headers: {'Accept': 'application/json'},
+      credentials: 'same-origin',
+    });
+    if (!resp.ok) {
+      form.submit();
+      return;
+    }
+
+    const data = await resp.json();
+    const button = form.querySelector('button');
+    button.classList.toggle('btn-primary', data.liked);
+    button.classList.toggle('btn-secondary', !data.liked);
+
+    const count = form.querySelector('.like-count');
+    if (count) {
+      count.textContent = Math.max(0, Number(count.textContent) + (data.liked ? 1 : -1));
+    }
+  });
+})();
@@ -0,0 +1,35 @@
+// Fill the search box's <datalist> with username suggestions as the user types.
+
+(function () {
+  const input = document.getElementById('search');
+  const list = document.getElementById('search-suggestions');
+  if (!input || !list) return;
+
+  let timer = null;
+  let latest = '';
+
+  input.addEventListener('input', function () {
+    clearTimeout(timer);
+    timer = setTimeout(suggest, 100);
+  });
+
+  async function suggest() {
+    const prefix = input.value.trim();
+    latest = prefix;
+    if (!prefix) {
+      list.innerHTML = '';
+      return;
+    }
+
+    const resp = await fetch('/users/autocomplete?q=' + encodeURIComponent(prefix));
+    if (!resp.ok || prefix !== latest) return;
+
+    const data = await resp.json();
+    list.innerHTML = '';
+    for (const user of data.users) {
+      const option = document.createElement('option');
+      option.value = user.username;
+      list.appendChild(option);
+    }
+  }
+})();
@@ -0,0 +1,123 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+import brotli
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        self.static_folder = tempfile.mkdtemp()
+        self.original_static_folder = app.static_folder
+
+        os.makedirs(os.path.join(self.static_folder, 'stylesheets'))
+        os.makedirs(os.path.join(self.static_folder, 'images'))
+        with open(os.path.join(self.static_folder, 'images', 'logo.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+        with open(os.path.join(self.static_folder, 'stylesheets', 'style.css'), 'w') as f:
+            f.write('body { background: url("/static/images/logo.png"); }\n'
+                    '.nav { background: url(../images/logo.png?x=1); }\n'
+                    '.ext { background: url(https://example.com/a.png); }\n' * 20)
+
+        self.manifest = assets.build(self.static_folder, log=lambda message: None)
+
+        app.static_folder = self.static_folder
+        assets._manifest = None
+        assets._vendored.clear()
+
+    def tearDown(self):
+        app.static_folder = self.original_static_folder
+        assets._manifest = None
+        assets._vendored.clear()
+        shutil.rmtree(self.static_folder)
+
+    def test_build_fingerprints_and_rewrites(self):
+        logo = self.manifest['images/logo.png']
+        css = self.manifest['stylesheets/style.css']
+        self.assertRegex(logo, r'^images/logo\.[0-9a-f]{12}\.png$')
+
+        dist = os.path.join(self.static_folder, 'dist')
+        with open(os.path.join(dist, css)) as f:
+            built = f.read()
+        self.assertIn(f'url("/static/dist/{logo}")', built)
+        self.assertIn(f'url(/static/dist/{logo}?x=1)', built)
+        self.assertIn('url(https://example.com/a.png)', built)
+
+        with gzip.open(os.path.join(dist, css + '.gz'), 'rt') as f:
+            self.assertEqual(f.read(), built)
+        with open(os.path.join(dist, css + '.br'), 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()).decode(), built)
+        self.assertFalse(os.path.exists(os.path.join(dist, logo + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(dist, logo + '.br')))
+
+        with open(os.path.join(dist, 'manifest.json')) as f:
+            self.assertEqual(json.load(f), self.manifest)
+
+    def test_build_requires_brotli(self):
+        brotli_module = assets.brotli
+        assets.brotli = None
+        try:
+            with self.assertRaises(RuntimeError):
+                assets.build(self.static_folder, log=lambda message: None)
+        finally:
+            assets.brotli = brotli_module
+
+    def test_static_url(self):
+        css = self.manifest['stylesheets/style.css']
+
+        with app.test_request_context():
+            self.assertEqual(assets.static_url('stylesheets/style.css'), f'/static/dist/{css}')
+            self.assertEqual(assets.static_url('/static/stylesheets/style.css'),
+                             f'/static/dist/{css}')
+            self.assertEqual(assets.static_url('https://example.com/me.png'),
+                             'https://example.com/me.png')
+            # vendored files not downloaded yet come from the CDN
+            self.assertEqual(assets.static_url('vendor/jquery/jquery.min.js'),
+                             assets.VENDOR['vendor/jquery/jquery.min.js'])
+
+    def test_serves_precompressed_with_far_future_caching(self):
+        url = f"/static/dist/{self.manifest['stylesheets/style.css']}"
+        client = app.test_client()
+
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn(b'/static/dist/', gzip.decompress(resp.data))
+        resp.close()
+
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn(b'/static/dist/', brotli.decompress(resp.data))
+        resp.close()
+
+        resp = client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
@@ -5,10 +5,20 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
+from datetime import datetime, timedelta
+import json
 import os
+import re
+import shutil
+import tempfile
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Follows, TimelineEntry
+import follows
+import fragments
+import graph
+import likes
+import timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -32,6 +42,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any view that goes over its declared SQL query budget
+
+app.config['QUERY_BUDGET_MODE'] = 'raise'
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -39,6 +53,7 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        graph.reset()
         User.query.delete()
         Message.query.delete()
 
@@ -51,6 +66,7 @@ class MessageViewTestCase(TestCase):
         self.testuser_id = 44444
         self.testuser.id = self.testuser_id
         db.session.commit()
+        graph.load()
 
     def tearDown(self):
         """After every test function rollback to delete any insertions in our db"""
@@ -103,6 +119,60 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<p class="single-message">testtttt</p>', html)
 
+    def test_message_show_conditional_get(self):
+        other = User.signup(username="other", email="other@test.com",
+                            password="password", image_url=None)
+        other.id = 70001
+        db.session.add(other)
+        db.session.add(Message(id=656567, text="etag me", user_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 70001
+
+            resp = c.get("/messages/656567")
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+            etag = resp.headers["ETag"]
+
+            resp = c.get("/messages/656567", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            # liking it changes the count shown, and following the author
+            # changes the button
+            c.post("/messages/656567/like")
+            likes.like_counts.flush()
+            resp = c.get("/messages/656567", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            etag = resp.headers["ETag"]
+            c.post(f"/users/follow/{self.testuser_id}")
+            resp = c.get("/messages/656567", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unfollow", resp.get_data(as_text=True))
+
+            self.assertEqual(c.get("/messages/999999").status_code, 404)
+
+    def test_anonymous_home_and_static_caching(self):
+        resp = self.client.get("/")
+        etag = resp.headers["ETag"]
+        self.assertEqual(self.client.get("/", headers={"If-None-Match": etag}).status_code, 304)
+
+        html = resp.get_data(as_text=True)
+        self.assertRegex(html, r'/static/stylesheets/style.css\?v=[0-9a-f]{12}')
+        url = re.search(r'/static/stylesheets/style.css\?v=[0-9a-f]+', html).group(0)
+        self.assertIn("immutable", self.client.get(url).headers["Cache-Control"])
+        self.assertEqual(self.client.get("/static/stylesheets/style.css")
+                         .headers["Cache-Control"], "public, no-cache")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+
     def test_message_delete_authenticated_authorized(self):
 
         m1 = Message(
@@ -173,5 +243,384 @@ class MessageViewTestCase(TestCase):
             m = Message.query.get(2222)
             self.assertIsNotNone(m)
 
+    def test_add_message_fans_out_to_followers(self):
+        """A new message lands on the home timeline of each follower."""
+
+        u = User.signup(username="follower",
+                        email="follower@test.com",
+                        password="password",
+                        image_url=None)
+        u.id = 55555
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=55555))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "fanned out"})
+
+            msg = Message.query.one()
+            entries = (TimelineEntry.query
+                       .filter(TimelineEntry.message_id == msg.id)
+                       .all())
+            self.assertEqual(sorted(e.user_id for e in entries),
+                             [self.testuser_id, 55555])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 55555
+
+            resp = c.get("/")
+            self.assertIn("fanned out", str(resp.data))
+
+    def test_delete_message_removes_timeline_entries(self):
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.post("/messages/new", data={"text": "short lived"})
+            msg = Message.query.one()
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(TimelineEntry.query.count(), 0)
+            resp = c.get("/")
+            self.assertNotIn("short lived", str(resp.data))
 
-    
+    def test_celebrity_message_is_pulled_not_pushed(self):
+        """Followers of a celebrity read their messages from the author cache."""
+
+        u = User.signup(username="fan",
+                        email="fan@test.com",
+                        password="password",
+                        image_url=None)
+        u.id = 55555
+        db.session.add(u)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=55555))
+        db.session.commit()
+
+        threshold = timeline.CELEBRITY_FOLLOWERS
+        timeline.CELEBRITY_FOLLOWERS = 1
+        timeline.celebrity_ids.clear()
+        timeline.recent_messages.clear()
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                c.post("/messages/new", data={"text": "famous words"})
+
+                msg = Message.query.one()
+                entries = (TimelineEntry.query
+                           .filter(TimelineEntry.message_id == msg.id)
+                           .all())
+                self.assertEqual([e.user_id for e in entries],
+                                 [self.testuser_id])
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 55555
+
+                resp = c.get("/")
+                self.assertIn("famous words", str(resp.data))
+        finally:
+            timeline.CELEBRITY_FOLLOWERS = threshold
+            timeline.celebrity_ids.clear()
+            timeline.recent_messages.clear()
+
+    def test_recent_messages_buffered_on_commit(self):
+        """A rolled-back post never reaches the author's recent-messages buffer."""
+
+        timeline.recent_messages.clear()
+        try:
+            self.assertEqual(list(timeline.recent(self.testuser_id)), [])
+
+            msg = Message(text="never posted", user_id=self.testuser_id)
+            db.session.add(msg)
+            db.session.flush()
+            timeline.fan_out(msg)
+            self.assertEqual(list(timeline.recent(self.testuser_id)), [])
+            db.session.rollback()
+            self.assertEqual(list(timeline.recent(self.testuser_id)), [])
+
+            msg = Message(text="posted", user_id=self.testuser_id)
+            db.session.add(msg)
+            db.session.flush()
+            timeline.fan_out(msg)
+            db.session.commit()
+            self.assertEqual([message_id for _, message_id
+                              in timeline.recent(self.testuser_id)], [msg.id])
+
+            timeline.retract(msg)
+            db.session.delete(msg)
+            self.assertEqual(len(timeline.recent(self.testuser_id)), 1)
+            db.session.commit()
+            self.assertIsNone(timeline.recent_messages.peek(self.testuser_id))
+        finally:
+            timeline.recent_messages.clear()
+
+    def test_timelines_are_capped(self):
+        """Rebuilds copy a few messages per author, and trimming keeps the newest."""
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        author.id = 70000
+        db.session.add(author)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=70000,
+                               user_following_id=self.testuser_id))
+        start = datetime(2020, 1, 1)
+        db.session.add_all([Message(id=90000 + n, text=f"post {n}", user_id=70000,
+                                    timestamp=start + timedelta(minutes=n))
+                            for n in range(5)])
+        db.session.commit()
+
+        def timeline_of(user_id):
+            return [e.message_id for e in TimelineEntry.query
+                    .filter_by(user_id=user_id)
+                    .order_by(TimelineEntry.timestamp.desc())]
+
+        saved = timeline.BACKFILL_LIMIT, timeline.TIMELINE_LIMIT
+        timeline.BACKFILL_LIMIT, timeline.TIMELINE_LIMIT = 2, 3
+        try:
+            self.assertEqual(timeline.rebuild_all(batch_size=1), 2)
+            self.assertEqual(timeline_of(self.testuser_id), [90004, 90003])
+            self.assertEqual(timeline_of(70000), [90004, 90003, 90002])
+
+            # posting doesn't trim; the periodic job does
+            msg = Message(id=90005, text="post 5", user_id=70000,
+                          timestamp=start + timedelta(minutes=5))
+            db.session.add(msg)
+            db.session.flush()
+            timeline.fan_out(msg)
+            db.session.commit()
+            self.assertEqual(len(timeline_of(70000)), 4)
+
+            self.assertEqual(timeline.trim_all(batch_size=1), 1)
+            self.assertEqual(timeline_of(70000), [90005, 90004, 90003])
+            self.assertEqual(timeline_of(self.testuser_id), [90005, 90004, 90003])
+        finally:
+            timeline.BACKFILL_LIMIT, timeline.TIMELINE_LIMIT = saved
+
+    def test_celebrity_previous_page_reads_past_buffer(self):
+        """A page after a cursor older than the buffer comes from the database."""
+
+        fan = User.signup(username="fan",
+                          email="fan@test.com",
+                          password="password",
+                          image_url=None)
+        fan.id = 55555
+        db.session.add(fan)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=self.testuser_id,
+                               user_following_id=55555))
+        start = datetime(2024, 1, 1)
+        msgs = [Message(id=3000 + n, text=f"post {n}", user_id=self.testuser_id,
+                        timestamp=start + timedelta(minutes=n))
+                for n in range(6)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        saved = timeline.CELEBRITY_FOLLOWERS, timeline.RECENT_PER_AUTHOR
+        timeline.CELEBRITY_FOLLOWERS, timeline.RECENT_PER_AUTHOR = 1, 3
+        timeline.celebrity_ids.clear()
+        timeline.recent_messages.clear()
+        try:
+            page = timeline.home_timeline(55555, limit=2,
+                                          after=(msgs[0].timestamp, msgs[0].id))
+            self.assertEqual([m.id for m in page], [3002, 3001])
+        finally:
+            timeline.CELEBRITY_FOLLOWERS, timeline.RECENT_PER_AUTHOR = saved
+            timeline.celebrity_ids.clear()
+            timeline.recent_messages.clear()
+
+    def test_crossing_celebrity_threshold_moves_messages(self):
+        """Becoming a celebrity retracts pushed copies; dropping back pushes them."""
+
+        for n in range(2):
+            u = User.signup(username=f"fan{n}",
+                            email=f"fan{n}@test.com",
+                            password="password",
+                            image_url=None)
+            u.id = 55555 + n
+            db.session.add(u)
+        db.session.commit()
+
+        saved = timeline.CELEBRITY_FOLLOWERS
+        timeline.CELEBRITY_FOLLOWERS = 2
+        timeline.celebrity_ids.clear()
+        timeline.recent_messages.clear()
+        try:
+            follows.follow(55555, self.testuser_id)
+            db.session.commit()
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+                c.post("/messages/new", data={"text": "before fame"})
+            msg_id = Message.query.one().id
+
+            def delivered():
+                return sorted(e.user_id for e in TimelineEntry.query
+                              .filter(TimelineEntry.message_id == msg_id))
+
+            self.assertEqual(delivered(), [self.testuser_id, 55555])
+
+            follows.follow(55556, self.testuser_id)
+            db.session.commit()
+            self.assertEqual(delivered(), [self.testuser_id])
+            self.assertEqual([m.id for m in timeline.home_timeline(55555)], [msg_id])
+
+            follows.unfollow(55556, self.testuser_id)
+            db.session.commit()
+            self.assertEqual(delivered(), [self.testuser_id, 55555])
+        finally:
+            timeline.CELEBRITY_FOLLOWERS = saved
+            timeline.celebrity_ids.clear()
+            timeline.recent_messages.clear()
+
+    def test_home_timeline_query_budget(self):
+        """The home page loads authors eagerly instead of once per message."""
+
+        authors = []
+        for n in range(10):
+            u = User.signup(username=f"author{n}",
+                            email=f"author{n}@test.com",
+                            password="password",
+                            image_url=None)
+            u.id = 70000 + n
+            authors.append(u)
+        db.session.add_all(authors)
+        db.session.commit()
+
+        for n in range(10):
+            db.session.add(Follows(user_being_followed_id=70000 + n,
+                                   user_following_id=self.testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            for n in range(10):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = 70000 + n
+                c.post("/messages/new", data={"text": f"post {n}"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@author9", str(resp.data))
+
+    def test_message_fragments_cached(self):
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        author.id = 70000
+        db.session.add(author)
+        db.session.commit()
+        db.session.add(Follows(user_being_followed_id=70000,
+                               user_following_id=self.testuser_id))
+        db.session.commit()
+        fragments.fragments.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 70000
+            c.post("/messages/new", data={"text": "cache me"})
+            msg_id = Message.query.filter_by(text="cache me").one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            self.assertIn("@author", c.get("/").get_data(as_text=True))
+            hits = fragments.fragments.hits
+            self.assertIn("cache me", c.get("/").get_data(as_text=True))
+            self.assertEqual(fragments.fragments.hits, hits + 1)
+
+            # the author's profile edit shows up without waiting for expiry
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 70000
+            c.post("/users/profile", data={"username": "renamed",
+                                           "email": "author@test.com",
+                                           "password": "password"})
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+            self.assertIn("@renamed", c.get("/").get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = 70000
+
+            self.assertIsNotNone(fragments.fragments.peek(msg_id))
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertIsNone(fragments.fragments.peek(msg_id))
+
+    def test_query_budget_exceeded(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            budget = app.view_functions['homepage'].query_budget
+            app.view_functions['homepage'].query_budget = 0
+            try:
+                resp = c.get("/")
+                self.assertEqual(resp.status_code, 500)
+            finally:
+                app.view_functions['homepage'].query_budget = budget
+
+    def test_server_timing_and_slow_query_log(self):
+        sample_rate = app.config['SQL_TIMING_SAMPLE_RATE']
+        slow_ms = app.config['SLOW_QUERY_MS']
+        app.config['SQL_TIMING_SAMPLE_RATE'] = 1
+        app.config['SLOW_QUERY_MS'] = 0
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                with self.assertLogs('warbler.slow_queries') as logged:
+                    resp = c.get("/", headers={"X-Request-ID": "abc123"})
+
+                self.assertEqual(resp.headers["X-Request-ID"], "abc123")
+                self.assertIn("db;dur=", resp.headers["Server-Timing"])
+
+                entry = json.loads(logged.records[0].getMessage())
+                self.assertEqual(entry["request_id"], "abc123")
+                self.assertEqual(entry["endpoint"], "homepage")
+                self.assertEqual(entry["route"], "/")
+                self.assertRegex(entry["call_site"], r"^\w+\.py:\d+ in \w+$")
+        finally:
+            app.config['SQL_TIMING_SAMPLE_RATE'] = sample_rate
+            app.config['SLOW_QUERY_MS'] = slow_ms
+
+    def test_profile_on_request(self):
+        profile_dir = tempfile.mkdtemp()
+        app.config['PROFILE_TOKEN'] = 'sekrit'
+        app.config['PROFILE_DIR'] = profile_dir
+        app.config['PROFILE_INTERVAL_MS'] = 1
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser_id
+
+                resp = c.get("/")
+                self.assertNotIn("X-Profile-File", resp.headers)
+
+                # the client's request id never reaches the file name
+                resp = c.get("/", headers={"X-Profile": "sekrit",
+                                           "X-Request-ID": "../../abc123"})
+                filename = resp.headers["X-Profile-File"]
+                self.assertRegex(filename, r"^homepage-[0-9a-f]{32}\.folded$")
+
+            # written once the request is torn down
+            self.assertEqual(os.listdir(profile_dir), [filename])
+            with open(os.path.join(profile_dir, filename)) as f:
+                for line in f:
+                    stack, count = line.rsplit(" ", 1)
+                    self.assertTrue(int(count) > 0)
+        finally:
+            app.config['PROFILE_TOKEN'] = None
+            shutil.rmtree(profile_dir)
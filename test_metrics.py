@@ -0,0 +1,114 @@
+"""Metrics endpoint tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import metrics
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MetricsTestCase(TestCase):
+    """Test the /metrics scrape endpoint."""
+
+    def setUp(self):
+        User.query.delete()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+        self.testuser_id = self.testuser.id
+
+        self.client = app.test_client()
+        self.metrics_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        shutil.rmtree(self.metrics_dir)
+        app.config['METRICS_TOKEN'] = None
+        app.config['METRICS_DIR'] = None
+        return res
+
+    def test_request_latency_and_caches(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser_id
+
+            c.get("/")
+            c.get("/")
+
+            resp = c.get("/metrics")
+            self.assertEqual(resp.status_code, 200)
+            body = resp.get_data(as_text=True)
+
+        self.assertIn('# TYPE warbler_request_duration_seconds histogram', body)
+        self.assertIn('warbler_request_duration_seconds_bucket'
+                      '{endpoint="homepage",method="GET",le="+Inf"}', body)
+        self.assertIn('warbler_requests_total{endpoint="homepage",method="GET",status="200"}', body)
+        self.assertIn('warbler_cache_hits_total{cache="principals"}', body)
+        self.assertIn('# TYPE warbler_db_pool_wait_seconds histogram', body)
+
+    def test_token_required(self):
+        app.config['METRICS_TOKEN'] = 'sekrit'
+
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 401)
+
+        resp = self.client.get("/metrics", headers={'Authorization': 'Bearer sekrit'})
+        self.assertEqual(resp.status_code, 200)
+
+    def test_aggregates_worker_snapshots(self):
+        app.config['METRICS_DIR'] = self.metrics_dir
+
+        before = metrics.aggregate()
+        served = before.get('warbler_requests_total', {}).get(('homepage', 'GET', '200'), 0)
+
+        # another worker that has since exited
+        other = {
+            'warbler_requests_total': {'samples': [[['homepage', 'GET', '200'], 7]]},
+            'warbler_db_pool_checked_out': {'samples': [[[], 3]]},
+        }
+        with open(os.path.join(self.metrics_dir, '999999999-1.json'), 'w') as f:
+            json.dump(other, f)
+        # an earlier process that had this worker's pid
+        with open(os.path.join(self.metrics_dir, f'{os.getpid()}-1.json'), 'w') as f:
+            json.dump(other, f)
+
+        totals = metrics.aggregate(self.metrics_dir)
+        self.assertEqual(totals['warbler_requests_total'][('homepage', 'GET', '200')],
+                         served + 14)
+        self.assertNotEqual(totals.get('warbler_db_pool_checked_out', {}).get(()), 3)
+
+        # dead workers are folded into one file, and still counted
+        self.assertEqual(sorted(os.listdir(self.metrics_dir)),
+                         ['dead.json', 'metrics.lock'])
+        totals = metrics.aggregate(self.metrics_dir)
+        self.assertEqual(totals['warbler_requests_total'][('homepage', 'GET', '200')],
+                         served + 14)
+
+        self.client.get("/metrics")
+        self.assertTrue(os.path.exists(
+            os.path.join(self.metrics_dir, metrics._own_filename())))
@@ -0,0 +1,111 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect, text
+
+from models import db, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import migrations
+
+db.create_all()
+
+
+class MigrationsTestCase(TestCase):
+    """Test the schema migration runner."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        with db.engine.connect() as connection:
+            connection.execute(text('DROP TABLE IF EXISTS schema_migrations'))
+
+    def tearDown(self):
+        res = super().tearDown()
+        db.session.rollback()
+        return res
+
+    def test_upgrade_applies_everything_once(self):
+        self.assertEqual(len(migrations.pending(db.engine)), len(migrations.MIGRATIONS))
+
+        migrations.upgrade(db.engine, log=lambda line: None)
+        self.assertEqual(migrations.pending(db.engine), [])
+
+        # running again is a no-op
+        migrations.upgrade(db.engine, log=self.fail)
+
+    def test_upgrade_adds_missing_indexes(self):
+        with db.engine.connect() as connection:
+            connection.execute(text('DROP INDEX ix_messages_user_timestamp'))
+
+        migrations.upgrade(db.engine, log=lambda line: None)
+
+        indexes = {ix['name'] for ix in inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_timestamp', indexes)
+
+    def test_upgrade_creates_timeline_entries(self):
+        with db.engine.begin() as connection:
+            connection.execute(text('DROP TABLE timeline_entries'))
+            connection.execute(text('ALTER TABLE users DROP COLUMN messages_count'))
+
+        migrations.upgrade(db.engine, log=lambda line: None)
+
+        inspector = inspect(db.engine)
+        self.assertEqual({col['name'] for col in inspector.get_columns('timeline_entries')},
+                         {'user_id', 'message_id', 'timestamp'})
+        self.assertEqual(
+            set(inspector.get_pk_constraint('timeline_entries')['constrained_columns']),
+            {'user_id', 'message_id'})
+        self.assertIn('ix_timeline_entries_user_timestamp',
+                      {ix['name'] for ix in inspector.get_indexes('timeline_entries')})
+        self.assertIn('messages_count',
+                      {col['name'] for col in inspector.get_columns('users')})
+
+    def test_upgrade_rekeys_likes(self):
+        u1 = User.signup("test1", "test1@test.com", "testpass1", None)
+        u2 = User.signup("test2", "test2@test.com", "testpass2", None)
+        db.session.commit()
+        msg = Message(text="hello", user_id=u1.id)
+        db.session.add(msg)
+        db.session.commit()
+        u1_id, u2_id, msg_id = u1.id, u2.id, msg.id
+
+        # the original table: surrogate id, one like per message
+        with db.engine.begin() as connection:
+            connection.execute(text('DROP TABLE likes'))
+            connection.execute(text(
+                'CREATE TABLE likes ('
+                ' id INTEGER PRIMARY KEY,'
+                ' user_id INTEGER REFERENCES users (id) ON DELETE CASCADE,'
+                ' message_id INTEGER UNIQUE REFERENCES messages (id) ON DELETE CASCADE)'))
+            connection.execute(text(
+                'INSERT INTO likes (user_id, message_id) VALUES (:user_id, :message_id)'),
+                user_id=u2_id, message_id=msg_id)
+
+        migrations.upgrade(db.engine, log=lambda line: None)
+
+        inspector = inspect(db.engine)
+        self.assertEqual(set(inspector.get_pk_constraint('likes')['constrained_columns']),
+                         {'user_id', 'message_id'})
+        self.assertIn('ix_likes_message_user',
+                      {ix['name'] for ix in inspector.get_indexes('likes')})
+        self.assertEqual(db.session.query(Message.likes_count).scalar(), 1)
+
+        # a second user can now like the same message
+        db.session.add(Likes(user_id=u1_id, message_id=msg_id))
+        db.session.commit()
+        self.assertEqual(Likes.query.filter_by(message_id=msg_id).count(), 2)
@@ -0,0 +1,96 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import csv
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from models import db, Follows, Likes, Message, TimelineEntry, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import likes
+import seed
+import timeline
+
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+class SeedTestCase(TestCase):
+    """Test streaming CSV files into a fresh database."""
+
+    def setUp(self):
+        # earlier tests' like counts, not yet written, would land on these ids
+        likes.like_counts._deltas.clear()
+
+        self.directory = tempfile.mkdtemp()
+        self.batches = seed.CHUNK_ROWS, timeline.REBUILD_BATCH
+        seed.CHUNK_ROWS = timeline.REBUILD_BATCH = 2
+
+        write_csv(os.path.join(self.directory, 'users.csv'),
+                  ['id', 'email', 'username', 'image_url', 'header_image_url',
+                   'bio', 'location', 'password'],
+                  [[n, f'user{n}@test.com', f'user{n}', '', '', '', 'Nowhere', 'x' * 60]
+                   for n in range(1, 6)])
+        write_csv(os.path.join(self.directory, 'messages.csv'),
+                  ['id', 'text', 'timestamp', 'user_id'],
+                  [[n, f'message {n}', f'2020-01-0{n} 10:00:00.000000', n % 2 + 1]
+                   for n in range(1, 6)])
+        write_csv(os.path.join(self.directory, 'follows.csv'),
+                  ['user_being_followed_id', 'user_following_id'],
+                  [[1, 3], [2, 3], [1, 4]])
+        write_csv(os.path.join(self.directory, 'likes.csv'),
+                  ['user_id', 'message_id'],
+                  [[3, 1], [4, 1], [3, 2]])
+
+    def tearDown(self):
+        seed.CHUNK_ROWS, timeline.REBUILD_BATCH = self.batches
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+        db.session.remove()
+
+    def test_seed(self):
+        progress = []
+        seed.seed(self.directory, log=progress.append)
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 5)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual(Likes.query.count(), 3)
+        self.assertIn("messages: 4 rows", " ".join(progress))
+
+        # defaults fill in what the files leave out
+        user = User.query.get(1)
+        self.assertEqual(user.profile_version, 1)
+        self.assertIsNone(user.bio)
+
+        # counters and timelines are built from the loaded rows
+        self.assertEqual(user.followers_count, 2)
+        self.assertEqual(User.query.get(3).likes_count, 2)
+        self.assertEqual(Message.query.get(1).likes_count, 2)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=3).count(), 5)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=4).count(), 2)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=1).count(), 2)
+
+        # deferred indexes are back
+        names = {index['name'] for index in inspect(db.engine).get_indexes('follows')}
+        self.assertIn('ix_follows_user_following', names)
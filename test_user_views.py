@@ -5,10 +5,13 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+from datetime import timedelta
 import os
+from threading import BoundedSemaphore, Event, Thread
+import time
 from unittest import TestCase
 from bs4 import BeautifulSoup
-from models import db, Message, User, Likes, Follows
+from models import db, Message, User, Likes, Follows, Recommendation
 
 
 # BEFORE we import our app, let's set an environmental variable
@@ -22,6 +25,14 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+import counters
+import typeahead
+import directory
+import graph
+import likes
+import passwords
+import principal
+import recommendations
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -33,6 +44,10 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any view that goes over its declared SQL query budget
+
+app.config['QUERY_BUDGET_MODE'] = 'raise'
+
 
 class UserViewTestCase(TestCase):
     """test views for users"""
@@ -40,6 +55,7 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        graph.reset()
         db.drop_all()
         db.create_all()
 
@@ -63,6 +79,7 @@ class UserViewTestCase(TestCase):
         db.session.add_all([self.user1, self.user2, self.user3, self.user4, self.user5])
 
         db.session.commit()
+        graph.load()
 
 
     def tearDown(self):
@@ -115,6 +132,26 @@ class UserViewTestCase(TestCase):
         db.session.add(like1)
         db.session.commit()
 
+    def test_user_show_conditional_get(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+
+            etag = c.get(f"/users/{self.user1_id}").headers["ETag"]
+            resp = c.get(f"/users/{self.user1_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # a new message changes the page, for everyone
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            c.post("/messages/new", data={"text": "fresh"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+            resp = c.get(f"/users/{self.user1_id}", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("fresh", resp.get_data(as_text=True))
+
     def test_user_show_with_likes(self):
         self.setup_likes()
 
@@ -191,6 +228,72 @@ class UserViewTestCase(TestCase):
             # The number of likes has not changed since making the request
             self.assertEqual(like_count, Likes.query.count())
 
+    def test_toggle_like_json(self):
+        msg = Message(id=5555, text="hhhhhhhhhhhhhhh", user_id=self.user2_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            headers = {"Accept": "application/json"}
+            resp = c.post("/messages/5555/like", headers=headers)
+            self.assertEqual(resp.get_json(), {"liked": True})
+            self.assertEqual(User.query.get(self.user1_id).likes_count, 1)
+
+            resp = c.post("/messages/5555/like", headers=headers)
+            self.assertEqual(resp.get_json(), {"liked": False})
+            self.assertEqual(User.query.get(self.user1_id).likes_count, 0)
+
+    def test_put_and_delete_like_are_idempotent(self):
+        msg = Message(id=5555, text="hhhhhhhhhhhhhhh", user_id=self.user2_id)
+        own = Message(id=6666, text="mine", user_id=self.user1_id)
+        db.session.add_all([msg, own])
+        db.session.commit()
+
+        with self.client as c:
+            self.assertEqual(c.put("/messages/5555/like").status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            for _ in range(2):
+                self.assertEqual(c.put("/messages/5555/like").status_code, 204)
+            self.assertEqual(Likes.query.filter_by(message_id=5555).count(), 1)
+            self.assertEqual(User.query.get(self.user1_id).likes_count, 1)
+
+            for _ in range(2):
+                self.assertEqual(c.delete("/messages/5555/like").status_code, 204)
+            self.assertEqual(Likes.query.filter_by(message_id=5555).count(), 0)
+            self.assertEqual(User.query.get(self.user1_id).likes_count, 0)
+
+            self.assertEqual(c.put("/messages/6666/like").status_code, 403)
+            self.assertEqual(c.put("/messages/7777/like").status_code, 404)
+
+    def test_many_users_like_one_message(self):
+        likes.like_counts._deltas.clear()
+        msg = Message(id=5555, text="popular", user_id=self.user3_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            for user_id in (self.user1_id, self.user2_id):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                self.assertEqual(c.put("/messages/5555/like").status_code, 204)
+
+        self.assertEqual(Likes.query.filter_by(message_id=5555).count(), 2)
+
+        # the per-message count is written in batches
+        with app.app_context():
+            likes.like_counts.flush()
+        self.assertEqual(db.session.query(Message.likes_count)
+                         .filter_by(id=5555).scalar(), 2)
+
+        resp = self.client.get(f"/users/{self.user3_id}")
+        self.assertIn('<i class="fa fa-thumbs-up"></i> 2', resp.data.decode())
+
     def setup_followers(self):
         f1 = Follows(user_being_followed_id=self.user2_id, user_following_id=self.user1_id)
         f2 = Follows(user_being_followed_id=self.user3_id, user_following_id=self.user1_id)
@@ -271,5 +374,598 @@ class UserViewTestCase(TestCase):
             self.assertNotIn("@test2", str(resp.data))
             self.assertIn("Access unauthorized", str(resp.data))
 
-    
+    def test_user_show_pagination(self):
+        texts = [f"warble number {n}" for n in range(5)]
+        db.session.add_all([Message(text=text, user_id=self.user1_id) for text in texts])
+        db.session.commit()
+
+        page_size = app.config['TIMELINE_PAGE_SIZE']
+        app.config['TIMELINE_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                seen = []
+                url = f"/users/{self.user1_id}"
+                while url:
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200)
+                    soup = BeautifulSoup(resp.data, 'html.parser')
+                    seen.extend(p.text for p in soup.select("#messages p"))
+                    older = soup.find("a", string="Older")
+                    url = older and older["href"]
+        finally:
+            app.config['TIMELINE_PAGE_SIZE'] = page_size
+
+        self.assertEqual(sorted(seen), texts)
+
+    def test_following_pagination(self):
+        self.setup_followers()
+        page_size = app.config['USERS_PAGE_SIZE']
+        app.config['USERS_PAGE_SIZE'] = 1
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+
+                resp = c.get(f"/users/{self.user1_id}/following")
+                self.assertIn("@test3", str(resp.data))
+                self.assertNotIn("@test2", str(resp.data))
+
+                resp = c.get(f"/users/{self.user1_id}/following?before={self.user3_id}")
+                self.assertIn("@test2", str(resp.data))
+                self.assertNotIn("@test3", str(resp.data))
+
+                resp = c.get(f"/users/{self.user1_id}/following?after={self.user2_id}")
+                self.assertIn("@test3", str(resp.data))
+                self.assertNotIn("@test2", str(resp.data))
+        finally:
+            app.config['USERS_PAGE_SIZE'] = page_size
+
+    def test_bad_cursor(self):
+        with self.client as c:
+            resp = c.get(f"/users/{self.user1_id}?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_counters_follow_routes(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post(f"/users/follow/{self.user2_id}")
+            c.post("/messages/new", data={"text": "counted"})
 
+            user1 = User.query.get(self.user1_id)
+            user2 = User.query.get(self.user2_id)
+            self.assertEqual(user1.following_count, 1)
+            self.assertEqual(user1.messages_count, 1)
+            self.assertEqual(user2.followers_count, 1)
+
+            c.post(f"/users/stop-following/{self.user2_id}")
+
+            user1 = User.query.get(self.user1_id)
+            user2 = User.query.get(self.user2_id)
+            self.assertEqual(user1.following_count, 0)
+            self.assertEqual(user2.followers_count, 0)
+
+    def test_follow_routes_are_idempotent(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.post(f"/users/follow/{self.user2_id}")
+            c.post(f"/users/follow/{self.user2_id}")
+            self.assertEqual(Follows.query.filter_by(user_following_id=self.user1_id).count(), 1)
+            self.assertEqual(User.query.get(self.user2_id).followers_count, 1)
+
+            self.assertEqual(c.post("/users/follow/9999").status_code, 404)
+
+            c.post(f"/users/stop-following/{self.user2_id}")
+            resp = c.post(f"/users/stop-following/{self.user2_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.user2_id).followers_count, 0)
+
+            # unfollowing someone who doesn't exist is a no-op, not an error
+            resp = c.post("/users/stop-following/9999")
+            self.assertEqual(resp.status_code, 302)
+
+    def test_bulk_follow(self):
+        self.setup_followers()
+        msg = Message(text="backfilled", user_id=self.user3_id)
+        db.session.add(msg)
+        db.session.commit()
+        abcd_id = User.query.filter_by(username="abcd").one().id
+
+        with self.client as c:
+            resp = c.post("/users/follow/bulk", json={"user_ids": [self.user3_id]})
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user2_id
+
+            resp = c.post("/users/follow/bulk", json={
+                "user_ids": [self.user1_id, self.user3_id, 9999],
+                "usernames": ["abcd", "test2", "nobody"],
+            })
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {
+                "followed": sorted([self.user3_id, abcd_id]),
+                "already_following": 1,
+                "not_found": [9999, "nobody"],
+            })
+
+            user2 = User.query.get(self.user2_id)
+            self.assertEqual(user2.following_count, 3)
+            self.assertEqual(User.query.get(self.user3_id).followers_count, 2)
+
+            # the new follows' messages show up on the home timeline
+            self.assertIn("backfilled", c.get("/").data.decode())
+
+            resp = c.post("/users/follow/bulk", json={"user_ids": ["1111"]})
+            self.assertEqual(resp.status_code, 400)
+
+            # JSON true is an int to Python, but not a user id
+            resp = c.post("/users/follow/bulk", json={"user_ids": [True]})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_profile_shows_known_followers(self):
+        abcd_id = User.query.filter_by(username="abcd").one().id
+        db.session.add_all([
+            Follows(user_following_id=self.user1_id, user_being_followed_id=self.user2_id),
+            Follows(user_following_id=self.user1_id, user_being_followed_id=self.user3_id),
+            Follows(user_following_id=self.user2_id, user_being_followed_id=abcd_id),
+            Follows(user_following_id=self.user3_id, user_being_followed_id=abcd_id),
+            Follows(user_following_id=abcd_id, user_being_followed_id=self.user1_id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            soup = BeautifulSoup(c.get(f"/users/{abcd_id}").data, 'html.parser')
+            known = soup.find(id="known-followers")
+            self.assertEqual([a.text for a in known.find_all("a")], ["@test2", "@test3"])
+            self.assertIn("Follows you", soup.text)
+
+            # following back is reflected straight away
+            c.post(f"/users/follow/{abcd_id}")
+            self.assertIn("You follow each other", c.get(f"/users/{abcd_id}").data.decode())
+
+    def test_relationships_from_sql_until_graph_loads(self):
+        abcd_id = User.query.filter_by(username="abcd").one().id
+        db.session.add_all([
+            Follows(user_following_id=self.user1_id, user_being_followed_id=self.user2_id),
+            Follows(user_following_id=self.user2_id, user_being_followed_id=abcd_id),
+            Follows(user_following_id=abcd_id, user_being_followed_id=self.user1_id),
+        ])
+        db.session.commit()
+        graph.reset()
+
+        # the SQL stand-in costs a few queries more than the loaded graph
+        app.config['QUERY_BUDGET_MODE'] = None
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+
+                soup = BeautifulSoup(c.get(f"/users/{abcd_id}").data, 'html.parser')
+                known = soup.find(id="known-followers")
+                self.assertEqual([a.text for a in known.find_all("a")], ["@test2"])
+                self.assertIn("Follows you", soup.text)
+        finally:
+            app.config['QUERY_BUDGET_MODE'] = 'raise'
+            graph.reset()
+
+    def test_follow_suggestions(self):
+        abcd_id = User.query.filter_by(username="abcd").one().id
+        efgh_id = User.query.filter_by(username="efgh").one().id
+        db.session.add_all([
+            Follows(user_following_id=self.user1_id, user_being_followed_id=self.user2_id),
+            Follows(user_following_id=self.user1_id, user_being_followed_id=self.user3_id),
+            Follows(user_following_id=self.user2_id, user_being_followed_id=abcd_id),
+            Follows(user_following_id=self.user3_id, user_being_followed_id=abcd_id),
+            Follows(user_following_id=self.user2_id, user_being_followed_id=efgh_id),
+            Follows(user_following_id=self.user2_id, user_being_followed_id=self.user1_id),
+        ])
+        db.session.commit()
+
+        def suggested(c, url="/"):
+            panel = BeautifulSoup(c.get(url).data, 'html.parser').find(id="who-to-follow")
+            if panel is None:
+                return []
+            return [li.find("a", href=True).get("href") for li in panel.find_all("li")]
+
+        # marked stale in the same second the graph is read; no slack, so
+        # the test needn't wait for the marks to settle
+        slack = recommendations.CLOCK_SLACK
+        recommendations.CLOCK_SLACK = timedelta(0)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+
+                # nothing stored yet: the worker computes everyone's
+                self.assertEqual(suggested(c), [])
+                with app.app_context():
+                    self.assertEqual(recommendations.refresh_stale(), 5)
+
+                self.assertEqual(suggested(c), [f"/users/{abcd_id}", f"/users/{efgh_id}"])
+                self.assertEqual(suggested(c, f"/users/{self.user2_id}"),
+                                 [f"/users/{abcd_id}", f"/users/{efgh_id}"])
+
+                # following a suggestion hides it at once and marks the
+                # follower's row, and their followers', for recomputing
+                c.post(f"/users/follow/{abcd_id}")
+                self.assertEqual(suggested(c), [f"/users/{efgh_id}"])
+                stale = {rec.user_id for rec in Recommendation.query.filter_by(stale=True)}
+                self.assertEqual(stale, {self.user1_id, self.user2_id})
+
+                # a graph read before the follow can't clear the marks
+                with app.app_context():
+                    as_of, follow_graph = recommendations.snapshot()
+                c.post(f"/users/follow/{efgh_id}")
+                with app.app_context():
+                    marked = [self.user1_id, self.user2_id]
+                    self.assertEqual(recommendations.refresh(marked, follow_graph, as_of), 2)
+                    db.session.commit()
+                    self.assertEqual(recommendations.refresh_stale(
+                        follow_graph=follow_graph, as_of=as_of), 0)
+                stale = {rec.user_id for rec in Recommendation.query.filter_by(stale=True)}
+                self.assertEqual(stale, {self.user1_id, self.user2_id})
+
+                with app.app_context():
+                    self.assertEqual(recommendations.refresh_stale(), 2)
+                self.assertEqual(Recommendation.query.filter_by(stale=True).count(), 0)
+                self.assertEqual(suggested(c), [])
+        finally:
+            recommendations.CLOCK_SLACK = slack
+
+    def test_follow_graph_overlay(self):
+        follow_graph = graph.FollowGraph()
+        follow_graph.load([(1, 2), (1, 3), (2, 3)], [(2, 1), (3, 1), (3, 2)])
+
+        self.assertTrue(follow_graph.follows(1, 3))
+        self.assertFalse(follow_graph.follows(3, 1))
+
+        follow_graph.add(3, 1)
+        follow_graph.remove(1, 2)
+        self.assertTrue(follow_graph.mutual(1, 3))
+        self.assertFalse(follow_graph.follows(1, 2))
+        self.assertEqual(list(follow_graph.following(1)), [3])
+        self.assertEqual(list(follow_graph.followers(1)), [3])
+        self.assertEqual(follow_graph.followed_by_following(2, 1), [3])
+        self.assertEqual(follow_graph.overlay_size(), 2)
+
+        # undoing a change drops it from the overlay
+        follow_graph.add(1, 2)
+        self.assertEqual(follow_graph.overlay_size(), 1)
+        self.assertEqual(list(follow_graph.following(1)), [2, 3])
+
+        self.assertEqual(graph.intersect([1, 5, 9], range(0, 100, 3)), [9])
+
+    def test_follow_graph_snapshot_and_change_log(self):
+        db.session.add_all([
+            Follows(user_following_id=self.user1_id, user_being_followed_id=self.user2_id),
+            Follows(user_following_id=self.user3_id, user_being_followed_id=self.user2_id),
+        ])
+        db.session.commit()
+        follow_graph = graph.rebuild()
+        self.assertEqual(follow_graph.overlay_size(), 0)
+
+        # what every worker maps
+        directory = graph._directory()
+        _, _, following, followers = graph._map_snapshot(
+            os.path.join(directory, graph.SNAPSHOT_FILE))
+        self.assertEqual(list(followers.neighbours(self.user2_id)),
+                         [self.user1_id, self.user3_id])
+        self.assertTrue(following.has(self.user3_id, self.user2_id))
+        self.assertFalse(following.has(self.user2_id, self.user3_id))
+
+        # this worker's commits are replayed at once...
+        db.session.add(Follows(user_following_id=self.user2_id,
+                               user_being_followed_id=self.user1_id))
+        db.session.commit()
+        self.assertTrue(graph.graph().mutual(self.user1_id, self.user2_id))
+
+        # ...and another worker's on the next sync
+        graph._append(directory, [(self.user1_id, self.user2_id, False)])
+        self.assertFalse(graph.load().follows(self.user1_id, self.user2_id))
+        self.assertEqual(list(follow_graph.followers(self.user2_id)), [self.user3_id])
+        self.assertEqual(follow_graph.overlay_size(), 2)
+
+    def test_reconcile_counters(self):
+        self.setup_followers()
+        User.query.update({User.followers_count: 42, User.likes_count: 7})
+        db.session.commit()
+
+        self.assertEqual(counters.reconcile(), 5)
+        db.session.commit()
+
+        user1 = User.query.get(self.user1_id)
+        self.assertEqual(user1.followers_count, 1)
+        self.assertEqual(user1.following_count, 2)
+        self.assertEqual(user1.likes_count, 0)
+
+    def test_users_search_ranking(self):
+        self.user4.bio = "just another test account"
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=test2")
+            self.assertIn("@test2", str(resp.data))
+            self.assertNotIn("@test1", str(resp.data))
+
+            # bio matches are found, but rank below username matches
+            resp = c.get("/users?q=test")
+            html = resp.data.decode()
+            self.assertIn("@abcd", html)
+            self.assertLess(html.index("@test1"), html.index("@abcd"))
+
+    def test_users_search_escapes_wildcards(self):
+        with self.client as c:
+            resp = c.get("/users?q=%25")
+            self.assertIn("Sorry, no users found", str(resp.data))
+
+    def test_autocomplete(self):
+        typeahead._loaded_at = None
+        self.setup_followers()
+        db.session.add(Follows(user_being_followed_id=self.user2_id,
+                               user_following_id=self.user3_id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users/autocomplete?q=TE")
+            names = [u["username"] for u in resp.get_json()["users"]]
+
+            # most-followed first; abcd/efgh don't match the prefix
+            self.assertEqual(names[0], "test2")
+            self.assertEqual(sorted(names), ["test1", "test2", "test3"])
+
+            # signups show up once committed
+            User.signup("tester", "tester@test.com", "password", None)
+            db.session.commit()
+
+            resp = c.get("/users/autocomplete?q=teste")
+            names = [u["username"] for u in resp.get_json()["users"]]
+            self.assertEqual(names, ["tester"])
+
+    def test_autocomplete_cache_survives_unrelated_saves(self):
+        typeahead._loaded_at = None
+
+        with self.client as c:
+            c.get("/users/autocomplete?q=t")
+            cached = typeahead.index._top["te"]
+
+            # a password rehash changes none of the indexed fields
+            user1 = User.query.get(self.user1_id)
+            user1.password = user1.password + "x"
+            db.session.commit()
+            self.assertIs(typeahead.index._top["te"], cached)
+
+            # a new username only touches its own prefixes
+            ab = typeahead.index._top["ab"]
+            User.signup("tester", "tester@test.com", "password", None)
+            db.session.commit()
+            self.assertIs(typeahead.index._top["ab"], ab)
+            self.assertIn("tester", [u["username"] for u in
+                                     c.get("/users/autocomplete?q=te").get_json()["users"]])
+
+    def test_users_directory_pagination(self):
+        directory.invalidate()
+        page_size = app.config['USERS_PAGE_SIZE']
+        app.config['USERS_PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                resp = c.get("/users")
+                html = resp.data.decode()
+                self.assertIn("5 users", html)
+                self.assertIn("@abcd", html)
+                self.assertIn("@efgh", html)
+                self.assertNotIn("@test1", html)
+
+                resp = c.get("/users?after=efgh")
+                html = resp.data.decode()
+                self.assertIn("@test1", html)
+                self.assertIn("@test2", html)
+                self.assertNotIn("@efgh", html)
+        finally:
+            app.config['USERS_PAGE_SIZE'] = page_size
+
+    def test_users_directory_cache_invalidated_on_signup(self):
+        directory.invalidate()
+        with self.client as c:
+            self.assertIn("5 users", c.get("/users").data.decode())
+
+            User.signup("aaaa", "aaaa@test.com", "password", None)
+            db.session.commit()
+
+            html = c.get("/users").data.decode()
+            self.assertIn("6 users", html)
+            self.assertIn("@aaaa", html)
+
+    def test_users_index_follow_buttons(self):
+        self.setup_followers()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            soup = BeautifulSoup(c.get("/users").data, 'html.parser')
+            unfollow = {form["action"] for form in soup.select("form")
+                        if "stop-following" in form.get("action", "")}
+            self.assertEqual(unfollow, {f"/users/stop-following/{self.user2_id}",
+                                        f"/users/stop-following/{self.user3_id}"})
+
+            # unfollowing is reflected on the next page view
+            c.post(f"/users/stop-following/{self.user2_id}")
+            soup = BeautifulSoup(c.get("/users").data, 'html.parser')
+            unfollow = {form["action"] for form in soup.select("form")
+                        if "stop-following" in form.get("action", "")}
+            self.assertEqual(unfollow, {f"/users/stop-following/{self.user3_id}"})
+
+    def test_principal_cached_and_refreshed_on_edit(self):
+        principal.principals.clear()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            c.get("/")
+            self.assertEqual(principal.principals.peek(self.user1_id).username, "test1")
+
+            # posting a message updates the cached counters
+            c.post("/messages/new", data={"text": "hello"})
+            self.assertIn(">1</a>", c.get("/").data.decode())
+
+            resp = c.post("/users/profile", data={"username": "renamed",
+                                                  "email": "test1@test.com",
+                                                  "password": "testpass1"})
+            self.assertEqual(resp.status_code, 302)
+
+            with c.session_transaction() as sess:
+                self.assertEqual(sess["curr_user_version"], 2)
+
+            self.assertIn("@renamed", c.get("/").data.decode())
+
+            # another worker's copy predates the edit
+            stale = principal.principals.peek(self.user1_id)._replace(
+                username="test1", profile_version=1)
+            principal.principals.set(self.user1_id, stale)
+            self.assertIn("@renamed", c.get("/").data.decode())
+
+    def test_login_rehashes_outdated_password(self):
+        old_hash = User.query.get(self.user1_id).password
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        try:
+            resp = self.client.post("/login", data={"username": "test1",
+                                                    "password": "testpass1"})
+            self.assertEqual(resp.status_code, 302)
+        finally:
+            del app.config['BCRYPT_LOG_ROUNDS']
+
+        new_hash = User.query.get(self.user1_id).password
+        self.assertNotEqual(new_hash, old_hash)
+        self.assertTrue(new_hash.startswith("$2b$04$"))
+        self.assertTrue(User.authenticate("test1", "testpass1"))
+
+    def test_login_throttled_after_failures(self):
+        passwords.attempts._failures.clear()
+        ip = {"REMOTE_ADDR": "10.0.0.1"}
+        for _ in range(5):
+            resp = self.client.post("/login", data={"username": "test2", "password": "wrongpass"},
+                                    environ_base=ip)
+            self.assertEqual(resp.status_code, 200)
+
+        # the right password no longer gets checked, for this username...
+        resp = self.client.post("/login", data={"username": "test2", "password": "testpass2"},
+                                environ_base=ip)
+        self.assertEqual(resp.status_code, 429)
+
+        # ...but other users can still log in
+        resp = self.client.post("/login", data={"username": "test3", "password": "testpass3"},
+                                environ_base=ip)
+        self.assertEqual(resp.status_code, 302)
+
+    def test_login_throttle_keyed_on_forwarded_client(self):
+        passwords.attempts._failures.clear()
+        app.config['TRUSTED_PROXIES'] = 1
+        proxy = {"REMOTE_ADDR": "10.0.0.1"}
+        try:
+            for n in range(20):
+                resp = self.client.post(
+                    "/login", data={"username": f"nobody{n}", "password": "wrongpass"},
+                    environ_base=proxy,
+                    headers={"X-Forwarded-For": "spoofed, 203.0.113.7"})
+                self.assertEqual(resp.status_code, 200)
+
+            resp = self.client.post(
+                "/login", data={"username": "test1", "password": "testpass1"},
+                environ_base=proxy, headers={"X-Forwarded-For": "203.0.113.7"})
+            self.assertEqual(resp.status_code, 429)
+
+            # other clients behind the same proxy are unaffected
+            resp = self.client.post(
+                "/login", data={"username": "test1", "password": "testpass1"},
+                environ_base=proxy, headers={"X-Forwarded-For": "198.51.100.9"})
+            self.assertEqual(resp.status_code, 302)
+        finally:
+            del app.config['TRUSTED_PROXIES']
+
+    def test_login_failures_kept_for_configured_window(self):
+        passwords.attempts._failures.clear()
+        app.config['LOGIN_FAILURE_WINDOW'] = 60 * 60
+        try:
+            with app.app_context():
+                passwords.attempts.failed("test1", "10.0.0.1")
+            _, expires = passwords.attempts._failures._data[('username', 'test1')]
+            self.assertGreater(expires - time.monotonic(), 59 * 60)
+        finally:
+            del app.config['LOGIN_FAILURE_WINDOW']
+
+    def test_profile_password_success_clears_failures(self):
+        passwords.attempts._failures.clear()
+        principal.principals.clear()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            for _ in range(4):
+                c.post("/users/profile", data={"username": "test1",
+                                               "email": "test1@test.com",
+                                               "password": "wrongpass"})
+            resp = c.post("/users/profile", data={"username": "test1",
+                                                  "email": "test1@test.com",
+                                                  "password": "testpass1"})
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.post("/users/profile", data={"username": "test1",
+                                                  "email": "test1@test.com",
+                                                  "password": "wrongpass"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(passwords.attempts.blocked("test1", "127.0.0.1"))
+
+    def test_login_when_hash_pool_busy(self):
+        slots = passwords.hasher._slots
+        passwords.hasher._slots = BoundedSemaphore(1)
+        passwords.hasher._slots.acquire()
+        try:
+            resp = self.client.post("/login", data={"username": "test1",
+                                                    "password": "testpass1"})
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "1")
+        finally:
+            passwords.hasher._slots = slots
+
+    def test_login_sheds_load_with_threaded_worker(self):
+        """Concurrent requests in one process, as under gunicorn --threads."""
+
+        hasher, checkpw = passwords.hasher, passwords.bcrypt.checkpw
+        started, release = Event(), Event()
+
+        def slow_checkpw(password, hashed):
+            started.set()
+            release.wait(10)
+            return checkpw(password, hashed)
+
+        passwords.hasher = passwords.Hasher()
+        passwords.bcrypt.checkpw = slow_checkpw
+        app.config['PASSWORD_HASH_WORKERS'] = 1
+        app.config['PASSWORD_HASH_QUEUE'] = 0
+        statuses = []
+
+        def login():
+            resp = app.test_client().post("/login", data={"username": "test1",
+                                                         "password": "testpass1"})
+            statuses.append(resp.status_code)
+
+        first = Thread(target=login)
+        try:
+            first.start()
+            self.assertTrue(started.wait(10))
+            resp = self.client.post("/login", data={"username": "test2",
+                                                    "password": "testpass2"})
+            self.assertEqual(resp.status_code, 503)
+        finally:
+            release.set()
+            first.join(10)
+            passwords.hasher, passwords.bcrypt.checkpw = hasher, checkpw
+            del app.config['PASSWORD_HASH_WORKERS']
+            del app.config['PASSWORD_HASH_QUEUE']
+        self.assertEqual(statuses, [302])
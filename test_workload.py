@@ -0,0 +1,95 @@
+"""Synthetic workload generator tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_workload.py
+
+
+from collections import Counter
+from datetime import timedelta
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+import seed
+import workload
+
+
+class WorkloadTestCase(TestCase):
+    """Test the generated data's shape and loading it."""
+
+    def setUp(self):
+        self.workload = workload.Workload(users=2000, messages=5000, seed=7)
+
+    def tearDown(self):
+        db.session.rollback()
+        db.session.remove()
+
+    def test_reproducible(self):
+        again = workload.Workload(users=2000, messages=5000, seed=7)
+        other = workload.Workload(users=2000, messages=5000, seed=8)
+
+        self.assertEqual(list(self.workload.follows_rows()), list(again.follows_rows()))
+        self.assertEqual(list(self.workload.messages_rows()), list(again.messages_rows()))
+        self.assertNotEqual(list(self.workload.likes_rows()), list(other.likes_rows()))
+
+    def test_shape(self):
+        follows = list(self.workload.follows_rows())[1:]
+        self.assertEqual(len(set(map(tuple, follows))), len(follows))
+        self.assertFalse([row for row in follows if row[0] == row[1]])
+
+        # a few celebrities hold a large share of all follows
+        in_degree = Counter(followed_id for followed_id, _ in follows)
+        top = sum(count for _, count in in_degree.most_common(20))
+        self.assertGreater(top / len(follows), 0.25)
+        self.assertEqual(in_degree.most_common(1)[0][0], 1)
+
+        messages = list(self.workload.messages_rows())[1:]
+        self.assertEqual(len(messages), 5000)
+        timestamps = [row[2] for row in messages]
+        self.assertEqual(timestamps, sorted(timestamps))
+        start = str(workload.END - timedelta(days=self.workload.days))
+        self.assertGreaterEqual(timestamps[0], start)
+        self.assertLess(timestamps[-1], str(workload.END))
+        self.assertTrue(all(1 <= row[3] <= 2000 for row in messages))
+
+        # the heaviest poster isn't the biggest celebrity, and depends on the seed
+        posters = Counter(row[3] for row in messages)
+        self.assertNotEqual(posters.most_common(1)[0][0], 1)
+        other = workload.Workload(users=2000, messages=5000, seed=8)
+        self.assertNotEqual(Counter(row[3] for row in list(other.messages_rows())[1:])
+                            .most_common(1)[0][0], posters.most_common(1)[0][0])
+
+        likes = list(self.workload.likes_rows())[1:]
+        self.assertEqual(len(set(map(tuple, likes))), len(likes))
+        self.assertTrue(all(1 <= message_id <= 5000 for _, message_id in likes))
+        authors = {row[0]: row[3] for row in messages}
+        self.assertFalse([row for row in likes if authors[row[1]] == row[0]])
+
+    def test_write_and_load(self):
+        directory = tempfile.mkdtemp()
+        try:
+            workload.write_csv(self.workload, directory, compress=True, log=lambda m: None)
+            self.assertTrue(os.path.exists(os.path.join(directory, 'likes.csv.gz')))
+
+            seed.seed(directory, log=lambda m: None)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(User.query.count(), 2000)
+        self.assertEqual(Message.query.count(), 5000)
+        self.assertEqual(Follows.query.count(), len(list(self.workload.follows_rows())) - 1)
+        self.assertEqual(Likes.query.count(), len(list(self.workload.likes_rows())) - 1)
+        self.assertEqual(User.query.get(1).followers_count,
+                         Follows.query.filter_by(user_being_followed_id=1).count())
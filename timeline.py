@@ -0,0 +1,492 @@
+"""Materialized home timelines for Warbler.
+
+Every user has a list of (message_id, timestamp) rows in the
+`timeline_entries` table. Posting a message pushes it into the timeline of
+the author and of each of their followers; following, unfollowing and
+deleting keep those rows in step. The home page is then a single indexed
+range read instead of an IN (...) over everyone the user follows.
+
+A timeline keeps only its newest TIMELINE_LIMIT entries, so the table is
+bounded by users x TIMELINE_LIMIT rather than followers x history; paging
+past them ends the home timeline. Posting doesn't trim (that would touch
+every follower's rows per post); `flask trim-timelines`, run
+periodically, does, a batch of users at a time. Following trims the
+follower's timeline after backfilling it, and `rebuild` copies at most
+BACKFILL_LIMIT messages per followed author, a batch of followers per
+transaction.
+
+Pushing is skipped for "celebrities" (authors with at least
+CELEBRITY_FOLLOWERS followers), since one post would mean millions of
+rows. Their messages are pulled at read time instead, from a per-author
+cache of their most recent message ids, and k-way merged with the pushed
+entries.
+
+Whether an author is pushed is decided from their followers_count when
+writing, so a post always goes the way the database says. When a follow
+or unfollow moves an author across CELEBRITY_FOLLOWERS, `reclassify`
+moves their messages over too: a new celebrity's pushed copies are
+retracted, and a former celebrity's recent messages are pushed to every
+follower. Other workers go on pulling by their cached celebrity set for
+up to its TTL; their readers may miss a new celebrity's messages until
+then, but nothing is lost.
+"""
+
+from collections import deque
+import heapq
+from itertools import islice
+
+from sqlalchemy import and_, event, exists, func, literal, or_, select, true, tuple_
+from sqlalchemy.orm import joinedload, Session
+
+from cache import LRUCache
+from models import db, Follows, Message, TimelineEntry, User
+from pagination import beyond, seek
+
+# How many of a newly-followed user's messages get copied into the
+# follower's timeline.
+BACKFILL_LIMIT = 100
+
+# Entries kept per home timeline, and users trimmed or rebuilt per batch.
+TIMELINE_LIMIT = 800
+TRIM_BATCH = 1000
+REBUILD_BATCH = 1000
+
+# Authors with at least this many followers are pulled, not pushed.
+CELEBRITY_FOLLOWERS = 10000
+
+# How many (timestamp, message_id) pairs are kept per author.
+RECENT_PER_AUTHOR = 200
+
+recent_messages = LRUCache('recent_messages', maxsize=10000, ttl=60)
+celebrity_ids = LRUCache('celebrity_ids', maxsize=1, ttl=300)
+
+entries = TimelineEntry.__table__
+messages = Message.__table__
+follows = Follows.__table__
+
+users = User.__table__
+
+_COLUMNS = ['user_id', 'message_id', 'timestamp']
+
+
+def _pushed(author_id):
+    """SQL for "`author_id` is below CELEBRITY_FOLLOWERS", for write paths."""
+
+    return exists().where(and_(users.c.id == author_id,
+                               users.c.followers_count < CELEBRITY_FOLLOWERS))
+
+
+def celebrities():
+    """Return the set of user ids whose messages are pulled, not pushed."""
+
+    def load():
+        rows = (db.session
+                .query(User.id)
+                .filter(User.followers_count >= CELEBRITY_FOLLOWERS))
+        return frozenset(user_id for (user_id,) in rows)
+
+    return celebrity_ids.get_or_load('all', load)
+
+
+def recent(author_id):
+    """Return the newest (timestamp, message_id) pairs for an author, newest first."""
+
+    def load():
+        rows = (db.session
+                .query(Message.timestamp, Message.id)
+                .filter(Message.user_id == author_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(RECENT_PER_AUTHOR))
+        return deque((tuple(row) for row in rows), maxlen=RECENT_PER_AUTHOR)
+
+    return recent_messages.get_or_load(author_id, load)
+
+
+def fan_out(msg):
+    """Push a freshly-flushed message into its author's and followers' timelines.
+
+    Celebrity messages only go to the author's own timeline and their
+    recent-messages buffer; followers pull them when reading.
+    """
+
+    _buffer(msg.user_id, (msg.timestamp, msg.id))
+
+    db.session.execute(entries.insert().values(
+        user_id=msg.user_id, message_id=msg.id, timestamp=msg.timestamp))
+
+    recipients = (select([follows.c.user_following_id,
+                          literal(msg.id),
+                          literal(msg.timestamp)])
+                  .where(and_(follows.c.user_being_followed_id == msg.user_id,
+                              follows.c.user_following_id != msg.user_id,
+                              _pushed(msg.user_id))))
+
+    db.session.execute(entries.insert().from_select(_COLUMNS, recipients))
+
+
+def backfill(follower_id, followed_id, limit=BACKFILL_LIMIT):
+    """Copy the most recent messages of `followed_id` into a follower's timeline.
+
+    Nothing is copied for celebrities, whose messages are pulled on read.
+    """
+
+    already_there = exists().where(and_(
+        entries.c.user_id == follower_id,
+        entries.c.message_id == messages.c.id))
+
+    recent = (select([literal(follower_id), messages.c.id, messages.c.timestamp])
+              .where(and_(messages.c.user_id == followed_id, ~already_there,
+                          _pushed(followed_id)))
+              .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+              .limit(limit))
+
+    db.session.execute(entries.insert().from_select(_COLUMNS, recent))
+    trim(follower_id, follower_id)
+
+
+def backfill_many(follower_id, followed_ids, limit=BACKFILL_LIMIT):
+    """`backfill` for several newly-followed users in one statement."""
+
+    newest_first = func.row_number().over(
+        partition_by=messages.c.user_id,
+        order_by=[messages.c.timestamp.desc(), messages.c.id.desc()])
+
+    ranked = (select([messages.c.id, messages.c.timestamp, newest_first.label('rank')])
+              .select_from(messages.join(users, users.c.id == messages.c.user_id))
+              .where(and_(messages.c.user_id.in_(followed_ids),
+                          users.c.followers_count < CELEBRITY_FOLLOWERS))
+              .alias('ranked'))
+
+    already_there = exists().where(and_(
+        entries.c.user_id == follower_id,
+        entries.c.message_id == ranked.c.id))
+
+    recent = (select([literal(follower_id), ranked.c.id, ranked.c.timestamp])
+              .where(and_(ranked.c.rank <= limit, ~already_there)))
+
+    db.session.execute(entries.insert().from_select(_COLUMNS, recent))
+    trim(follower_id, follower_id)
+
+
+def trim(first_id, last_id, limit=None, connection=None):
+    """Delete all but the newest `limit` (default TIMELINE_LIMIT) entries of
+    the timelines of users `first_id` to `last_id`. Returns how many were
+    deleted.
+    """
+
+    execute = (connection or db.session).execute
+    limit = limit or TIMELINE_LIMIT
+
+    newest_first = func.row_number().over(
+        partition_by=entries.c.user_id,
+        order_by=[entries.c.timestamp.desc(), entries.c.message_id.desc()])
+
+    ranked = (select([entries.c.user_id, entries.c.message_id,
+                      newest_first.label('rank')])
+              .where(entries.c.user_id.between(first_id, last_id))
+              .alias('ranked'))
+
+    excess = (select([ranked.c.user_id, ranked.c.message_id])
+              .where(ranked.c.rank > limit))
+
+    return execute(entries.delete().where(
+        tuple_(entries.c.user_id, entries.c.message_id).in_(excess))).rowcount
+
+
+def trim_all(batch_size=TRIM_BATCH, limit=None):
+    """`trim` every timeline, committing after each batch of users."""
+
+    deleted, last_id = 0, 0
+    while True:
+        user_ids = [user_id for (user_id,) in db.session
+                    .query(User.id)
+                    .filter(User.id > last_id)
+                    .order_by(User.id)
+                    .limit(batch_size)]
+        if not user_ids:
+            return deleted
+
+        deleted += trim(user_ids[0], user_ids[-1], limit)
+        db.session.commit()
+        last_id = user_ids[-1]
+
+
+def prune(follower_id, followed_id):
+    """Drop every message of `followed_id` from a follower's timeline."""
+
+    authored = select([messages.c.id]).where(messages.c.user_id == followed_id)
+
+    db.session.execute(entries.delete().where(and_(
+        entries.c.user_id == follower_id,
+        entries.c.message_id.in_(authored))))
+
+
+def reclassify(user_ids, delta):
+    """Move authors whose followers_count just crossed CELEBRITY_FOLLOWERS
+    between pushed and pulled.
+
+    `delta` is the change just made to each of `user_ids`' followers_count
+    (+1 for a follow, -1 for an unfollow), inside the caller's transaction.
+    Only the write that lands exactly on the boundary sees the crossing.
+    """
+
+    edge = CELEBRITY_FOLLOWERS if delta > 0 else CELEBRITY_FOLLOWERS - 1
+    crossed = [user_id for (user_id,) in db.session
+               .query(User.id)
+               .filter(User.id.in_(list(user_ids)), User.followers_count == edge)]
+    if not crossed:
+        return
+
+    celebrity_ids.clear()
+    for author_id in crossed:
+        if delta > 0:
+            _retract_author(author_id)
+        else:
+            _push_author(author_id)
+
+
+def _retract_author(author_id):
+    """Drop a new celebrity's messages from their followers' timelines."""
+
+    authored = select([messages.c.id]).where(messages.c.user_id == author_id)
+
+    db.session.execute(entries.delete().where(and_(
+        entries.c.user_id != author_id,
+        entries.c.message_id.in_(authored))))
+
+
+def _push_author(author_id, limit=BACKFILL_LIMIT):
+    """Push a former celebrity's recent messages to every follower."""
+
+    recent = (select([messages.c.id, messages.c.timestamp])
+              .where(messages.c.user_id == author_id)
+              .order_by(messages.c.timestamp.desc(), messages.c.id.desc())
+              .limit(limit)
+              .alias('recent'))
+
+    already_there = exists().where(and_(
+        entries.c.user_id == follows.c.user_following_id,
+        entries.c.message_id == recent.c.id))
+
+    rows = (select([follows.c.user_following_id, recent.c.id, recent.c.timestamp])
+            .select_from(follows.join(recent, true()))
+            .where(and_(follows.c.user_being_followed_id == author_id,
+                        follows.c.user_following_id != author_id,
+                        ~already_there)))
+
+    db.session.execute(entries.insert().from_select(_COLUMNS, rows))
+
+
+def retract(msg):
+    """Remove a message from every timeline it was delivered to."""
+
+    _buffer(msg.user_id, None)
+
+    db.session.execute(
+        entries.delete().where(entries.c.message_id == msg.id))
+
+
+def _buffer(author_id, key):
+    """Queue a change to an author's recent messages until the session commits.
+
+    `key` is a new (timestamp, message_id) pair to add, or None to drop the
+    author's buffer. Applied earlier, a rolled-back post would stay in the
+    buffer, and a reader could reload a deleted message before it's gone.
+    """
+
+    db.session.info.setdefault('recent_messages', []).append((author_id, key))
+
+
+@event.listens_for(Session, 'after_commit')
+def _buffer_on_commit(session):
+    for author_id, key in session.info.pop('recent_messages', ()):
+        if key is None:
+            recent_messages.pop(author_id)
+            continue
+        buffered = recent_messages.peek(author_id)
+        if buffered is not None:
+            buffered.appendleft(key)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_on_rollback(session, previous_transaction):
+    session.info.pop('recent_messages', None)
+
+
+def home_timeline(user_id, limit=100, before=None, after=None):
+    """Return up to `limit` messages from a user's home timeline, newest first.
+
+    `before`/`after` are (timestamp, message_id) keyset cursors (see
+    pagination.py). Pushed entries come from one range read; messages of
+    followed celebrities are merged in from their recent-messages buffers.
+    """
+
+    celebs = celebrities()
+    followed_celebs = []
+    if celebs:
+        followed_celebs = [
+            followed_id for (followed_id,) in db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id.in_(list(celebs)))]
+
+    columns = [TimelineEntry.timestamp, TimelineEntry.message_id]
+
+    if not followed_celebs:
+        query = (Message
+                 .query
+                 .options(joinedload(Message.user))
+                 .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                 .filter(TimelineEntry.user_id == user_id))
+        messages = seek(query, columns, before, after).limit(limit).all()
+        if after is not None:
+            messages.reverse()
+        return messages
+
+    pushed = seek(db.session
+                  .query(TimelineEntry.timestamp, TimelineEntry.message_id)
+                  .filter(TimelineEntry.user_id == user_id),
+                  columns, before, after).limit(limit)
+
+    streams = [[tuple(row) for row in pushed]]
+    streams.extend(_author_stream(author_id, limit, before, after)
+                   for author_id in followed_celebs)
+
+    merged = heapq.merge(*streams, reverse=after is None)
+    ids = list(islice(_unique(message_id for _, message_id in merged), limit))
+    if after is not None:
+        ids.reverse()
+
+    by_id = {msg.id: msg for msg in (Message
+                                      .query
+                                      .options(joinedload(Message.user))
+                                      .filter(Message.id.in_(ids)))}
+    return [by_id[message_id] for message_id in ids if message_id in by_id]
+
+
+def _author_stream(author_id, limit, before=None, after=None):
+    """Return an author's (timestamp, message_id) pairs past a cursor.
+
+    Ordered like `seek`: newest-first, or oldest-first for `after`. Reads
+    that reach past the oldest buffered message go to the database.
+    """
+
+    buffered = list(recent(author_id))
+    keys = [key for key in buffered if beyond(key, before, after)]
+
+    if len(buffered) == RECENT_PER_AUTHOR:
+        if after is not None:
+            # Messages between the cursor and the buffer aren't in it.
+            past_buffer = after < buffered[-1]
+        else:
+            past_buffer = len(keys) < limit
+        if past_buffer:
+            columns = [Message.timestamp, Message.id]
+            query = (db.session
+                     .query(Message.timestamp, Message.id)
+                     .filter(Message.user_id == author_id))
+            return [tuple(row) for row in seek(query, columns, before, after).limit(limit)]
+
+    if after is not None:
+        keys.reverse()
+    return keys[:limit]
+
+
+def _unique(message_ids):
+    seen = set()
+    for message_id in message_ids:
+        if message_id not in seen:
+            seen.add(message_id)
+            yield message_id
+
+
+def rebuild(connection=None, first_id=None, last_id=None):
+    """Recreate the timelines of users `first_id` to `last_id` (by default,
+    everyone's) from the `messages` and `follows` tables.
+
+    Used to populate timelines for data that predates fan-out, or to repair
+    them. Each follower gets the newest BACKFILL_LIMIT messages of each
+    author they follow, as on follow, and celebrities' messages are left
+    to be pulled, as on post; then the timelines are trimmed to
+    TIMELINE_LIMIT. Runs inside the caller's transaction; `rebuild_all`
+    does a large table a batch at a time.
+    """
+
+    execute = (connection or db.session).execute
+
+    if first_id is None or last_id is None:
+        first_id, last_id = execute(select([func.min(users.c.id),
+                                            func.max(users.c.id)])).first()
+        if first_id is None:
+            return
+
+    def in_range(column):
+        return column.between(first_id, last_id)
+
+    followed_ids = (select([follows.c.user_being_followed_id])
+                    .where(in_range(follows.c.user_following_id)))
+
+    newest_first = func.row_number().over(
+        partition_by=messages.c.user_id,
+        order_by=[messages.c.timestamp.desc(), messages.c.id.desc()])
+
+    ranked = (select([messages.c.user_id, messages.c.id, messages.c.timestamp,
+                      newest_first.label('rank')])
+              .where(or_(in_range(messages.c.user_id),
+                         messages.c.user_id.in_(followed_ids)))
+              .alias('ranked'))
+
+    own = (select([ranked.c.user_id, ranked.c.id, ranked.c.timestamp])
+           .where(and_(in_range(ranked.c.user_id),
+                       ranked.c.rank <= TIMELINE_LIMIT)))
+
+    followed = (select([follows.c.user_following_id,
+                        ranked.c.id,
+                        ranked.c.timestamp])
+                .select_from(follows
+                             .join(ranked,
+                                   ranked.c.user_id == follows.c.user_being_followed_id)
+                             .join(users, users.c.id == ranked.c.user_id))
+                .where(and_(in_range(follows.c.user_following_id),
+                            ranked.c.rank <= BACKFILL_LIMIT,
+                            follows.c.user_following_id != ranked.c.user_id,
+                            users.c.followers_count < CELEBRITY_FOLLOWERS)))
+
+    execute(entries.delete().where(in_range(entries.c.user_id)))
+    execute(entries.insert().from_select(_COLUMNS, own))
+    execute(entries.insert().from_select(_COLUMNS, followed))
+    trim(first_id, last_id, connection=connection)
+
+
+def rebuild_all(connection=None, batch_size=None, after_id=0, log=None):
+    """`rebuild` every timeline, a batch of users per transaction.
+
+    With `connection`, each batch commits on it; otherwise on db.session.
+    Memory and transaction size stay bounded however many users there
+    are. An interrupted run can be resumed from the last user id logged,
+    passed as `after_id`. Returns how many users were rebuilt.
+    """
+
+    batch_size = batch_size or REBUILD_BATCH
+    done, last_id = 0, after_id
+    while True:
+        execute = (connection or db.session).execute
+        user_ids = [user_id for (user_id,) in execute(
+            select([users.c.id])
+            .where(users.c.id > last_id)
+            .order_by(users.c.id)
+            .limit(batch_size))]
+        if not user_ids:
+            return done
+
+        if connection is None:
+            rebuild(None, user_ids[0], user_ids[-1])
+            db.session.commit()
+        else:
+            with connection.begin():
+                rebuild(connection, user_ids[0], user_ids[-1])
+
+        done += len(user_ids)
+        last_id = user_ids[-1]
+        if log:
+            log(f"Timelines rebuilt through user {last_id}")
@@ -0,0 +1,257 @@
+"""In-memory username prefix index for search-box autocomplete.
+
+Each worker keeps a sorted array of lowercase usernames. A prefix maps to
+one contiguous slice of it (two bisects), and the slice's most-followed
+users are returned. Short prefixes cover huge slices, so their top-TOP_K
+lists are cached: every prefix up to PRECOMPUTED_LENGTH characters is
+ranked when the index is loaded, longer ones when first asked for.
+
+Lookups don't take the lock. They work on the array and cache they found
+when they started: writers replace the array rather than change it, and
+swap cache entries whole. A change to one user only touches the cached
+lists for prefixes of their old and new username, and a save that
+changes none of the indexed fields (such as a password rehash) changes
+nothing.
+
+The index is built from the `users` table on first use. User inserts,
+updates and deletes are applied when their transaction commits, and the
+whole index is rebuilt every REFRESH_SECONDS to pick up changes made
+through other workers.
+"""
+
+from bisect import bisect_left, insort
+import heapq
+from itertools import groupby
+from threading import Lock, Thread
+import time
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, User
+
+REFRESH_SECONDS = 300
+
+# Slices up to this size are ranked on every call; larger ones are cached.
+SCAN_LIMIT = 256
+
+# Prefixes up to this long are ranked when the index is loaded.
+PRECOMPUTED_LENGTH = 2
+
+# Length of the cached lists; a larger `k` is always ranked on the spot.
+TOP_K = 10
+
+_MISSING = (float('inf'),)
+
+
+class PrefixIndex:
+    """Sorted (username, id) array with per-user popularity weights."""
+
+    def __init__(self):
+        self._keys = []
+        self._users = {}
+        self._top = {}
+        self._version = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._users)
+
+    def load(self, rows):
+        """Replace the index contents with (id, username, image_url, weight) rows."""
+
+        users = {user_id: (username, image_url, weight or 0)
+                 for user_id, username, image_url, weight in rows}
+        keys = sorted((username.lower(), user_id)
+                      for user_id, (username, _, _) in users.items())
+
+        top = {}
+        for length in range(1, PRECOMPUTED_LENGTH + 1):
+            groups = groupby((key for key in keys if len(key[0]) >= length),
+                             key=lambda key: key[0][:length])
+            for prefix, group in groups:
+                top[prefix] = _rank((user_id for _, user_id in group), users, TOP_K)
+
+        with self._lock:
+            self._users, self._keys, self._top = users, keys, top
+            self._version += 1
+
+    def add(self, user_id, username, image_url, weight=0):
+        """Insert or update one user."""
+
+        entry = (username, image_url, weight)
+        with self._lock:
+            old = self._users.get(user_id)
+            if old == entry:
+                return
+
+            if old is None or old[0] != username:
+                keys = list(self._keys)
+                if old is not None:
+                    _discard(keys, (old[0].lower(), user_id))
+                insort(keys, (username.lower(), user_id))
+                self._keys = keys
+
+            self._users[user_id] = entry
+            self._update_top(user_id, old, entry)
+            self._version += 1
+
+    def remove(self, user_id):
+        with self._lock:
+            old = self._users.get(user_id)
+            if old is None:
+                return
+
+            keys = list(self._keys)
+            _discard(keys, (old[0].lower(), user_id))
+            self._keys = keys
+            del self._users[user_id]
+            self._update_top(user_id, old, None)
+            self._version += 1
+
+    def _update_top(self, user_id, old, new):
+        """Fix the cached lists a change to one user affects. Holds the lock."""
+
+        names = [entry[0].lower() for entry in (old, new) if entry]
+        prefixes = {name[:n] for name in names for n in range(1, len(name) + 1)}
+
+        for prefix in prefixes & self._top.keys():
+            listed = self._top[prefix]
+            ids = [other for other in listed if other != user_id]
+            matches = new is not None and new[0].lower().startswith(prefix)
+
+            if len(ids) < len(listed) and (
+                    not matches or _order(user_id, new) > _order(user_id, old)):
+                # Someone outside the list may now belong in it.
+                del self._top[prefix]
+            elif matches:
+                order = _order(user_id, new)
+                if len(ids) < TOP_K or order < _order(ids[-1], self._users[ids[-1]]):
+                    ids.append(user_id)
+                    ids.sort(key=lambda other: _order(other, self._users[other]))
+                    self._top[prefix] = ids[:TOP_K]
+
+    def complete(self, prefix, k=8):
+        """Return up to `k` {id, username, image_url} dicts, most-followed first."""
+
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+
+        version, keys, users, top = self._version, self._keys, self._users, self._top
+
+        ids = top.get(prefix) if k <= TOP_K else None
+        if ids is None:
+            lo = bisect_left(keys, (prefix,))
+            hi = bisect_left(keys, (prefix + '\uffff',))
+            ids = _rank((keys[i][1] for i in range(lo, hi)), users, max(k, TOP_K))
+
+            if hi - lo > SCAN_LIMIT and k <= TOP_K:
+                with self._lock:
+                    if self._version == version:
+                        self._top[prefix] = ids
+
+        matches = []
+        for user_id in ids[:k]:
+            entry = users.get(user_id)
+            if entry is not None:
+                matches.append({'id': user_id,
+                                'username': entry[0],
+                                'image_url': entry[1]})
+        return matches
+
+
+def _order(user_id, entry):
+    """Sort key: most-followed first, then alphabetical."""
+
+    if entry is None:
+        return _MISSING
+    return (-entry[2], entry[0].lower(), user_id)
+
+
+def _rank(user_ids, users, k):
+    return heapq.nsmallest(k, user_ids,
+                           key=lambda user_id: _order(user_id, users.get(user_id)))
+
+
+def _discard(keys, key):
+    pos = bisect_left(keys, key)
+    if pos < len(keys) and keys[pos] == key:
+        del keys[pos]
+
+
+index = PrefixIndex()
+_loaded_at = None
+_refreshing = Lock()
+
+
+def _rows():
+    return (db.session
+            .query(User.id, User.username, User.image_url, User.followers_count)
+            .all())
+
+
+def complete(prefix, k=8):
+    """Autocomplete `prefix` against the (lazily built) username index."""
+
+    global _loaded_at
+
+    if _loaded_at is None:
+        with _refreshing:
+            if _loaded_at is None:
+                index.load(_rows())
+                _loaded_at = time.monotonic()
+
+    elif time.monotonic() - _loaded_at > REFRESH_SECONDS and _refreshing.acquire(False):
+        _loaded_at = time.monotonic()
+        app = current_app._get_current_object()
+        Thread(target=_refresh, args=(app,), daemon=True).start()
+
+    return index.complete(prefix, k)
+
+
+def _refresh(app):
+    try:
+        with app.app_context():
+            index.load(_rows())
+            db.session.remove()
+    finally:
+        _refreshing.release()
+
+
+##############################################################################
+# Keep the index current: queue user changes during the flush and apply
+# them once the transaction commits.
+
+
+def _queue(session, change):
+    if _loaded_at is not None:
+        session.info.setdefault('typeahead', []).append(change)
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _user_saved(mapper, connection, user):
+    session = Session.object_session(user)
+    _queue(session, ('add', user.id, user.username, user.image_url,
+                     user.followers_count or 0))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    _queue(Session.object_session(user), ('remove', user.id))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    for change in session.info.pop('typeahead', []):
+        if change[0] == 'add':
+            index.add(*change[1:])
+        else:
+            index.remove(change[1])
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('typeahead', None)
@@ -0,0 +1,96 @@
+"""Relationship lookups from the point of view of the logged-in user.
+
+User cards ask "does the viewer follow this user?" once per card, and
+profiles ask whether the user follows the viewer back and which of the
+viewer's follows also follow them. All of these are answered from the
+in-memory follow graph (graph.py), without a query per card. "Who to
+follow" suggestions are precomputed (recommendations.py).
+"""
+
+from flask import g
+
+from graph import graph
+import recommendations
+from models import db, User
+
+
+def _id(user_or_id):
+    return getattr(user_or_id, 'id', user_or_id)
+
+
+class Viewer:
+    """The current user's relationships, for templates."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self._following = None
+        self._suggestions = None
+
+    def __repr__(self):
+        return f"<Viewer #{self.user_id}>"
+
+    @property
+    def following(self):
+        """Frozen set of ids the viewer follows."""
+
+        if self._following is None:
+            self._following = frozenset(graph().following(self.user_id))
+        return self._following
+
+    def is_following(self, user_or_id):
+        """Does the viewer follow this user (a User, card or id)?"""
+
+        return graph().follows(self.user_id, _id(user_or_id))
+
+    def is_followed_by(self, user_or_id):
+        """Does this user follow the viewer?"""
+
+        return graph().follows(_id(user_or_id), self.user_id)
+
+    def is_mutual(self, user_or_id):
+        """Do the viewer and this user follow each other?"""
+
+        return graph().mutual(self.user_id, _id(user_or_id))
+
+    def known_followers(self, user_or_id, limit=3):
+        """Followers of this user whom the viewer follows.
+
+        Returns (up to `limit` (id, username) pairs, total number).
+        """
+
+        ids = graph().followed_by_following(self.user_id, _id(user_or_id))
+        if not ids:
+            return [], 0
+
+        names = dict(db.session
+                     .query(User.id, User.username)
+                     .filter(User.id.in_(ids[:limit])))
+        shown = [(user_id, names[user_id]) for user_id in ids[:limit] if user_id in names]
+        return shown, len(ids)
+
+    def suggestions(self):
+        """Accounts the viewer might want to follow, as JSON cards."""
+
+        if self._suggestions is None:
+            self._suggestions = recommendations.suggestions_for(self.user_id)
+        return self._suggestions
+
+
+def current_viewer():
+    """The Viewer for this request, or None when logged out."""
+
+    if not g.get('user'):
+        return None
+    if 'viewer' not in g or g.viewer.user_id != g.user.id:
+        g.viewer = Viewer(g.user.id)
+    return g.viewer
+
+
+def forget(user_id):
+    """Drop relationships cached for this request after `user_id` follows or
+    unfollows someone. The follow graph itself is updated on commit."""
+
+    viewer = g.get('viewer')
+    if viewer is not None and viewer.user_id == user_id:
+        viewer._following = None
+        viewer._suggestions = None
@@ -0,0 +1,305 @@
+"""Synthetic data sets shaped like a real social network.
+
+    python workload.py --users 100000 --out generator
+    python seed.py generator
+
+or, without intermediate files:
+
+    python workload.py --users 100000 --load
+
+The generated data has these properties:
+- In-degree follows a Zipf law: user 1 is the biggest celebrity and user
+  n has about 1/n**ZIPF of user 1's followers. A few accounts get a large
+  share of all follows, and most get a handful.
+- Out-degree is geometric around --follows-per-user, capped at MAX_FOLLOWING.
+- Posting activity is also Zipfian, over a shuffled order of users, so
+  the heaviest posters aren't simply the celebrities. The order depends
+  on --seed.
+- Message timestamps follow a daily cycle with occasional bursts of rapid
+  posting, increasing with message id. They are scaled to fill --days
+  ending at END, so the last message is just before END.
+- Likes are skewed towards a Zipfian set of popular messages, and nobody
+  likes their own.
+
+Every table is generated from its own random stream, derived from --seed,
+so the same arguments always produce the same rows. Rows are produced
+lazily and nothing grows with the data set's size, so --users and
+--messages can be in the tens of millions (100M+ rows in total). Files
+are CSV, gzipped with --gzip (seed.py reads either).
+"""
+
+import argparse
+import csv
+from datetime import datetime, timedelta
+import gzip
+import math
+import os
+import random
+import time
+
+# A bcrypt hash of "password", shared by every generated user.
+PASSWORD_HASH = '$2b$12$AKL5NgBOGUHTX/F4EtE4nuMdxeWQICHhrMlNW4F.k9e2wKzss82dq'
+
+END = datetime(2024, 1, 1)
+ZIPF = 1.0
+MAX_FOLLOWING = 5000
+MAX_LIKES = 5000
+
+# Chance that a message starts a burst, the burst's mean length, and how
+# much faster messages arrive during one.
+BURST_CHANCE = 0.002
+BURST_LENGTH = 200
+BURST_SPEEDUP = 20
+
+# How much busier the evening peak is than the daily average.
+DIURNAL = 0.6
+
+_MASK64 = 2 ** 64 - 1
+
+WORDS = ('just', 'the', 'a', 'new', 'today', 'coffee', 'code', 'shipping',
+         'weekend', 'music', 'birds', 'warble', 'really', 'love', 'this',
+         'why', 'is', 'my', 'deploy', 'bug', 'fixed', 'again', 'good',
+         'morning', 'night', 'thread', 'hot', 'take', 'city', 'rain')
+LOCATIONS = ('San Francisco', 'New York', 'London', 'Berlin', 'Lagos',
+             'Tokyo', 'São Paulo', 'Mumbai', 'Sydney', 'Toronto', '')
+
+
+class Workload:
+    """Row generators for one synthetic data set."""
+
+    def __init__(self, users=10000, messages=None, follows_per_user=20,
+                 likes_per_user=10, days=365, zipf=ZIPF, seed=0):
+        self.users = users
+        self.messages = users * 10 if messages is None else messages
+        self.follows_per_user = follows_per_user
+        self.likes_per_user = likes_per_user
+        self.days = days
+        self.zipf = zipf
+        self.seed = seed
+        self._user_step = self._step(users)
+        self._message_step = self._step(max(self.messages, 1))
+        rng = self._random('shuffle')
+        self._user_offset = rng.randrange(users)
+        self._message_offset = rng.randrange(max(self.messages, 1))
+        self._author_seed = self._random('authors').getrandbits(64)
+
+    def _random(self, name):
+        return random.Random(f'{self.seed}:{name}')
+
+    def _zipf_rank(self, rng, n):
+        """A rank in 1..n, rank r drawn with probability ~ 1/r**zipf."""
+
+        return self._zipf_quantile(rng.random(), n)
+
+    def _zipf_quantile(self, u, n):
+        """The rank at quantile `u` in [0, 1).
+
+        Inverts the CDF of the continuous power law on [1, n + 1), so it
+        needs no table of weights.
+        """
+
+        s = self.zipf
+        if s == 1:
+            x = (n + 1) ** u
+        else:
+            x = (u * ((n + 1) ** (1 - s) - 1) + 1) ** (1 / (1 - s))
+        return min(int(x), n)
+
+    @staticmethod
+    def _step(n):
+        step = 2654435761 % n or 1
+        while math.gcd(step, n) != 1:
+            step += 1
+        return step
+
+    @staticmethod
+    def _shuffled(rank, n, step, offset):
+        """Map ranks 1..n onto ids 1..n in a scrambled order.
+
+        `step` is coprime to n, so this is a bijection; `offset` makes the
+        order differ between seeds.
+        """
+
+        return ((rank - 1) * step + offset) % n + 1
+
+    def _author(self, message_id):
+        """The author of a message, a Zipfian draw made from its id alone.
+
+        Hashing the id (splitmix64) instead of drawing from the messages
+        stream lets likes_rows know who wrote a message without replaying
+        every message before it.
+        """
+
+        x = (self._author_seed + message_id * 0x9E3779B97F4A7C15) & _MASK64
+        x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+        x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+        x ^= x >> 31
+        rank = self._zipf_quantile(x / 2 ** 64, self.users)
+        return self._shuffled(rank, self.users, self._user_step, self._user_offset)
+
+    def users_rows(self):
+        rng = self._random('users')
+        yield ['id', 'email', 'username', 'bio', 'location', 'password']
+        for user_id in range(1, self.users + 1):
+            bio = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(0, 8)))
+            yield [user_id, f'user{user_id}@example.com', f'user{user_id}',
+                   bio, rng.choice(LOCATIONS), PASSWORD_HASH]
+
+    def follows_rows(self):
+        rng = self._random('follows')
+        cap = min(MAX_FOLLOWING, self.users - 1)
+        # Geometric out-degree with mean follows_per_user.
+        p = 1 / (1 + self.follows_per_user)
+
+        yield ['user_being_followed_id', 'user_following_id']
+        for follower_id in range(1, self.users + 1):
+            wanted = min(int(math.log(1 - rng.random()) / math.log(1 - p)), cap)
+            followed = set()
+            attempts = 0
+            while len(followed) < wanted and attempts < wanted * 4:
+                attempts += 1
+                followed_id = self._zipf_rank(rng, self.users)
+                if followed_id != follower_id:
+                    followed.add(followed_id)
+            for followed_id in sorted(followed):
+                yield [followed_id, follower_id]
+
+    def _arrivals(self, span):
+        """Arrival times in seconds for every message, and one after them.
+
+        The last is `span` on average, but only on average.
+        """
+
+        rng = self._random('message_times')
+        mean_gap = span / (self.messages + 1)
+        # Keep the average gap at mean_gap, bursts included.
+        calm_gap = mean_gap / (1 - BURST_CHANCE * BURST_LENGTH * (1 - 1 / BURST_SPEEDUP))
+        at = 0.0
+        burst = 0
+
+        for _ in range(self.messages + 1):
+            if burst:
+                burst -= 1
+                gap = mean_gap / BURST_SPEEDUP
+            else:
+                if rng.random() < BURST_CHANCE:
+                    burst = int(rng.expovariate(1 / BURST_LENGTH))
+                # Busier in the evening (UTC), quieter before dawn.
+                hour = (at % 86400) / 3600
+                # 1 / (1 + a sin) averages 1 / sqrt(1 - a**2) over a day.
+                gap = (calm_gap * math.sqrt(1 - DIURNAL ** 2)
+                       / (1 + DIURNAL * math.sin((hour - 12) * math.pi / 12)))
+            at += rng.expovariate(1 / gap)
+            yield at
+
+    def messages_rows(self):
+        rng = self._random('messages')
+        span = timedelta(days=self.days).total_seconds()
+        start = END - timedelta(seconds=span)
+
+        # The arrivals are random, so their total is only span on
+        # average. A first pass (cheap: a few floats per message) finds
+        # it, and the second scales every arrival to land before END.
+        total = 0.0
+        for total in self._arrivals(span):
+            pass
+        scale = span / total if total else 1.0
+        arrivals = self._arrivals(span)
+
+        yield ['id', 'text', 'timestamp', 'user_id']
+        for message_id in range(1, self.messages + 1):
+            at = next(arrivals) * scale
+            author_id = self._author(message_id)
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 20)))[:140]
+            timestamp = start + timedelta(seconds=at)
+            yield [message_id, text, timestamp.strftime('%Y-%m-%d %H:%M:%S.%f'), author_id]
+
+    def likes_rows(self):
+        rng = self._random('likes')
+        cap = min(MAX_LIKES, self.messages)
+        p = 1 / (1 + self.likes_per_user)
+
+        yield ['user_id', 'message_id']
+        for user_id in range(1, self.users + 1):
+            wanted = min(int(math.log(1 - rng.random()) / math.log(1 - p)), cap)
+            liked = set()
+            attempts = 0
+            while len(liked) < wanted and attempts < wanted * 4:
+                attempts += 1
+                message_id = self._shuffled(self._zipf_rank(rng, self.messages),
+                                            self.messages, self._message_step,
+                                            self._message_offset)
+                if self._author(message_id) != user_id:
+                    liked.add(message_id)
+            for message_id in sorted(liked):
+                yield [user_id, message_id]
+
+    def tables(self):
+        """(name, rows) for every table, in the order they must be loaded."""
+
+        return [('users', self.users_rows()),
+                ('messages', self.messages_rows()),
+                ('follows', self.follows_rows()),
+                ('likes', self.likes_rows())]
+
+
+def write_csv(workload, directory, compress=False, log=print):
+    """Write the workload's tables as CSV files in `directory`."""
+
+    os.makedirs(directory, exist_ok=True)
+    for name, rows in workload.tables():
+        path = os.path.join(directory, f'{name}.csv' + ('.gz' if compress else ''))
+        opener = gzip.open if compress else open
+        started = time.perf_counter()
+        with opener(path, 'wt', newline='') as f:
+            written = -1
+            writer = csv.writer(f)
+            for written, row in enumerate(rows):
+                writer.writerow(row)
+                if written and written % 1000000 == 0:
+                    log(f"{name}: {written:,} rows")
+        log(f"Wrote {written:,} {name} to {path} in {time.perf_counter() - started:,.1f}s")
+
+
+def load(workload, log=print):
+    """Recreate the database and stream the workload straight into it."""
+
+    import seed
+    from models import Follows, Likes, Message, User
+
+    tables = {'users': User.__table__, 'messages': Message.__table__,
+              'follows': Follows.__table__, 'likes': Likes.__table__}
+    seed.seed_tables([(tables[name], rows) for name, rows in workload.tables()], log)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int,
+                        help="total messages (default: 10 per user)")
+    parser.add_argument('--follows-per-user', type=int, default=20)
+    parser.add_argument('--likes-per-user', type=int, default=10)
+    parser.add_argument('--days', type=int, default=365,
+                        help="messages are spread over this many days")
+    parser.add_argument('--zipf', type=float, default=ZIPF,
+                        help="skew of followers, posting and likes")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='generator',
+                        help="directory for the CSV files")
+    parser.add_argument('--gzip', action='store_true', help="gzip the CSV files")
+    parser.add_argument('--load', action='store_true',
+                        help="load into the database instead of writing files")
+    args = parser.parse_args(argv)
+
+    workload = Workload(users=args.users, messages=args.messages,
+                        follows_per_user=args.follows_per_user,
+                        likes_per_user=args.likes_per_user, days=args.days,
+                        zipf=args.zipf, seed=args.seed)
+    if args.load:
+        load(workload)
+    else:
+        write_csv(workload, args.out, compress=args.gzip)
+
+
+if __name__ == '__main__':
+    main()